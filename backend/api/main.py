@@ -5,24 +5,54 @@ Web 聊天界面的后端 API 服务
 
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
 import os
 import sys
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from backend.api.services.auth_service import AuthService
 from backend.api.services.session_service import SessionService
 from backend.api.services.chat_service import ChatService
-from backend.api.routers import auth, sessions, chat
+from backend.api.services.job_service import JobService
+from backend.api.middleware.affinity import SessionAffinityMiddleware, worker_id
+from backend.api.middleware.server_timing import ServerTimingMiddleware
+from backend.api.routers import auth, sessions, chat, jobs, metrics, admin
+from backend.src.cache import caches
+from backend.src.logging_setup import log_pipeline
+from backend.src.loop_monitor import LoopMonitor
+from backend.src.memory_accounting import MemoryAccountant
+from backend.src.profiler import Profiler
+from backend.src.rate_governor import rate_governor
+from backend.src.readiness import Readiness
+from backend.src.startup import StartupReport, preload
+from backend.src.tracing import tracer
 
 
+logger = logging.getLogger(__name__)
+
 # 全局服务实例（用于依赖注入）
 auth_service: AuthService = None
 session_service: SessionService = None
 chat_service: ChatService = None
+job_service: JobService = None
+loop_monitor: LoopMonitor = None
+profiler: Profiler = None
+memory_accountant: MemoryAccountant = None
+readiness: Readiness = None
+
+# 管理员用户名（/api/admin 接口）
+admin_users: set[str] = set()
+admin_allow_all: bool = False
+
+# 最近一次启动的耗时报告
+startup_report: StartupReport = None
 
 # 全局资源（应用启动时初始化一次）
 global_mcp_manager = None
@@ -30,147 +60,155 @@ global_rag_manager = None
 global_config = None
 
 
+async def _init_mcp(mcp_cfg):
+    """初始化全局 MCP 管理器"""
+    from backend.src.mcp_manager import MCPManager
+    manager = MCPManager(mcp_cfg)
+    await manager.initialize()
+    return manager
+
+
+async def _init_rag(rag_cfg):
+    """初始化全局 RAG 管理器（qdrant_client 在线程中导入，期间不阻塞 MCP 握手）"""
+    await preload(["qdrant_client"])
+    from backend.src.rag_manager import RAGManager
+    manager = RAGManager(rag_cfg)
+    await manager.initialize()
+    return manager
+
+
+def _connect_studio(studio_cfg: dict) -> None:
+    """连接 AgentScope Studio（同步网络请求，在线程中调用）"""
+    import agentscope
+    try:
+        agentscope.init(
+            studio_url=studio_cfg.get("url", "http://localhost:3000"),
+            project=studio_cfg.get("project_name", "HowtoLive"),
+        )
+        print(f"✓ AgentScope Studio 已连接: {studio_cfg['url']}")
+    except Exception:
+        print(f"   提示: 请先启动 Studio (端口 {studio_cfg.get('port', 3000)})")
+        raise
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理
     
-    启动时初始化服务和全局资源，关闭时清理
+    启动时初始化服务和全局资源（相互独立的步骤并发进行），关闭时清理
     """
-    import time
-    _total_start = time.time()
+    global auth_service, session_service, chat_service, job_service, loop_monitor, profiler, memory_accountant, readiness, admin_users, admin_allow_all
+    global global_mcp_manager, global_rag_manager, global_config, startup_report
     
-    global auth_service, session_service, chat_service
-    global global_mcp_manager, global_rag_manager, global_config
+    # 启动耗时报告（写入 data/startup.json，见 /api/admin/startup）
+    startup_report = StartupReport()
     
     # 配置日志系统（在最开始配置）
-    import logging
-    import sys
-    from pathlib import Path
-    
-    _stage_start = time.time()
-    
-    # 配置根日志记录器
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(sys.stdout)  # 输出到控制台
-        ]
-    )
-    
-    # 设置特定模块的日志级别
-    logging.getLogger('backend.api.services.orchestrator_adapter').setLevel(logging.INFO)
-    logging.getLogger('uvicorn.access').setLevel(logging.WARNING)  # 减少访问日志
+    import yaml
     
-    print(f"⏱️  [日志配置]: {time.time() - _stage_start:.2f}秒")
+    with startup_report.phase("logging"):
+        # 加载 API 配置（使用绝对路径，从项目根目录开始）
+        _backend_dir = Path(__file__).parent.parent
+        api_config_path = _backend_dir / "config" / "api.yaml"
+        with open(api_config_path, "r", encoding="utf-8") as f:
+            api_cfg = yaml.safe_load(f).get("api", {})
+        
+        # 日志经队列由后台线程输出（不阻塞事件循环），格式 / 采样 / 限流见 api.yaml 的 logging 配置块
+        log_pipeline.configure(api_cfg.get("logging", {}), base_dir=_backend_dir)
     
     print("=" * 80)
     print("HowToLive Web API 启动中...")
     print("=" * 80)
     
-    _stage_start = time.time()
+    startup_cfg = api_cfg.get("startup", {})
+    
+    # 多 worker 部署：每个 worker 单独监听一个端口（共 HOWTOLIVE_WORKERS 个，端口为 api.port + HOWTOLIVE_WORKER_INDEX），
+    # 负载均衡器按会话做粘性路由。每个进程各自限流，模型限额按进程总数平分；
+    # 同一端口上的 uvicorn --workers（WEB_CONCURRENCY）同样计入进程总数，但这些进程共享端口，无法粘性路由
+    port_workers = int(os.environ.get("HOWTOLIVE_WORKERS") or 1)
+    shared_workers = int(os.environ.get("WEB_CONCURRENCY") or 1)
+    workers = port_workers * shared_workers
+    rate_governor.set_workers(workers)
+    if shared_workers > 1:
+        logger.warning(
+            f"⚠️ 同一端口运行 {shared_workers} 个 worker（WEB_CONCURRENCY / api.workers）：请求随机分配到进程，"
+            "断线续传、幂等重试和批量任务的长轮询 / 取消不可用，聊天服务请使用 HOWTOLIVE_WORKERS 每个 worker 一个端口"
+        )
+    if workers > 1:
+        print(f"  ✓ 多 worker 模式: {worker_id()} (共 {workers} 个 worker，模型限额按 worker 数平分)")
     
     # 加载配置
     from backend.src.config import load_app_config
-    from backend.src.mcp_manager import MCPManager
-    from backend.src.rag_manager import RAGManager
-    print(f"⏱️  [导入核心模块]: {time.time() - _stage_start:.2f}秒")
     
-    # 获取配置目录路径
-    _current_dir = Path(__file__).parent
-    _backend_dir = _current_dir.parent
+    with startup_report.phase("config"):
+        # 配置文件路径：相对于 backend 目录
+        config_dir = _backend_dir / "config"
+        cfg = load_app_config(str(config_dir))
+        global_config = cfg  # 保存全局配置
     
-    _stage_start = time.time()
+    # 共享缓存（嵌入向量等），需要在创建嵌入模型之前配置
+    cache_cfg = api_cfg.get("cache", {})
+    caches.configure(cache_cfg, base_dir=_backend_dir)
+    if caches.enabled:
+        print(f"  ✓ 缓存后端: {caches.backend.name}")
     
-    # 初始化 AgentScope Studio（如果启用）
-    import agentscope
-    print(f"⏱️  [导入 AgentScope]: {time.time() - _stage_start:.2f}秒")
-    _stage_start = time.time()
+    # === 第1步：初始化全局资源和认证数据库（相互独立，并发进行）===
+    print("\n[1] 初始化全局资源...")
+    pending = []
+    
+    # RAG、Studio 连接和认证数据库在其他任务 / 线程中进行
+    if cfg.rag and cfg.rag.enabled:
+        pending.append(asyncio.create_task(startup_report.run("rag", _init_rag(cfg.rag))))
+    else:
+        startup_report.skip("rag")
     
     studio_config_path = _backend_dir / "config" / "studio.yaml"
+    studio_cfg = {}
     if studio_config_path.exists():
-        import yaml
         with open(studio_config_path, "r", encoding="utf-8") as f:
             studio_cfg = yaml.safe_load(f).get("studio", {})
-        
-        if studio_cfg.get("enabled", False):
-            try:
-                # 正确的 agentscope.init 参数
-                agentscope.init(
-                    studio_url=studio_cfg.get("url", "http://localhost:3000"),
-                    project=studio_cfg.get("project_name", "HowtoLive"),
-                )
-                print(f"✓ AgentScope Studio 已连接: {studio_cfg['url']}")
-            except Exception as e:
-                print(f"⚠️ AgentScope Studio 连接失败: {e}")
-                print(f"   提示: 请先启动 Studio (端口 {studio_cfg.get('port', 3000)})")
-    
-    print(f"⏱️  [AgentScope Studio 初始化]: {time.time() - _stage_start:.2f}秒")
-    _stage_start = time.time()
-    
-    # 原有配置加载
-    
-    # 配置文件路径：相对于 backend 目录
-    config_dir = _backend_dir / "config"
-    cfg = load_app_config(str(config_dir))
-    global_config = cfg  # 保存全局配置
-    
-    # 加载 API 配置
-    import yaml
-    # 使用绝对路径，从项目根目录开始
-    api_config_path = _backend_dir / "config" / "api.yaml"
-    with open(api_config_path, "r", encoding="utf-8") as f:
-        api_cfg = yaml.safe_load(f).get("api", {})
+    if studio_cfg.get("enabled", False):
+        pending.append(asyncio.create_task(
+            startup_report.run("studio", asyncio.to_thread(_connect_studio, studio_cfg))
+        ))
+    else:
+        startup_report.skip("studio")
     
-    print(f"⏱️  [加载配置文件]: {time.time() - _stage_start:.2f}秒")
-    _stage_start = time.time()
+    # 认证服务 - 使用绝对路径确保数据位置固定
+    db_relative_path = api_cfg.get("database", {}).get("path", "data/users.db")
+    db_path = _backend_dir / db_relative_path
     
-    # === 第1步：初始化全局资源（耗时，但只需一次）===
-    print("\n[1] 初始化全局资源...")
+    # 确保数据目录存在
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    
+    auth_task = asyncio.create_task(startup_report.run("auth_db", asyncio.to_thread(
+        AuthService,
+        db_path=str(db_path),
+        secret_key=api_cfg.get("auth", {}).get("secret_key", "default-secret-key"),
+        algorithm=api_cfg.get("auth", {}).get("algorithm", "HS256"),
+        pool_size=api_cfg.get("database", {}).get("pool_size", 4),
+    ), required=True))
     
-    # 初始化 MCP 管理器（全局共享）
+    # MCP 在当前任务中初始化：stdio 客户端的连接由 anyio 的取消作用域管理，
+    # 必须在同一个任务中建立和关闭（关闭在 lifespan 结束时），因此不放到其他任务中
     if cfg.mcp and cfg.mcp.servers:
-        try:
-            print("  [MCP] 初始化 MCP 服务...")
-            global_mcp_manager = MCPManager(cfg.mcp)
-            await global_mcp_manager.initialize()
+        print("  [MCP] 初始化 MCP 服务...")
+        global_mcp_manager = await startup_report.run("mcp", _init_mcp(cfg.mcp))
+        if global_mcp_manager is not None:
             print("  ✓ MCP 管理器已初始化（全局）")
-        except Exception as e:
-            print(f"  ✗ MCP 初始化失败: {e}")
-            global_mcp_manager = None
+    else:
+        startup_report.skip("mcp")
     
-    print(f"⏱️  [MCP 初始化]: {time.time() - _stage_start:.2f}秒")
-    _stage_start = time.time()
-    
-    # 初始化 RAG 管理器（全局共享）
+    results = await asyncio.gather(*pending)
     if cfg.rag and cfg.rag.enabled:
-        try:
-            print("  [RAG] 初始化 RAG 系统...")
-            global_rag_manager = RAGManager(cfg.rag)
-            await global_rag_manager.initialize()
+        global_rag_manager = results[0]
+        if global_rag_manager is not None:
             print("  ✓ RAG 管理器已初始化（全局）")
-        except Exception as e:
-            print(f"  ✗ RAG 初始化失败: {e}")
-            global_rag_manager = None
-    
-    print(f"⏱️  [RAG 初始化]: {time.time() - _stage_start:.2f}秒")
-    _stage_start = time.time()
     
     # === 第2步：初始化应用服务 ===
     print("\n[2] 初始化应用服务...")
     
-    # 认证服务 - 使用绝对路径确保数据位置固定
-    db_relative_path = api_cfg.get("database", {}).get("path", "data/users.db")
-    db_path = _backend_dir / db_relative_path
-    
-    # 确保数据目录存在
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-    
-    auth_service = AuthService(
-        db_path=str(db_path),
-        secret_key=api_cfg.get("auth", {}).get("secret_key", "default-secret-key"),
-        algorithm=api_cfg.get("auth", {}).get("algorithm", "HS256"),
-    )
+    auth_service = await auth_task
     print(f"  ✓ 认证服务已初始化 (数据库: {db_path})")
     
     # 会话服务 - 使用绝对路径
@@ -179,28 +217,108 @@ async def lifespan(app: FastAPI):
     session_service = SessionService(sessions_base_dir=str(sessions_dir))
     print(f"  ✓ 会话服务已初始化 (会话目录: {sessions_dir})")
     
+    # 事件循环延迟监控（阻塞报告见 /api/admin/event-loop）
+    loop_monitor = LoopMonitor.from_config(api_cfg.get("loop_monitor", {}))
+    if loop_monitor is not None:
+        await loop_monitor.start()
+        print(f"  ✓ 事件循环监控已启动 (阻塞阈值: {loop_monitor.threshold * 1000:.0f}ms)")
+    
+    # 管理员：只有 admin.users 中的用户可以访问 /api/admin，admin.allow_all 显式开启时所有登录用户都可以访问
+    admin_cfg = api_cfg.get("admin", {}) or {}
+    admin_users = set(admin_cfg.get("users") or [])
+    admin_allow_all = bool(admin_cfg.get("allow_all", False))
+    if admin_allow_all:
+        logger.warning("⚠️ admin.allow_all 已开启：所有登录用户都可以访问管理接口（调用栈、采样分析、内存快照），仅适用于本地开发")
+    elif not admin_users:
+        print("  ℹ️ 未配置管理员（admin.users），管理接口对所有用户返回 403")
+    
+    # 采样分析器（/api/admin/profile，以及聊天请求的 X-Profile 请求头）
+    profiler = Profiler.from_config(api_cfg.get("profiling", {}), base_dir=_backend_dir)
+    
+    # 链路追踪（导出到本地文件或 OTLP 端点）
+    tracing_cfg = api_cfg.get("tracing", {})
+    tracer.configure(tracing_cfg, base_dir=_backend_dir)
+    if tracer.enabled:
+        print(f"  ✓ 链路追踪已启用 (导出: {tracing_cfg.get('exporter', 'jsonl')}, 采样率: {tracer.sample_ratio})")
+    
     # 聊天服务（传入全局资源）
-    chat_service = ChatService(
-        global_config=global_config,
-        global_mcp_manager=global_mcp_manager,
-        global_rag_manager=global_rag_manager,
-    )
+    with startup_report.phase("chat_service"):
+        chat_service = ChatService(
+            global_config=global_config,
+            global_mcp_manager=global_mcp_manager,
+            global_rag_manager=global_rag_manager,
+            sse_config=api_cfg.get("sse", {}),
+            websocket_config=api_cfg.get("websocket", {}),
+            idempotency_config=api_cfg.get("idempotency", {}),
+            scheduler_config=api_cfg.get("scheduler", {}),
+            admission_config=api_cfg.get("admission", {}),
+            deadline_config=api_cfg.get("deadlines", {}),
+            shutdown_config=api_cfg.get("shutdown", {}),
+            profiler=profiler,
+        )
     print("  ✓ 聊天服务已初始化")
     
-    print(f"⏱️  [应用服务初始化]: {time.time() - _stage_start:.2f}秒")
+    # 批量任务服务（复用聊天服务的 Orchestrator 适配器）
+    job_service = JobService.from_config(
+        chat_service.orchestrator_adapter,
+        api_cfg.get("jobs", {}),
+        base_dir=_backend_dir,
+        shutdown_cfg=api_cfg.get("shutdown", {}),
+    )
+    await job_service.start()
+    print(f"  ✓ 批量任务服务已初始化 (worker: {job_service.workers}, 结果目录: {job_service.jobs_dir})")
+    
+    # 内存统计（/api/admin/memory，定期统计的结果导出为指标）
+    memory_accountant = MemoryAccountant.from_config(api_cfg.get("memory", {}))
+    if memory_accountant is not None:
+        memory_accountant.add_source(chat_service.memory_sources)
+        await memory_accountant.start()
+    
+    # 预热：探测 MCP / Qdrant，可选发送一次模型 / 嵌入请求（完成前 /ready 返回 503）
+    readiness_cfg = api_cfg.get("readiness", {})
+    readiness = Readiness.from_config(readiness_cfg, global_mcp_manager, global_rag_manager, cfg, startup_report)
+    if readiness is not None and readiness_cfg.get("warm_up", {}).get("enabled", True):
+        await startup_report.run("warm_up", readiness.warm_up())
+        status = readiness.get_status()
+        print(f"  ✓ 预热完成 (就绪: {status['ready']}, 失败: {status['failed'] or '无'})")
+    elif readiness is not None:
+        readiness.warm = True
+    
+    # 启动后在后台预先导入首个请求才用到的模块（mem0 等），不计入启动时间
+    preload_task = asyncio.create_task(
+        startup_report.run("preload", preload(startup_cfg.get("preload", ["mem0", "openai"])))
+    )
+    
+    startup_report.finish()
+    startup_report.save(_backend_dir / startup_cfg.get("report_path", "data/startup.json"))
+    logger.info(f"🚀 启动完成: {json.dumps(startup_report.as_dict(), ensure_ascii=False)}")
     
-    _total_elapsed = time.time() - _total_start
     print("\n" + "=" * 80)
     print("✓ HowToLive Web API 已启动")
     print(f"  - API 文档: http://localhost:{api_cfg.get('port', 8000)}/docs")
     print(f"  - ReDoc: http://localhost:{api_cfg.get('port', 8000)}/redoc")
-    print(f"\n🚀 总启动时间: {_total_elapsed:.2f}秒")
+    print(f"\n🚀 总启动时间: {startup_report.total:.2f}秒")
     print("=" * 80)
     
     yield
     
     # 关闭时清理
     print("\n[关闭] 清理资源...")
+    preload_task.cancel()
+    
+    # 排空：拒绝新的生成，进行中的生成和批量任务消息在宽限期内完成并保存（会话状态、时间线、长期记忆），
+    # 超时的被取消（已生成的部分内容仍会保存），之后才关闭 MCP 等共享资源
+    grace = chat_service.shutdown_grace
+    stream_drain, job_drain = await asyncio.gather(chat_service.drain(grace), job_service.drain(grace))
+    logger.info(f"🛑 排空完成: {json.dumps({'streams': stream_drain, 'jobs': job_drain}, ensure_ascii=False)}")
+    print(
+        f"  ✓ 排空完成 ({stream_drain['seconds']:.1f}秒): 生成 {stream_drain['drained']} 个完成 / {stream_drain['aborted']} 个取消，"
+        f"批量任务消息 {job_drain['drained']} 条完成 / {job_drain['aborted']} 条未完成"
+    )
+    
+    # 停止批量任务
+    if job_service:
+        await job_service.close()
     
     # 清理聊天服务
     if chat_service:
@@ -211,7 +329,28 @@ async def lifespan(app: FastAPI):
         print("  [MCP] 关闭全局 MCP 管理器...")
         await global_mcp_manager.close_all()
     
+    # 停止内存统计
+    if memory_accountant:
+        await memory_accountant.stop()
+    
+    # 停止事件循环监控
+    if loop_monitor:
+        await loop_monitor.stop()
+    
+    # 关闭缓存连接
+    await caches.close()
+    
+    # 关闭用户数据库连接池
+    if auth_service:
+        await asyncio.to_thread(auth_service.close)
+    
+    # 导出剩余的 span
+    tracer.shutdown()
+    
     print("✓ 资源清理完成")
+    
+    # 输出队列中剩余的日志
+    log_pipeline.shutdown()
 
 
 # 创建 FastAPI 应用
@@ -233,13 +372,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Worker-Id"],
 )
 
+# 阶段耗时（Server-Timing 响应头 / 流式聊天 done 事件的 timings 字段）
+app.add_middleware(ServerTimingMiddleware)
+
+# 会话亲和提示（X-Worker-Id 响应头，负载均衡器按 X-Session-Id 请求头路由）
+app.add_middleware(SessionAffinityMiddleware)
+
 
 # 注册路由
 app.include_router(auth.router)
 app.include_router(sessions.router)
 app.include_router(chat.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
 
 
 @app.get("/", tags=["系统"])
@@ -259,6 +408,19 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/ready", tags=["系统"])
+async def readiness_check():
+    """就绪检查端点（依赖可用且预热完成时返回 200，否则返回 503）"""
+    if startup_report is None or startup_report.total is None:
+        return JSONResponse(status_code=503, content={"ready": False, "warm": False})
+    if chat_service is not None and chat_service.draining:
+        return JSONResponse(status_code=503, content={"ready": False, "draining": True})
+    if readiness is None:
+        return {"ready": True}
+    status = await readiness.check()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
 if __name__ == "__main__":
     import uvicorn
     import yaml
@@ -327,12 +489,25 @@ if __name__ == "__main__":
         "**/.idea/**",
     ]
     
+    # 同一端口的多个 worker（不支持粘性路由，见 API 指南；热重载时只能使用单个 worker）
+    workers = 1 if api_cfg.get("reload", False) else int(api_cfg.get("workers", 1))
+    if workers > 1:
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+    
+    # 每个 worker 一个端口：第 HOWTOLIVE_WORKER_INDEX 个 worker 监听 api.port + HOWTOLIVE_WORKER_INDEX
+    port = int(api_cfg.get("port", 8000)) + int(os.environ.get("HOWTOLIVE_WORKER_INDEX") or 0)
+    
+    # 关闭时等待连接结束的上限：SSE 连接保持到生成完成（shutdown.grace_period），留出保存的时间
+    grace_period = float(api_cfg.get("shutdown", {}).get("grace_period", 30))
+    
     uvicorn.run(
         "backend.api.main:app",
         host=api_cfg.get("host", "0.0.0.0"),
-        port=api_cfg.get("port", 8000),
+        port=port,
         reload=api_cfg.get("reload", False),
         reload_dirs=reload_dirs if api_cfg.get("reload", True) else None,
         reload_excludes=reload_excludes if api_cfg.get("reload", True) else None,
+        workers=workers,
+        timeout_graceful_shutdown=int(grace_period) + 10,
     )
 
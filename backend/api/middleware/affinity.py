@@ -0,0 +1,55 @@
+"""会话亲和（多 worker 部署）
+
+多个 worker 进程共享会话文件（有文件锁保护）和用户数据库，但以下状态只在处理请求的进程内：
+
+- 用户级资源缓存（mem0、用户知识库）
+- 幂等表（重试同一条消息时返回已有结果）
+- 生成流（``GET /api/chat/stream/{stream_id}`` 断线续传、WebSocket 的 resume）
+- 批量任务的执行（``/api/jobs`` 的长轮询和取消）
+
+这些请求需要由同一个 worker 处理。路由键是 ``X-Session-Id`` 请求头或 ``session_id`` 查询参数，
+负载均衡器按它做一致性哈希（例如 nginx ``hash $http_x_session_id$arg_session_id consistent``）：
+
+- ``POST /api/chat/stream``：前端带 ``X-Session-Id`` 请求头
+- ``GET /api/chat/stream/{stream_id}``：必须带 ``X-Session-Id`` 或 ``session_id``（缺少时返回 400）
+- ``/api/chat/ws``：连接地址带 ``session_id``，按连接路由
+- ``/api/jobs``：客户端在提交和后续请求中使用同一个自选的 ``X-Session-Id``
+
+每个响应都带有 ``X-Worker-Id``，用于检查路由是否稳定。
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+
+
+def worker_id() -> str:
+    """当前 worker 的标识（主机名-进程号）"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class SessionAffinityMiddleware:
+    """纯 ASGI 中间件：响应头附加 X-Worker-Id，并回显请求中的 X-Session-Id"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        # 进程号在 fork 后才确定，每个请求读取一次（开销可以忽略）
+        extra = [(b"x-worker-id", worker_id().encode("latin-1"))]
+        for name, value in scope.get("headers", []):
+            if name == b"x-session-id":
+                extra.append((b"x-session-id", value))
+                break
+        
+        async def send_with_worker(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + extra}
+            await send(message)
+        
+        await self.app(scope, receive, send_with_worker)
@@ -11,6 +11,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from backend.api.models import User
 from backend.api.services.auth_service import AuthService
+from backend.src.timings import timed
 
 
 security = HTTPBearer()
@@ -35,15 +36,75 @@ async def get_current_user(
     Args:
         credentials: HTTP Authorization Bearer token
         auth_service: 认证服务实例
-        
+    
     Returns:
         当前用户对象
-        
+    
     Raises:
         HTTPException: 如果 token 无效或用户不存在
     """
-    token = credentials.credentials
+    with timed("auth"):
+        return await authenticate_token(credentials.credentials, auth_service)
+
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """获取当前管理员用户（依赖注入，用于 /api/admin 调试接口）
+    
+    管理员由 api.yaml 的 admin.users 配置；列表为空时所有用户都返回 403，
+    admin.allow_all 为 true 时所有登录用户都可以访问（仅适用于本地开发）
     
+    Raises:
+        HTTPException: 如果当前用户不是管理员
+    """
+    if not is_admin(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required",
+        )
+    return current_user
+
+
+async def get_configured_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """获取当前管理员用户，只接受 admin.users 中列出的用户（依赖注入，用于采样分析）
+    
+    采样分析会安装进程级的 SIGPROF 定时器，admin.allow_all 开启时也不开放给其他用户
+    
+    Raises:
+        HTTPException: 如果当前用户不在 admin.users 中
+    """
+    if not is_configured_admin(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required",
+        )
+    return current_user
+
+
+def is_admin(user: User) -> bool:
+    """用户是否为管理员（在 api.yaml 的 admin.users 中，或显式开启了 admin.allow_all）"""
+    from backend.api.main import admin_allow_all
+    return admin_allow_all or is_configured_admin(user)
+
+
+def is_configured_admin(user: User) -> bool:
+    """用户是否在 api.yaml 的 admin.users 中（不考虑 admin.allow_all）"""
+    from backend.api.main import admin_users
+    return user.username in admin_users
+
+
+async def authenticate_token(token: str, auth_service: AuthService) -> User:
+    """验证 access token 并返回对应用户（HTTP 依赖和 WebSocket 共用）
+    
+    Args:
+        token: JWT access token
+        auth_service: 认证服务实例
+    
+    Returns:
+        当前用户对象
+    
+    Raises:
+        HTTPException: 如果 token 无效或用户不存在
+    """
     # 验证 token
     payload = auth_service.verify_token(token)
     if payload is None:
@@ -70,7 +131,7 @@ async def get_current_user(
         )
     
     # 获取用户信息
-    user = auth_service.get_user_by_id(user_id)
+    user = await auth_service.get_user_by_id(user_id)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,36 @@
+"""Server-Timing 中间件
+
+为每个 HTTP 请求创建阶段耗时记录（``backend/src/timings.py``），
+响应开始时把已记录的阶段写入 ``Server-Timing`` 响应头。
+
+非流式接口在处理完成后才开始响应，响应头包含全部阶段；
+流式聊天的响应头只包含开始生成前的阶段（例如 auth），完整耗时见 ``done`` 事件。
+"""
+
+from __future__ import annotations
+
+from backend.src.timings import RequestTimings, timings_scope
+
+
+class ServerTimingMiddleware:
+    """纯 ASGI 中间件（不缓冲流式响应）"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        timings = RequestTimings()
+        
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+        
+        with timings_scope(timings):
+            await self.app(scope, receive, send_with_timing)
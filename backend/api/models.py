@@ -81,6 +81,7 @@ class ChatRequest(BaseModel):
     """聊天请求"""
     session_id: str = Field(..., description="会话ID")
     message: str = Field(..., description="用户消息")
+    idempotency_key: Optional[str] = Field(None, max_length=255, description="幂等键（可选，也可以使用 Idempotency-Key 请求头）")
 
 
 class ChatResponse(BaseModel):
@@ -95,9 +96,50 @@ class ChatResponse(BaseModel):
 
 class StreamChunk(BaseModel):
     """流式响应数据块"""
-    type: str  # "start", "token", "done", "error"
+    type: str  # "start", "token", "tool_start", "tool_end", "done", "error"
     content: Optional[str] = None
+    tool_name: Optional[str] = None
+    tool_id: Optional[str] = None
     session_id: Optional[str] = None
     message_id: Optional[str] = None
     error: Optional[str] = None
 
+
+
+# ============ 批量任务相关 ============
+
+class JobItemCreate(BaseModel):
+    """批量任务中的一条消息"""
+    session_id: str = Field(..., description="会话ID")
+    message: str = Field(..., description="用户消息")
+
+
+class JobCreate(BaseModel):
+    """创建批量任务请求"""
+    items: list[JobItemCreate] = Field(..., min_length=1, description="要处理的消息列表")
+    concurrency: Optional[int] = Field(None, ge=1, description="该任务同时处理的消息数（可选，不超过服务端上限）")
+
+
+class JobItemResult(BaseModel):
+    """批量任务中一条消息的处理结果"""
+    index: int
+    session_id: str
+    message: str
+    status: str  # "pending", "running", "completed", "failed", "cancelled"
+    content: Optional[str] = None
+    error: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+class JobInfo(BaseModel):
+    """批量任务状态"""
+    job_id: str
+    status: str  # "queued", "running", "completed", "cancelled", "interrupted"
+    total: int
+    completed: int
+    failed: int
+    concurrency: int
+    created_at: datetime
+    updated_at: datetime
+    results: Optional[list[JobItemResult]] = None
@@ -0,0 +1,197 @@
+"""管理路由
+
+提供运行时诊断接口（仅管理员可访问）
+"""
+
+from __future__ import annotations
+
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+
+from backend.api.middleware.auth import get_admin_user, get_configured_admin_user
+from backend.src.loop_monitor import LoopMonitor
+from backend.src.memory_accounting import MemoryAccountant, TracingNotStarted
+from backend.src.profiler import Profiler, ProfilerBusy
+
+
+router = APIRouter(prefix="/api/admin", tags=["管理"], dependencies=[Depends(get_admin_user)])
+
+
+def get_loop_monitor() -> LoopMonitor:
+    """获取事件循环监控器实例（依赖注入）"""
+    from backend.api.main import loop_monitor
+    if loop_monitor is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="事件循环监控未启用",
+        )
+    return loop_monitor
+
+
+def get_profiler() -> Profiler:
+    """获取采样分析器实例（依赖注入）"""
+    from backend.api.main import profiler
+    if profiler is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="采样分析未启用",
+        )
+    return profiler
+
+
+def get_memory_accountant() -> MemoryAccountant:
+    """获取内存统计实例（依赖注入）"""
+    from backend.api.main import memory_accountant
+    if memory_accountant is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="内存统计未启用",
+        )
+    return memory_accountant
+
+
+@router.get("/startup", summary="启动耗时报告")
+async def get_startup_report():
+    """最近一次启动的各阶段耗时（与 data/startup.json 相同）
+    
+    每个阶段包含相对启动的开始时间、耗时和结果（ok / failed / skipped），
+    并发进行的阶段开始时间相近。
+    """
+    from backend.api.main import startup_report
+    if startup_report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="服务尚未启动完成",
+        )
+    return startup_report.as_dict()
+
+
+@router.get("/event-loop", summary="事件循环阻塞报告")
+async def event_loop_report(
+    limit: int = Query(10, ge=1, le=100, description="返回的阻塞位置数量"),
+    loop_monitor: LoopMonitor = Depends(get_loop_monitor),
+):
+    """查看事件循环延迟和阻塞最多的调用位置
+    
+    每个位置包含阻塞次数、累计 / 最长阻塞时间和最近一次阻塞时的调用栈，
+    用于定位异步路径中的同步调用（数据库、文件读写等）。
+    """
+    return loop_monitor.get_report(limit=limit)
+
+
+@router.post("/profile", summary="进程采样分析", dependencies=[Depends(get_configured_admin_user)])
+async def profile_process(
+    duration: float = Query(10, gt=0, le=300, description="采样时长（秒，不超过 profiling.max_duration）"),
+    loop_only: bool = Query(False, description="只采样事件循环线程"),
+    include_idle: bool = Query(False, description="包含等待中的线程"),
+    output: Literal["folded", "json"] = Query("folded", alias="format", description="folded: 折叠栈文件，json: 摘要"),
+    profiler: Profiler = Depends(get_profiler),
+):
+    """对运行中的进程做限时采样分析
+    
+    folded 格式可直接用于 flamegraph.pl / speedscope 生成火焰图，
+    结果同时保存在服务端，可通过 `GET /api/admin/profiles/{profile_id}` 再次获取。
+    采样接口只对 admin.users 中的管理员开放（不受 admin.allow_all 影响），每个进程同时只进行一次采样。
+    
+    Raises:
+        HTTPException: 如果已有采样（包括单次请求采样）正在进行（409）
+    """
+    try:
+        profile = await profiler.profile_process(duration, loop_only=loop_only, include_idle=include_idle)
+    except ProfilerBusy as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        )
+    
+    if output == "json":
+        return profile.summary(limit=20)
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={
+            "Content-Disposition": f'attachment; filename="{profile.id}.folded"',
+            "X-Profile-Id": profile.id,
+        },
+    )
+
+
+@router.get("/profiles", summary="已保存的采样结果", dependencies=[Depends(get_configured_admin_user)])
+async def list_profiles(profiler: Profiler = Depends(get_profiler)):
+    """列出已保存的采样结果（包括单次请求采样，新的在前）"""
+    return profiler.list_profiles()
+
+
+@router.get(
+    "/profiles/{profile_id}",
+    response_class=PlainTextResponse,
+    summary="获取采样结果",
+    dependencies=[Depends(get_configured_admin_user)],
+)
+async def get_profile(profile_id: str, profiler: Profiler = Depends(get_profiler)):
+    """获取已保存的折叠栈文件
+    
+    Raises:
+        HTTPException: 如果结果不存在
+    """
+    collapsed = profiler.load(profile_id)
+    if collapsed is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="采样结果不存在",
+        )
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'},
+    )
+
+
+@router.get("/memory", summary="内存统计")
+async def memory_report(memory_accountant: MemoryAccountant = Depends(get_memory_accountant)):
+    """统计各缓存和各用户的保留大小（近似值）
+    
+    缓存包括每个用户的 mem0 实例和知识库、生成流的帧缓冲区、幂等表、
+    进行中请求的 Agent 对话历史和事件队列。被多个条目共享的对象单独计为 shared_bytes。
+    统计会遍历缓存引用的全部对象，用户较多时需要数秒。
+    """
+    return await memory_accountant.report()
+
+
+@router.post("/memory/tracemalloc", summary="开启 tracemalloc")
+async def start_tracemalloc(
+    frames: int = Query(10, ge=1, le=100, description="记录的调用栈深度"),
+    memory_accountant: MemoryAccountant = Depends(get_memory_accountant),
+):
+    """开启 tracemalloc（约有 30% 的内存和 CPU 开销，排查完成后请关闭）"""
+    started = memory_accountant.start_tracing(frames)
+    return {"started": started, **memory_accountant.tracing_stats()}
+
+
+@router.delete("/memory/tracemalloc", summary="关闭 tracemalloc")
+async def stop_tracemalloc(memory_accountant: MemoryAccountant = Depends(get_memory_accountant)):
+    """关闭 tracemalloc 并丢弃基线快照"""
+    memory_accountant.stop_tracing()
+    return memory_accountant.tracing_stats()
+
+
+@router.post("/memory/snapshot", summary="内存分配快照")
+async def memory_snapshot(
+    limit: int = Query(20, ge=1, le=200, description="返回的分配位置数量"),
+    group_by: Literal["lineno", "traceback"] = Query("lineno", description="按行 / 按完整调用栈汇总"),
+    memory_accountant: MemoryAccountant = Depends(get_memory_accountant),
+):
+    """拍摄 tracemalloc 快照，返回分配最多的位置
+    
+    与上一次快照的差异在 `diff` 中（按增长量排序），间隔一段时间连续调用两次即可找到持续增长的分配位置。
+    
+    Raises:
+        HTTPException: 如果 tracemalloc 未开启（409）
+    """
+    try:
+        return await memory_accountant.snapshot(limit=limit, group_by=group_by)
+    except TracingNotStarted as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"{e}，请先调用 POST /api/admin/memory/tracemalloc",
+        )
@@ -32,7 +32,7 @@ async def register(
     Raises:
         HTTPException: 如果用户名已存在
     """
-    user_id = auth_service.register_user(
+    user_id = await auth_service.register_user(
         username=user_data.username,
         password=user_data.password,
         email=user_data.email,
@@ -45,7 +45,7 @@ async def register(
         )
     
     # 获取创建的用户信息
-    user = auth_service.get_user_by_id(user_id)
+    user = await auth_service.get_user_by_id(user_id)
     return user
 
 
@@ -65,7 +65,7 @@ async def login(
     Raises:
         HTTPException: 如果用户名或密码错误
     """
-    user = auth_service.authenticate_user(
+    user = await auth_service.authenticate_user(
         username=user_data.username,
         password=user_data.password,
     )
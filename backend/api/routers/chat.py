@@ -1,16 +1,25 @@
 """聊天路由
 
-提供 SSE 流式聊天接口
+提供 SSE 流式聊天接口和 WebSocket 多路复用接口
 """
 
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, WebSocket, status
 from sse_starlette.sse import EventSourceResponse
 
 from backend.api.models import User, ChatRequest
+from backend.api.services.admission import Overloaded
+from backend.api.services.auth_service import AuthService
 from backend.api.services.chat_service import ChatService
-from backend.api.middleware.auth import get_current_user
+from backend.api.services.chat_socket import ChatSocket, authenticate_websocket
+from backend.api.services.fair_scheduler import QueueFull
+from backend.api.services.idempotency import IdempotencyConflict
+from backend.api.services.stream_registry import Draining, parse_last_event_id
+from backend.src.profiler import ProfilerBusy
+from backend.api.middleware.auth import get_auth_service, get_current_user, is_configured_admin
 
 
 router = APIRouter(prefix="/api/chat", tags=["聊天"])
@@ -25,34 +34,184 @@ def get_chat_service() -> ChatService:
 @router.post("/stream", summary="流式聊天（SSE）")
 async def chat_stream(
     chat_request: ChatRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+    x_profile: Optional[str] = Header(None, alias="X-Profile"),
     current_user: User = Depends(get_current_user),
     chat_service: ChatService = Depends(get_chat_service),
 ):
     """流式聊天接口（使用 Server-Sent Events）
     
+    生成在后台独立运行，连接断开后可通过 `GET /api/chat/stream/{stream_id}`
+    携带 `Last-Event-ID` 恢复。
+    
+    带 `Idempotency-Key` 请求头（或请求体中的 idempotency_key）的重复提交
+    不会再次生成：进行中的生成会被重新订阅，已完成的生成会重放结果，
+    此时响应头包含 `Idempotency-Replayed: true`。
+    
+    生成按用户公平排队：同一用户排队的请求过多时返回 429；
+    服务过载（进行中的生成数达到自适应并发上限）或正在关闭时返回 503。
+    两种情况下 `Retry-After` 响应头都给出建议的重试间隔（秒）。
+    
+    `admin.users` 中的管理员可以带 `X-Profile: 1` 请求头对本次生成做采样分析（每个进程同时只进行一次，已有采样时返回 409），
+    `done` 事件的 `profile` 字段给出摘要，完整的折叠栈通过 `GET /api/admin/profiles/{profile_id}` 获取。
+    
+    所有连接断开且在宽限期
+    （`sse.resume.disconnect_grace`）内没有重连时，生成会被取消，
+    已生成的部分内容仍会保存到会话历史。
+    
     Args:
         chat_request: 聊天请求（包含 session_id 和 message）
+        idempotency_key: 幂等键（请求头 Idempotency-Key）
+        x_profile: 采样分析开关（请求头 X-Profile，仅 admin.users 中的管理员）
         current_user: 当前登录用户
         chat_service: 聊天服务实例
-        
+    
     Returns:
-        SSE 事件流
-        
+        SSE 事件流（每个事件带递增的 id）
+    
+    Raises:
+        HTTPException: 如果非管理员请求采样分析（403），已有采样正在进行或幂等键已用于不同的请求（409），排队的请求过多（429），或服务过载 / 正在关闭（503）
+    
     事件格式：
-        data: {"type": "start", "session_id": "xxx"}
+        data: {"type": "start", "session_id": "xxx", "stream_id": "xxx"}
         data: {"type": "token", "content": "字"}
-        data: {"type": "done", "message_id": "xxx"}
+        data: {"type": "tool_start", "tool_name": "xxx", "tool_id": "xxx"}
+        data: {"type": "tool_end", "tool_name": "xxx", "tool_id": "xxx"}
+        data: {"type": "done", "message_id": "xxx", "timings": {...}}
+        data: {"type": "resync", "content": "完整回复"}
+        data: {"type": "cancelled", "reason": "disconnect", "content": "已生成的部分内容"}
         data: {"type": "error", "error": "错误信息"}
     """
-    # 创建 SSE 事件生成器
-    async def event_generator():
-        async for chunk in chat_service.stream_chat(
+    profile = x_profile is not None and x_profile.lower() not in ("", "0", "false")
+    if profile and not is_configured_admin(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required",
+        )
+    
+    try:
+        stream, replayed = chat_service.start_stream(
             user_id=str(current_user.id),
             username=current_user.username,
             session_id=chat_request.session_id,
             message=chat_request.message,
-        ):
-            yield chunk
+            idempotency_key=idempotency_key or chat_request.idempotency_key,
+            profile=profile,
+        )
+    except (IdempotencyConflict, ProfilerBusy) as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        )
+    except QueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except (Overloaded, Draining) as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
     
-    return EventSourceResponse(event_generator())
+    return EventSourceResponse(
+        stream.subscribe(),
+        headers={"Idempotency-Replayed": "true"} if replayed else None,
+        ping=chat_service.ping_interval,
+        send_timeout=chat_service.send_timeout,
+        shutdown_grace_period=chat_service.shutdown_grace,
+    )
 
+
+@router.get("/stream/{stream_id}", summary="恢复流式聊天（SSE）")
+async def resume_chat_stream(
+    stream_id: str,
+    session_id: Optional[str] = Query(None, description="会话ID（不能设置请求头的客户端使用，例如浏览器 EventSource）"),
+    x_session_id: Optional[str] = Header(None, alias="X-Session-Id"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    current_user: User = Depends(get_current_user),
+    chat_service: ChatService = Depends(get_chat_service),
+):
+    """断线重连：重放 Last-Event-ID 之后的帧，然后继续跟随仍在运行的生成
+    
+    如果遗漏的帧已超出服务端缓冲区，会先收到一个
+    `{"type": "resync", "content": "此前的完整文本"}` 事件。
+    
+    生成流只在启动它的 worker 进程内，请求必须带上会话ID（`X-Session-Id` 请求头或 `session_id` 查询参数），
+    多 worker 部署时负载均衡器据此把请求路由到与 `POST /api/chat/stream` 相同的 worker。
+    
+    Args:
+        stream_id: start 事件中返回的流ID
+        session_id: 会话ID（查询参数）
+        x_session_id: 会话ID（请求头 X-Session-Id）
+        last_event_id: 客户端最后收到的事件ID（请求头 Last-Event-ID）
+    
+    Returns:
+        SSE 事件流
+    
+    Raises:
+        HTTPException: 如果缺少会话ID（400），或流不存在、已过期、不属于该会话（404）
+    """
+    session_id = x_session_id or session_id
+    if not session_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="缺少会话ID（X-Session-Id 请求头或 session_id 查询参数）",
+        )
+    
+    stream = chat_service.get_stream(stream_id, str(current_user.id))
+    if stream is None or stream.session_id != session_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="流不存在或已过期",
+        )
+    
+    return EventSourceResponse(
+        stream.subscribe(parse_last_event_id(last_event_id)),
+        ping=chat_service.ping_interval,
+        send_timeout=chat_service.send_timeout,
+        shutdown_grace_period=chat_service.shutdown_grace,
+    )
+
+
+@router.get("/stats", summary="生成流统计")
+async def chat_stats(
+    current_user: User = Depends(get_current_user),
+    chat_service: ChatService = Depends(get_chat_service),
+):
+    """生成流统计
+    
+    Returns:
+        启动 / 完成 / 因客户端断开而取消的生成数量，进行中的生成数，
+        取消后节省的 token 估算（按已完成回复的平均长度计算），
+        各级缓冲区的高水位（当前用户进行中的生成列出明细），
+        准入控制的并发上限和拒绝数量，公平调度的排队情况，
+        以及各阶段（路由 / 记忆 / 知识库 / 工具 / Agent）超出预算的次数
+    """
+    return chat_service.get_stats(user_id=str(current_user.id))
+
+
+@router.websocket("/ws")
+async def chat_websocket(
+    websocket: WebSocket,
+    chat_service: ChatService = Depends(get_chat_service),
+    auth_service: AuthService = Depends(get_auth_service),
+):
+    """WebSocket 聊天接口（一个连接承载多个会话的生成）
+    
+    连接后只认证一次（Authorization 请求头或首条 `{"type": "auth"}` 消息），
+    之后通过带 request_id 的 chat / resume / credit / cancel 消息
+    同时进行多个生成。事件格式与 SSE 接口相同，协议见 `chat_socket` 模块。
+    """
+    await websocket.accept()
+    user = await authenticate_websocket(
+        websocket,
+        auth_service,
+        timeout=chat_service.websocket_config.get("auth_timeout", 10),
+    )
+    if user is None:
+        return
+    
+    await ChatSocket.from_config(websocket, chat_service, user).run()
@@ -0,0 +1,141 @@
+"""批量任务路由
+
+提供批量聊天任务的提交、查询（轮询 / 长轮询）和取消接口
+"""
+
+from __future__ import annotations
+
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+from backend.api.models import User, JobCreate, JobInfo
+from backend.api.services.job_service import JobService
+from backend.api.services.stream_registry import Draining
+from backend.api.middleware.auth import get_current_user
+
+
+router = APIRouter(prefix="/api/jobs", tags=["批量任务"])
+
+
+def get_job_service() -> JobService:
+    """获取任务服务实例（依赖注入）"""
+    from backend.api.main import job_service
+    return job_service
+
+
+@router.post("", response_model=JobInfo, status_code=status.HTTP_202_ACCEPTED, summary="提交批量任务")
+async def create_job(
+    job_data: JobCreate,
+    current_user: User = Depends(get_current_user),
+    job_service: JobService = Depends(get_job_service),
+):
+    """提交批量聊天任务
+    
+    消息在服务端 worker 池中处理，同一会话的消息按提交顺序串行执行。
+    
+    Args:
+        job_data: 消息列表和可选的并发数
+    
+    Returns:
+        任务状态（包含 job_id）
+    
+    Raises:
+        HTTPException: 如果消息数超过上限（400），或服务正在关闭（503 + Retry-After）
+    """
+    try:
+        job = await job_service.submit(
+            user_id=str(current_user.id),
+            username=current_user.username,
+            items=[item.model_dump() for item in job_data.items],
+            concurrency=job_data.concurrency,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    except Draining as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    
+    return job.to_dict()
+
+
+@router.get("", response_model=List[JobInfo], summary="获取任务列表")
+async def list_jobs(
+    current_user: User = Depends(get_current_user),
+    job_service: JobService = Depends(get_job_service),
+):
+    """获取当前用户的所有任务（不含结果）
+    
+    Returns:
+        任务状态列表，按创建时间倒序排列
+    """
+    return job_service.list_jobs(str(current_user.id))
+
+
+@router.get("/{job_id}", response_model=JobInfo, summary="获取任务状态和结果")
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="长轮询等待时间（秒），0 表示立即返回"),
+    after: int = Query(-1, ge=-1, description="长轮询：已处理（完成 + 失败）的消息数超过该值时返回"),
+    current_user: User = Depends(get_current_user),
+    job_service: JobService = Depends(get_job_service),
+):
+    """获取任务状态和结果
+    
+    带 `wait` 参数时为长轮询：在有新的消息处理完成、任务结束或超时后返回。
+    
+    Args:
+        job_id: 任务ID
+        wait: 最长等待时间（秒）
+        after: 客户端已知的已处理消息数
+    
+    Returns:
+        任务状态（包含每条消息的结果）
+    
+    Raises:
+        HTTPException: 如果任务不存在
+    """
+    if wait > 0:
+        job = await job_service.wait(job_id, str(current_user.id), after_completed=after, timeout=wait)
+    else:
+        job = job_service.get(job_id, str(current_user.id))
+    
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="任务不存在",
+        )
+    
+    return job
+
+
+@router.delete("/{job_id}", response_model=JobInfo, summary="取消任务")
+async def cancel_job(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    job_service: JobService = Depends(get_job_service),
+):
+    """取消任务（未开始的消息不再处理，进行中的消息被取消）
+    
+    Args:
+        job_id: 任务ID
+    
+    Returns:
+        取消后的任务状态
+    
+    Raises:
+        HTTPException: 如果任务不存在
+    """
+    job = await job_service.cancel(job_id, str(current_user.id))
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="任务不存在",
+        )
+    
+    return job
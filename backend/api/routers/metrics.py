@@ -0,0 +1,202 @@
+"""指标路由
+
+以 Prometheus 文本格式导出进程内指标（不需要认证，便于本地抓取）
+"""
+
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from backend.src.cache import caches
+from backend.src.logging_setup import log_pipeline
+from backend.src.metrics import MetricFamily, registry
+from backend.src.tracing import tracer
+
+
+router = APIRouter(tags=["系统"])
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _collect_services() -> list[MetricFamily]:
+    """把各服务已有的统计转换为指标（抓取时调用）"""
+    from backend.api.main import auth_service, chat_service, job_service, memory_accountant, readiness, startup_report
+
+    families: list[MetricFamily] = []
+    if chat_service is not None:
+        stats = chat_service.get_stats()
+        families += [
+            ("howtolive_streams_total", "counter", "生成流数量（按结果）",
+             [({"result": key}, stats[key]) for key in ("started", "completed", "cancelled", "expired")]),
+            ("howtolive_streams_in_flight", "gauge", "进行中的生成数",
+             [({}, stats["in_flight"])]),
+            ("howtolive_stream_tokens_saved_total", "counter", "取消生成节省的 token 数（估算）",
+             [({}, stats["tokens_saved_estimate"])]),
+            ("howtolive_buffer_high_water", "gauge", "各级流式缓冲区的最大占用（事件数）",
+             [({"buffer": name}, size) for name, size in stats["high_water_peak"].items()]),
+        ]
+
+        idempotency = stats["idempotency"]
+        families += [
+            ("howtolive_idempotency_requests_total", "counter", "幂等键查找次数（按结果）",
+             [({"result": key}, idempotency[key]) for key in ("hits", "misses", "conflicts")]),
+            ("howtolive_idempotency_entries", "gauge", "幂等表中的 key 数",
+             [({}, idempotency["entries"])]),
+        ]
+
+        admission = stats.get("admission")
+        if admission is not None:
+            families += [
+                ("howtolive_admission_requests_total", "counter", "准入控制结果",
+                 [({"result": "admitted"}, admission["admitted"]), ({"result": "shed"}, admission["shed"])]),
+                ("howtolive_admission_in_flight", "gauge", "已接收的生成数",
+                 [({}, admission["in_flight"])]),
+                ("howtolive_admission_limit", "gauge", "自适应并发上限",
+                 [({}, admission["limit"])]),
+            ]
+
+        scheduler = stats.get("scheduler")
+        if scheduler is not None:
+            families += [
+                ("howtolive_scheduler_running", "gauge", "占用生成槽位的请求数",
+                 [({}, scheduler["running"])]),
+                ("howtolive_scheduler_queued", "gauge", "排队的请求数",
+                 [({}, scheduler["queued"])]),
+                ("howtolive_scheduler_rejected_total", "counter", "因用户队列已满被拒绝的请求数",
+                 [({}, scheduler["rejected"])]),
+            ]
+
+        deadlines = stats["deadlines"]
+        families += [
+            ("howtolive_stage_overruns_total", "counter", "各阶段超出预算的次数",
+             [({"stage": stage}, s["overruns"]) for stage, s in deadlines.items()]),
+            ("howtolive_stage_degraded_total", "counter", "各阶段超时后降级的次数",
+             [({"stage": stage}, s["degraded"]) for stage, s in deadlines.items()]),
+        ]
+
+        llm = stats["llm"]
+        families += [
+            ("howtolive_llm_calls_total", "counter", "模型调用次数",
+             [({"model": model}, s["calls"]) for model, s in llm.items()]),
+            ("howtolive_llm_throttled_total", "counter", "收到限流错误的模型调用次数",
+             [({"model": model}, s["throttled"]) for model, s in llm.items()]),
+            ("howtolive_llm_tokens_total", "counter", "模型调用消耗的 token 数",
+             [({"model": model}, s["tokens"]) for model, s in llm.items()]),
+            ("howtolive_llm_in_flight", "gauge", "进行中的模型调用数",
+             [({"model": model}, s["in_flight"]) for model, s in llm.items()]),
+            ("howtolive_llm_waiting", "gauge", "等待限流许可的模型调用数",
+             [({"model": model}, s["waiting"]) for model, s in llm.items()]),
+            ("howtolive_llm_queue_wait_seconds_avg", "gauge", "模型调用的平均排队时间（秒，按优先级）",
+             [({"model": model, "priority": priority}, w["avg"])
+              for model, s in llm.items() for priority, w in s["queue_wait_seconds"].items()]),
+        ]
+
+    if job_service is not None:
+        jobs = job_service.get_stats()
+        families += [
+            ("howtolive_jobs_workers", "gauge", "批量任务 worker 数（按状态）",
+             [({"state": "total"}, jobs["workers"]), ({"state": "busy"}, jobs["busy_workers"])]),
+            ("howtolive_jobs_active", "gauge", "未结束的批量任务数",
+             [({}, jobs["active_jobs"])]),
+            ("howtolive_jobs_pending_items", "gauge", "批量任务中待处理的消息数",
+             [({}, jobs["pending_items"])]),
+        ]
+
+    if memory_accountant is not None:
+        memory = memory_accountant.get_stats()
+        families += [
+            ("howtolive_memory_rss_bytes", "gauge", "进程常驻内存（字节）",
+             [({}, memory["rss_bytes"])]),
+            ("howtolive_memory_cache_entries", "gauge", "各缓存的条目数",
+             [({"cache": cache}, count) for cache, count in memory["entries"].items()]),
+            ("howtolive_memory_retained_bytes", "gauge", "各缓存的保留大小（字节，最近一次统计的近似值）",
+             [({"cache": cache}, s["retained_bytes"]) for cache, s in memory["caches"].items()]),
+            ("howtolive_memory_shared_bytes", "gauge", "各缓存引用的共享对象大小（字节，最近一次统计）",
+             [({"cache": cache}, s["shared_bytes"]) for cache, s in memory["caches"].items()]),
+        ]
+        if memory["tracemalloc"]["tracing"]:
+            families += [
+                ("howtolive_memory_traced_bytes", "gauge", "tracemalloc 跟踪的内存（字节）",
+                 [({}, memory["tracemalloc"]["traced_bytes"])]),
+            ]
+
+    if startup_report is not None and startup_report.total is not None:
+        families += [
+            ("howtolive_startup_seconds", "gauge", "最近一次启动的耗时（秒，按阶段，total 为总时间）",
+             [({"phase": p["name"]}, p["duration"]) for p in startup_report.phases]
+             + [({"phase": "total"}, startup_report.total)]),
+        ]
+
+    if readiness is not None:
+        checks = readiness.get_status()["checks"]
+        families += [
+            ("howtolive_dependency_up", "gauge", "依赖最近一次探测是否成功",
+             [({"dependency": name}, int(r["ok"])) for name, r in checks.items()]),
+            ("howtolive_dependency_probe_seconds", "gauge", "依赖最近一次探测的耗时（秒）",
+             [({"dependency": name}, r["latency_ms"] / 1000) for name, r in checks.items()]),
+        ]
+
+    if auth_service is not None:
+        db = auth_service.get_stats()
+        name = auth_service.db.name
+        families += [
+            ("howtolive_db_pool_size", "gauge", "数据库连接池的线程 / 连接数",
+             [({"db": name}, db["size"])]),
+            ("howtolive_db_pool_operations", "gauge", "数据库连接池中的操作数（按状态）",
+             [({"db": name, "state": state}, db[state]) for state in ("queued", "active")]),
+            ("howtolive_db_queries_total", "counter", "数据库操作次数（按结果）",
+             [({"db": name, "result": "ok"}, db["queries"] - db["errors"]),
+              ({"db": name, "result": "error"}, db["errors"])]),
+        ]
+
+    cache = caches.get_stats()
+    if cache["enabled"]:
+        families += [
+            ("howtolive_cache_errors_total", "counter", "缓存读写失败次数",
+             [({"cache": name}, stats["errors"]) for name, stats in cache["namespaces"].items()]),
+        ]
+        # redis 的条目数和淘汰由 Redis 自身统计
+        if "entries" in cache:
+            families += [
+                ("howtolive_cache_entries", "gauge", "缓存条目数（sqlite 为最近一次清理时的值）",
+                 [({"backend": cache["backend"]}, cache["entries"])]),
+                ("howtolive_cache_evictions_total", "counter", "超出条目上限被淘汰的缓存条目数",
+                 [({"backend": cache["backend"]}, cache["evictions"])]),
+            ]
+
+    logs = log_pipeline.get_stats()
+    if logs["configured"]:
+        families += [
+            ("howtolive_log_queue_size", "gauge", "等待输出的日志条数",
+             [({}, logs["queued"])]),
+            ("howtolive_log_records_dropped_total", "counter", "被丢弃的日志条数（按 logger 前缀和原因）",
+             [({"logger": "*", "reason": "queue_full"}, logs["dropped_queue_full"])]
+             + [({"logger": prefix, "reason": reason}, count)
+                for prefix, dropped in logs["dropped"].items() for reason, count in dropped.items()]),
+        ]
+
+    tracing = tracer.get_stats()
+    if tracing["enabled"]:
+        families += [
+            ("howtolive_traces_total", "counter", "追踪的请求数（按是否导出）",
+             [({"result": "sampled"}, tracing["sampled"]),
+              ({"result": "discarded"}, tracing["traces"] - tracing["sampled"])]),
+            ("howtolive_spans_total", "counter", "span 导出结果",
+             [({"result": key}, tracing.get(key, 0)) for key in ("exported", "dropped", "failed")]),
+        ]
+    return families
+
+
+registry.add_collector("services", _collect_services)
+
+
+@router.get("/metrics", response_class=PlainTextResponse, summary="Prometheus 指标")
+async def metrics():
+    """导出进程内指标（Prometheus 文本格式）
+
+    包含流水线各阶段耗时、路由分布、首 token 时间、输出速度、缓存命中、
+    会话读写和依赖（知识库 / 长期记忆 / 工具）调用耗时，以及各服务的统计。
+    """
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
@@ -11,6 +11,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from backend.api.models import User, SessionCreate, SessionInfo, SessionDetail
 from backend.api.services.session_service import SessionService
 from backend.api.middleware.auth import get_current_user
+from backend.src.file_lock import LockTimeout
 
 
 router = APIRouter(prefix="/api/sessions", tags=["会话管理"])
@@ -112,9 +113,15 @@ async def delete_session(
         成功消息
         
     Raises:
-        HTTPException: 如果会话不存在
+        HTTPException: 如果会话不存在（404），或会话正在被其他请求写入（409）
     """
-    success = session_service.delete_session(current_user.id, current_user.username, session_id)
+    try:
+        success = await session_service.delete_session(current_user.id, current_user.username, session_id)
+    except LockTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="会话正在使用中，请稍后重试",
+        )
     
     if not success:
         raise HTTPException(
@@ -0,0 +1,152 @@
+"""聊天请求准入控制
+
+上游模型变慢时，如果照常接收请求，生成会在调度队列和模型限流器中无限堆积，
+最终所有请求一起超时。准入控制器按 AIMD 自适应调整并发上限：
+
+- 每个生成的首个输出延迟（排队之后到第一个 token / 工具调用）作为延迟样本
+- 延迟超过目标值或生成出错：并发上限乘以 backoff（每个目标延迟周期最多降低一次）
+- 延迟正常且并发接近上限：并发上限每轮增加 1（每个样本增加 1 / limit）
+- 进行中的生成数达到上限时直接拒绝新请求（路由返回 503 和 Retry-After）
+
+这样过载时多出的请求快速失败，已接收的请求仍能在合理时间内完成。
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from typing import Optional
+
+
+class Overloaded(Exception):
+    """服务过载，拒绝新的生成"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"服务繁忙，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+class Permit:
+    """一次已接收的生成"""
+    
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.started_at = time.monotonic()
+        self.sampled = False
+        self.released = False
+    
+    def sample(self, since: Optional[float] = None, failed: bool = False) -> None:
+        """记录首个输出的延迟（只记录一次）
+        
+        Args:
+            since: 延迟的起点（monotonic 时间，默认为接收时间，可传入排队结束的时间）
+            failed: 生成是否出错
+        """
+        if not self.sampled:
+            self.sampled = True
+            latency = time.monotonic() - (since if since is not None else self.started_at)
+            self.controller._on_sample(latency, failed)
+    
+    def release(self) -> None:
+        """生成结束，可以重复调用"""
+        if not self.released:
+            self.released = True
+            self.controller._on_release(time.monotonic() - self.started_at)
+
+
+class AdmissionController:
+    """AIMD 自适应并发上限"""
+    
+    def __init__(
+        self,
+        initial_limit: int = 16,
+        min_limit: int = 2,
+        max_limit: int = 64,
+        latency_target: float = 10.0,
+        backoff: float = 0.9,
+    ):
+        """初始化准入控制器
+        
+        Args:
+            initial_limit: 初始并发上限
+            min_limit: 并发上限的下限
+            max_limit: 并发上限的上限
+            latency_target: 首个输出的目标延迟（秒），超过时降低并发上限
+            backoff: 降低并发上限时的乘数
+        """
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(int(initial_limit), self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        
+        self.in_flight = 0
+        self._latency: Optional[float] = None  # 首个输出延迟的滑动平均
+        self._duration = latency_target  # 生成耗时的滑动平均，用于估算 Retry-After
+        self._last_decrease = float("-inf")
+        
+        self.stats = {"admitted": 0, "shed": 0, "decreases": 0}
+    
+    @classmethod
+    def from_config(cls, cfg: dict | None) -> Optional["AdmissionController"]:
+        """从 api.yaml 的 admission 配置块创建（未启用时返回 None）"""
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        return cls(
+            initial_limit=cfg.get("initial_limit", 16),
+            min_limit=cfg.get("min_limit", 2),
+            max_limit=cfg.get("max_limit", 64),
+            latency_target=float(cfg.get("latency_target", 10)),
+            backoff=float(cfg.get("backoff", 0.9)),
+        )
+    
+    def admit(self) -> Permit:
+        """接收一次生成
+        
+        Raises:
+            Overloaded: 进行中的生成数已达当前并发上限
+        """
+        if self.in_flight >= math.floor(self.limit):
+            self.stats["shed"] += 1
+            raise Overloaded(self._retry_after())
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+        return Permit(self)
+    
+    def _retry_after(self) -> int:
+        # 超出上限的部分需要等前面的生成结束
+        excess = self.in_flight - math.floor(self.limit) + 1
+        return max(1, math.ceil(self._duration * excess / max(1.0, self.limit)))
+    
+    def _on_sample(self, latency: float, failed: bool) -> None:
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += 0.2 * (latency - self._latency)
+        
+        now = time.monotonic()
+        if failed or latency > self.latency_target:
+            # 一次延迟升高会影响同一时间段的所有样本，每个周期只降低一次
+            if now - self._last_decrease >= self.latency_target:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self._last_decrease = now
+                self.stats["decreases"] += 1
+        elif self.in_flight >= self.limit / 2:
+            # 只有并发确实接近上限时才提高上限
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+    
+    def _on_release(self, duration: float) -> None:
+        self.in_flight -= 1
+        self._duration += 0.1 * (duration - self._duration)
+    
+    def get_stats(self) -> dict:
+        """准入统计（当前并发、并发上限、拒绝数量、延迟）"""
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "limit": round(self.limit, 2),
+            "latency_target": self.latency_target,
+            "first_output_latency": round(self._latency, 4) if self._latency is not None else None,
+            "avg_duration": round(self._duration, 4),
+        }
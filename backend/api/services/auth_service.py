@@ -1,6 +1,9 @@
 """用户认证服务
 
 负责用户注册、登录、密码验证等
+
+数据库操作在专用连接池的线程中执行（``backend/src/sqlite_pool.py``），
+请求中的用户查询不再同步打开数据库连接、阻塞事件循环。
 """
 
 from __future__ import annotations
@@ -13,6 +16,7 @@ from typing import Optional
 from jose import JWTError, jwt
 
 from backend.api.models import User
+from backend.src.sqlite_pool import SQLitePool
 
 
 # 使用 SHA256 进行密码哈希（简单可靠，适合开发环境）
@@ -47,18 +51,20 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 class AuthService:
     """用户认证服务"""
     
-    def __init__(self, db_path: str, secret_key: str, algorithm: str = "HS256"):
+    def __init__(self, db_path: str, secret_key: str, algorithm: str = "HS256", pool_size: int = 4):
         """初始化认证服务
         
         Args:
             db_path: SQLite 数据库路径
             secret_key: JWT 密钥
             algorithm: JWT 算法
+            pool_size: 数据库连接池大小
         """
         self.db_path = db_path
         self.secret_key = secret_key
         self.algorithm = algorithm
         self._init_database()
+        self.db = SQLitePool(db_path, size=pool_size, name="auth_db")
     
     def _init_database(self):
         """初始化用户数据库"""
@@ -144,7 +150,7 @@ class AuthService:
             print(f"Token 验证异常: {e}")
             return None
     
-    def register_user(self, username: str, password: str, email: Optional[str] = None) -> Optional[int]:
+    async def register_user(self, username: str, password: str, email: Optional[str] = None) -> Optional[int]:
         """注册新用户
         
         Args:
@@ -155,25 +161,18 @@ class AuthService:
         Returns:
             用户ID，如果用户名已存在则返回 None
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        password_hash = self.get_password_hash(password)
         try:
-            password_hash = self.get_password_hash(password)
-            cursor.execute(
+            return await self.db.execute(
                 "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
-                (username, email, password_hash)
+                (username, email, password_hash),
+                op="register",
             )
-            conn.commit()
-            user_id = cursor.lastrowid
-            return user_id
         except sqlite3.IntegrityError:
             # 用户名已存在
             return None
-        finally:
-            conn.close()
     
-    def authenticate_user(self, username: str, password: str) -> Optional[User]:
+    async def authenticate_user(self, username: str, password: str) -> Optional[User]:
         """验证用户登录
         
         Args:
@@ -183,45 +182,40 @@ class AuthService:
         Returns:
             User 对象，如果验证失败则返回 None
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        return await self.db.run(self._authenticate, username, password, op="login")
+    
+    def _authenticate(self, conn: sqlite3.Connection, username: str, password: str) -> Optional[User]:
+        """查询用户、验证密码并更新最后登录时间（在连接池线程中执行）"""
+        row = conn.execute(
             "SELECT * FROM users WHERE username = ?",
             (username,)
-        )
-        row = cursor.fetchone()
+        ).fetchone()
         
         if not row:
-            conn.close()
             return None
         
         # 验证密码
         if not self.verify_password(password, row["password_hash"]):
-            conn.close()
             return None
         
         # 更新最后登录时间
-        cursor.execute(
-            "UPDATE users SET last_login = ? WHERE id = ?",
-            (datetime.utcnow(), row["id"])
-        )
-        conn.commit()
+        last_login = datetime.utcnow()
+        with conn:
+            conn.execute(
+                "UPDATE users SET last_login = ? WHERE id = ?",
+                (last_login, row["id"])
+            )
         
         # 构建 User 对象
-        user = User(
+        return User(
             id=row["id"],
             username=row["username"],
             email=row["email"],
             created_at=datetime.fromisoformat(row["created_at"]),
-            last_login=datetime.utcnow(),
+            last_login=last_login,
         )
-        
-        conn.close()
-        return user
     
-    def get_user_by_id(self, user_id: int) -> Optional[User]:
+    async def get_user_by_id(self, user_id: int) -> Optional[User]:
         """通过 ID 获取用户
         
         Args:
@@ -230,15 +224,7 @@ class AuthService:
         Returns:
             User 对象，如果不存在则返回 None
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        
-        conn.close()
-        
+        row = await self.db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,), op="get_user")
         if not row:
             return None
         
@@ -249,4 +235,11 @@ class AuthService:
             created_at=datetime.fromisoformat(row["created_at"]),
             last_login=datetime.fromisoformat(row["last_login"]) if row["last_login"] else None,
         )
-
+    
+    def get_stats(self) -> dict:
+        """数据库连接池统计"""
+        return self.db.get_stats()
+    
+    def close(self):
+        """关闭数据库连接池（等待进行中的查询完成）"""
+        self.db.close()
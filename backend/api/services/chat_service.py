@@ -5,79 +5,343 @@
 
 from __future__ import annotations
 
-import json
-import asyncio
-from typing import AsyncGenerator
+import time
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Optional
 
-from agentscope.message import Msg
+from sse_starlette.sse import AppStatus
 
+from backend.api.services.admission import AdmissionController, Permit
+from backend.api.services.fair_scheduler import FairScheduler, Ticket
+from backend.api.services.idempotency import IdempotencyTable
 from backend.api.services.orchestrator_adapter import OrchestratorAdapter
+from backend.api.services.stream_coalescer import StreamCoalescer
+from backend.api.services.stream_registry import Draining, GenerationStream, StreamRegistry
+from backend.src.deadline import get_stage_stats
+from backend.src.metrics import GENERATED_TOKENS, TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND
+from backend.src.profiler import Profiler, ProfileSlot
+from backend.src.rate_governor import rate_governor
+from backend.src.streaming import FINAL, TEXT_DELTA, TOOL_CALL_END, TOOL_CALL_START, estimate_tokens
+from backend.src.timings import RequestTimings, current_timings, timings_scope
 
 
 class ChatService:
     """聊天服务"""
     
-    def __init__(self, global_config, global_mcp_manager, global_rag_manager):
+    def __init__(
+        self,
+        global_config,
+        global_mcp_manager,
+        global_rag_manager,
+        sse_config: dict | None = None,
+        websocket_config: dict | None = None,
+        idempotency_config: dict | None = None,
+        scheduler_config: dict | None = None,
+        admission_config: dict | None = None,
+        deadline_config: dict | None = None,
+        shutdown_config: dict | None = None,
+        profiler: Profiler | None = None,
+    ):
         """初始化聊天服务
         
         Args:
             global_config: 全局配置
             global_mcp_manager: 全局 MCP 管理器
             global_rag_manager: 全局 RAG 管理器
+            sse_config: api.yaml 中的 sse 配置块
+            websocket_config: api.yaml 中的 websocket 配置块
+            idempotency_config: api.yaml 中的 idempotency 配置块
+            scheduler_config: api.yaml 中的 scheduler 配置块
+            admission_config: api.yaml 中的 admission 配置块
+            deadline_config: api.yaml 中的 deadlines 配置块
+            shutdown_config: api.yaml 中的 shutdown 配置块
+            profiler: 采样分析器（用于单次请求采样，None 表示不支持）
         """
+        self.sse_config = sse_config or {}
+        self.websocket_config = websocket_config or {}
         self.orchestrator_adapter = OrchestratorAdapter(
             global_config=global_config,
             global_mcp_manager=global_mcp_manager,
             global_rag_manager=global_rag_manager,
+            stream_buffer=self.sse_config.get("buffer"),
+            scheduler=FairScheduler.from_config(scheduler_config),
+            deadlines=deadline_config,
         )
+        
+        # 心跳间隔 / 单次写入超时（慢客户端长时间不读取时断开，由断线取消机制接管）
+        self.ping_interval = self.sse_config.get("ping_interval", 15)
+        self.send_timeout = self.sse_config.get("send_timeout")
+        self.coalescer = StreamCoalescer.from_config(self.sse_config)
+        self.streams = StreamRegistry.from_config(self.sse_config)
+        self.idempotency = IdempotencyTable.from_config(idempotency_config)
+        self.streams.on_evict = self.idempotency.release
+        self.admission = AdmissionController.from_config(admission_config)
+        self.profiler = profiler
+        
+        # 关闭时的排空宽限期（进行中的生成在此期间正常完成，SSE 连接保持到生成结束）
+        shutdown_config = shutdown_config or {}
+        self.shutdown_grace = float(shutdown_config.get("grace_period", 30))
+        self.draining_retry_after = int(shutdown_config.get("retry_after", 5))
     
-    async def stream_chat(
+    @property
+    def draining(self) -> bool:
+        """服务是否正在关闭（收到退出信号后即为 True，早于 lifespan 的关闭阶段）"""
+        return self.streams.draining or AppStatus.should_exit
+    
+    def start_stream(
         self,
         user_id: str,
         username: str,
         session_id: str,
         message: str,
-    ) -> AsyncGenerator[str, None]:
-        """流式聊天生成器（SSE 格式）
+        idempotency_key: Optional[str] = None,
+        profile: bool = False,
+    ) -> tuple[GenerationStream, bool]:
+        """在后台启动一次生成（与 HTTP 连接解耦，断线后可通过 stream_id 恢复）
+        
+        带 idempotency_key 的重复请求不会再次生成，而是复用已有的生成流。
+        新的生成先经过准入控制（服务过载时拒绝），
+        启用公平调度时再进入用户的队列，队列已满时拒绝。
+        每个进程同时只采样一次生成，已有采样时拒绝。
         
         Args:
             user_id: 用户ID
             username: 用户名
             session_id: 会话ID
             message: 用户消息
-            
-        Yields:
-            JSON 字符串（EventSourceResponse 会自动添加 data: 前缀和换行）
+            idempotency_key: 幂等键（可选）
+            profile: 是否对本次生成做单次请求采样（结果摘要在 done 事件的 profile 字段中）
+        
+        Returns:
+            (GenerationStream 实例, 是否复用了已有的生成)
+        
+        Raises:
+            IdempotencyConflict: 幂等键已用于不同的请求
+            Overloaded: 进行中的生成数已达准入控制的并发上限
+            QueueFull: 用户的排队请求数已达上限
+            Draining: 服务正在关闭
+            ProfilerBusy: 请求采样但已有采样正在进行
         """
-        # 发送开始事件
-        yield json.dumps({'type': 'start', 'session_id': session_id}, ensure_ascii=False)
+        if idempotency_key:
+            fingerprint = self.idempotency.fingerprint(session_id, message)
+            stream = self.idempotency.lookup(str(user_id), idempotency_key, fingerprint)
+            if stream is not None:
+                return stream, True
+        
+        if self.draining:
+            raise Draining(self.draining_retry_after)
         
+        profile_slot = self.profiler.reserve() if profile and self.profiler is not None else None
+        permit = None
+        ticket = None
+        scheduler = self.orchestrator_adapter.scheduler
         try:
-            # 调用流式处理方法（真正的流式输出）
-            async for is_final, delta_content, full_content in self.orchestrator_adapter.handle_message_stream(
-                user_id=str(user_id),
+            permit = self.admission.admit() if self.admission is not None else None
+            if scheduler is not None:
+                ticket = scheduler.submit(str(user_id), username)
+        except Exception:
+            if permit is not None:
+                permit.release()
+            if profile_slot is not None:
+                profile_slot.release()
+            raise
+        
+        # HTTP 请求的耗时记录从中间件开始（包括认证），WebSocket 消息从这里开始
+        timings = current_timings() or RequestTimings()
+        stream = self.streams.start(
+            user_id=str(user_id),
+            session_id=session_id,
+            producer_factory=lambda stream_id: self.stream_chat(
+                user_id=user_id,
                 username=username,
                 session_id=session_id,
                 message=message,
-            ):
-                # 发送增量内容（delta）
-                if delta_content:  # 只发送非空的增量
-                    yield json.dumps({
-                        'type': 'token',
-                        'content': delta_content,
-                        'is_final': is_final
-                    }, ensure_ascii=False)
+                stream_id=stream_id,
+                ticket=ticket,
+                permit=permit,
+                timings=timings,
+                profile_slot=profile_slot,
+            ),
+        )
+        # 生成在开始前就被取消时，生成器不会运行，由任务结束回调归还
+        if ticket is not None:
+            stream.task.add_done_callback(lambda _: ticket.release())
+        if permit is not None:
+            stream.task.add_done_callback(lambda _: permit.release())
+        if profile_slot is not None:
+            stream.task.add_done_callback(lambda _: profile_slot.release())
+        if idempotency_key:
+            self.idempotency.remember(str(user_id), idempotency_key, fingerprint, stream)
+        return stream, False
+    
+    def get_stream(self, stream_id: str, user_id: str) -> Optional[GenerationStream]:
+        """获取用户的进行中 / 最近完成的生成流"""
+        return self.streams.get(stream_id, str(user_id))
+    
+    def cancel_stream(self, stream_id: str, user_id: str) -> bool:
+        """取消用户的进行中的生成（已生成的部分内容会保存到会话历史）"""
+        return self.streams.cancel(stream_id, str(user_id), reason="client")
+    
+    async def stream_chat(
+        self,
+        user_id: str,
+        username: str,
+        session_id: str,
+        message: str,
+        stream_id: Optional[str] = None,
+        ticket: Optional[Ticket] = None,
+        permit: Optional[Permit] = None,
+        timings: Optional[RequestTimings] = None,
+        profile_slot: Optional[ProfileSlot] = None,
+    ) -> AsyncGenerator[dict, None]:
+        """流式聊天生成器
+        
+        ``done`` 事件的 ``timings`` 字段包含本次请求各阶段的耗时（毫秒）：
+        auth、queue、user_resources、create_agents、restore_session、router、
+        agent、persist，检索 / 工具阶段（memory、rag、tool）的累计耗时，
+        以及从接收请求开始计算的 first_token、last_token 和 total。
+        
+        Args:
+            user_id: 用户ID
+            username: 用户名
+            session_id: 会话ID
+            message: 用户消息
+            stream_id: 生成流ID（用于断线重连）
+            ticket: 公平调度凭证
+            permit: 准入控制凭证（记录首个输出的延迟）
+            timings: 请求的阶段耗时记录（None 表示从这里开始记录）
+            profile_slot: 已占用的采样（不为 None 时采样本次生成，包括 Agent 任务和工具调用）
+        
+        Yields:
+            事件字典（由 StreamRegistry 统一编码为 SSE 帧）
+        """
+        if timings is None:
+            timings = RequestTimings()
+        first_token_at = None
+        last_token_at = None
+        profile_session = self.profiler.start_task_profile(profile_slot) if profile_slot is not None else None
+        
+        with timings_scope(timings):
+            # 发送开始事件
+            yield {'type': 'start', 'session_id': session_id, 'stream_id': stream_id}
+            
+            try:
+                # 调用流式处理方法（模型层直接产出增量事件，经合并器批量发送）
+                events = self.orchestrator_adapter.handle_message_stream(
+                    user_id=str(user_id),
+                    username=username,
+                    session_id=session_id,
+                    message=message,
+                    ticket=ticket,
+                )
+                async with aclosing(self.coalescer.coalesce(events)) as coalesced:
+                    async for event in coalesced:
+                        if permit is not None:
+                            # 延迟从排队结束开始计算，只反映上游模型的响应速度
+                            permit.sample(
+                                since=ticket.granted_at if ticket is not None else None,
+                                failed=event.type == FINAL and bool(event.error),
+                            )
+                        if event.type == TEXT_DELTA:
+                            if first_token_at is None:
+                                TIME_TO_FIRST_TOKEN.observe(timings.mark("first_token"))
+                                first_token_at = time.perf_counter()
+                            last_token_at = time.perf_counter()
+                            # 发送增量内容（delta）
+                            yield {
+                                'type': 'token',
+                                'content': event.text,
+                                'is_final': False
+                            }
+                        elif event.type == TOOL_CALL_START:
+                            yield {
+                                'type': 'tool_start',
+                                'tool_name': event.tool_name,
+                                'tool_id': event.tool_id,
+                            }
+                        elif event.type == TOOL_CALL_END:
+                            yield {
+                                'type': 'tool_end',
+                                'tool_name': event.tool_name,
+                                'tool_id': event.tool_id,
+                            }
+                        elif event.type == FINAL:
+                            if last_token_at is not None:
+                                timings.add("last_token", last_token_at - timings.started)
+                            tokens = estimate_tokens(event.text)
+                            GENERATED_TOKENS.inc(tokens)
+                            if first_token_at is not None and not event.error:
+                                elapsed = time.perf_counter() - first_token_at
+                                if elapsed > 0:
+                                    TOKENS_PER_SECOND.observe(tokens / elapsed)
+                            if event.metadata.get('dropped_chars'):
+                                # drop 策略丢弃过文本增量：用完整回复重新同步客户端
+                                yield {'type': 'resync', 'content': event.text}
+                
+                # 发送完成事件
+                done = {'type': 'done', 'message_id': session_id, 'timings': timings.as_dict()}
+                if profile_session is not None:
+                    done['profile'] = (await profile_session.stop()).summary()
+                yield done
             
-            # 发送完成事件
-            yield json.dumps({'type': 'done', 'message_id': session_id}, ensure_ascii=False)
+            except Exception as e:
+                if permit is not None:
+                    permit.sample(failed=True)
+                # 发送错误事件
+                import traceback
+                error_detail = f"{str(e)}\n{traceback.format_exc()}"
+                yield {'type': 'error', 'error': error_detail}
             
-        except Exception as e:
-            # 发送错误事件
-            import traceback
-            error_detail = f"{str(e)}\n{traceback.format_exc()}"
-            yield json.dumps({'type': 'error', 'error': error_detail}, ensure_ascii=False)
+            finally:
+                if profile_session is not None:
+                    await profile_session.stop()
+    
+    def get_stats(self, user_id: Optional[str] = None) -> dict:
+        """生成流统计（启动 / 完成 / 取消数量、节省的 token 估算、缓冲区高水位、准入控制、公平调度、阶段超时、模型限流）
+        
+        Args:
+            user_id: 只列出该用户进行中的生成（None 表示全部）
+        """
+        stats = self.streams.get_stats(user_id=None if user_id is None else str(user_id))
+        stats["idempotency"] = self.idempotency.get_stats()
+        scheduler = self.orchestrator_adapter.scheduler
+        if scheduler is not None:
+            stats["scheduler"] = scheduler.get_stats(user_id=user_id)
+        if self.admission is not None:
+            stats["admission"] = self.admission.get_stats()
+        stats["deadlines"] = get_stage_stats()
+        stats["llm"] = rate_governor.get_stats()
+        return stats
+    
+    def memory_sources(self) -> dict[str, list[tuple[str, Any]]]:
+        """按用户常驻内存的缓存（{缓存名: [(用户ID, 条目), ...]}，见 backend/src/memory_accounting.py）"""
+        adapter = self.orchestrator_adapter
+        sources = {
+            "user_mem0": list(adapter.user_mem0_cache.items()),
+            "user_rag": list(adapter.user_rag_cache.items()),
+            "streams": [(stream.user_id, stream) for stream in list(self.streams.streams.values())],
+            "idempotency": self.idempotency.entries(),
+        }
+        if adapter.global_rag is not None:
+            sources["rag_user_knowledge"] = [
+                (kb.user_id, kb) for kb in list(adapter.global_rag.user_knowledges.values())
+            ]
+            # 全局知识库作为单独的条目，避免计入第一个引用它的用户
+            sources["rag_global_knowledge"] = [("", kb) for kb in adapter.global_rag.global_knowledges.values()]
+        return sources
+    
+    async def drain(self, grace: Optional[float] = None) -> dict:
+        """排空：拒绝新的生成，等待进行中的生成完成并保存（超过宽限期的被取消）
+        
+        Args:
+            grace: 宽限期（秒），None 表示使用 shutdown.grace_period
+        
+        Returns:
+            {"drained": 完成的生成数, "aborted": 被取消的生成数, "seconds": 耗时}
+        """
+        return await self.streams.drain(self.shutdown_grace if grace is None else grace)
     
     async def cleanup_all(self):
         """清理所有资源"""
+        await self.streams.cancel_all()
         await self.orchestrator_adapter.cleanup_all()
-
@@ -0,0 +1,296 @@
+"""WebSocket 聊天连接
+
+一个连接只认证一次，可同时承载多个会话的生成（多路复用）。
+每个帧都是一个 JSON 对象，生成相关的帧带客户端指定的 request_id：
+
+客户端 -> 服务端：
+    {"type": "auth", "token": "..."}   首条消息（也可以使用 Authorization 请求头）
+    {"type": "chat", "request_id": "r1", "session_id": "xxx", "message": "...",
+     "idempotency_key": "可选"}
+    {"type": "resume", "request_id": "r1", "stream_id": "xxx", "last_event_id": 12}
+    {"type": "credit", "request_id": "r1", "credit": 32}   流量控制：允许再发送的事件数
+    {"type": "cancel", "request_id": "r1"}
+    {"type": "ping"}
+
+服务端 -> 客户端：
+    {"type": "ready", "user_id": 1, "username": "xxx", "initial_credit": 64}
+    {"request_id": "r1", "session_id": "xxx", "stream_id": "xxx", "id": 3, "event": {...}}
+    {"type": "error", "request_id": "r1", "error": "错误信息"}
+    {"type": "error", "request_id": "r1", "error": "...", "retry_after": 30}   排队的请求过多或服务过载
+    {"type": "pong"}
+
+event 与 SSE 接口的事件格式完全相同。生成仍由 StreamRegistry 在后台运行，
+WebSocket 只是另一种订阅方式：客户端的信用额度用完后停止读取帧，
+与 SSE 慢客户端的背压行为一致；连接断开后也可以改用 SSE 恢复。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from contextlib import aclosing
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from backend.api.middleware.auth import authenticate_token
+from backend.api.services.admission import Overloaded
+from backend.api.models import User
+from backend.api.services.auth_service import AuthService
+from backend.api.services.chat_service import ChatService
+from backend.api.services.fair_scheduler import QueueFull
+from backend.api.services.idempotency import IdempotencyConflict
+from backend.api.services.stream_registry import Draining, GenerationStream
+
+
+# 认证失败时使用的关闭码（1008: Policy Violation）
+WS_POLICY_VIOLATION = 1008
+
+
+class _Credit:
+    """单个请求的发送额度（initial <= 0 表示不做流量控制）"""
+    
+    def __init__(self, initial: int):
+        self.unlimited = initial <= 0
+        self.value = initial
+        self._available = asyncio.Event()
+        if self.value > 0:
+            self._available.set()
+    
+    def add(self, amount: int) -> None:
+        if self.unlimited or amount <= 0:
+            return
+        self.value += amount
+        self._available.set()
+    
+    def release(self) -> None:
+        """取消流量控制（请求被取消后，让剩余的帧直接发送完）"""
+        self.unlimited = True
+        self._available.set()
+    
+    async def take(self) -> None:
+        if self.unlimited:
+            return
+        await self._available.wait()
+        self.value -= 1
+        if self.value <= 0:
+            self._available.clear()
+
+
+async def authenticate_websocket(
+    websocket: WebSocket,
+    auth_service: AuthService,
+    timeout: float = 10,
+) -> Optional[User]:
+    """认证 WebSocket 连接（连接已 accept）
+    
+    优先使用 Authorization 请求头，否则等待首条 {"type": "auth"} 消息。
+    
+    Returns:
+        认证通过的用户，失败时返回 None（连接已关闭）
+    """
+    token = None
+    header = websocket.headers.get("authorization", "")
+    if header.lower().startswith("bearer "):
+        token = header[7:].strip()
+    
+    try:
+        if token is None:
+            message = await asyncio.wait_for(websocket.receive_json(), timeout=timeout)
+            if isinstance(message, dict) and message.get("type") == "auth":
+                token = message.get("token")
+        if not token:
+            raise HTTPException(status_code=401, detail="Missing authentication token")
+        return await authenticate_token(token, auth_service)
+    except WebSocketDisconnect:
+        return None
+    except (asyncio.TimeoutError, HTTPException, ValueError) as e:
+        reason = e.detail if isinstance(e, HTTPException) else "Authentication required"
+        await websocket.close(code=WS_POLICY_VIOLATION, reason=reason)
+        return None
+
+
+class ChatSocket:
+    """一个已认证的 WebSocket 连接"""
+    
+    def __init__(
+        self,
+        websocket: WebSocket,
+        chat_service: ChatService,
+        user: User,
+        initial_credit: int = 64,
+        max_streams: int = 8,
+    ):
+        """初始化连接
+        
+        Args:
+            websocket: 已认证的 WebSocket
+            chat_service: 聊天服务实例
+            user: 当前用户
+            initial_credit: 每个请求的初始发送额度（<= 0 表示不做流量控制）
+            max_streams: 单个连接同时进行的请求数上限
+        """
+        self.websocket = websocket
+        self.chat_service = chat_service
+        self.user = user
+        self.initial_credit = int(initial_credit)
+        self.max_streams = max(1, int(max_streams))
+        
+        self._requests: dict[str, tuple[GenerationStream, _Credit, asyncio.Task]] = {}
+        self._send_lock = asyncio.Lock()
+    
+    @classmethod
+    def from_config(cls, websocket: WebSocket, chat_service: ChatService, user: User) -> "ChatSocket":
+        """使用 api.yaml 的 websocket 配置块创建"""
+        ws_cfg = chat_service.websocket_config
+        return cls(
+            websocket,
+            chat_service,
+            user,
+            initial_credit=ws_cfg.get("initial_credit", 64),
+            max_streams=ws_cfg.get("max_streams", 8),
+        )
+    
+    async def run(self) -> None:
+        """处理客户端消息，直到连接关闭"""
+        await self._send_json({
+            "type": "ready",
+            "user_id": self.user.id,
+            "username": self.user.username,
+            "initial_credit": self.initial_credit,
+        })
+        try:
+            while True:
+                try:
+                    message = await self.websocket.receive_json()
+                except json.JSONDecodeError:
+                    await self._send_error(None, "消息必须是 JSON 对象")
+                    continue
+                if not isinstance(message, dict):
+                    await self._send_error(None, "消息必须是 JSON 对象")
+                    continue
+                await self._dispatch(message)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # 只停止订阅，生成本身交给断线取消机制（宽限期内可以通过 SSE 恢复）
+            tasks = [task for _, _, task in self._requests.values()]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _dispatch(self, message: dict) -> None:
+        msg_type = message.get("type")
+        request_id = message.get("request_id")
+        
+        if msg_type == "ping":
+            await self._send_json({"type": "pong"})
+            return
+        if msg_type not in ("chat", "resume", "credit", "cancel"):
+            await self._send_error(request_id, f"未知的消息类型: {msg_type}")
+            return
+        if not isinstance(request_id, str) or not request_id:
+            await self._send_error(None, "缺少 request_id")
+            return
+        
+        if msg_type == "credit":
+            entry = self._requests.get(request_id)
+            amount = message.get("credit")
+            if not isinstance(amount, int):
+                await self._send_error(request_id, "credit 必须是整数")
+            elif entry is not None:
+                entry[1].add(amount)
+            return
+        
+        if msg_type == "cancel":
+            entry = self._requests.get(request_id)
+            if entry is None:
+                await self._send_error(request_id, "请求不存在或已结束")
+                return
+            # 生成会以 cancelled 事件结束，转发任务随之退出
+            self.chat_service.cancel_stream(entry[0].stream_id, str(self.user.id))
+            entry[1].release()
+            return
+        
+        if request_id in self._requests:
+            await self._send_error(request_id, "request_id 正在使用中")
+            return
+        if len(self._requests) >= self.max_streams:
+            await self._send_error(request_id, f"同时进行的请求数已达上限（{self.max_streams}）")
+            return
+        
+        last_event_id = None
+        if msg_type == "chat":
+            session_id = message.get("session_id")
+            text = message.get("message")
+            if not session_id or not text:
+                await self._send_error(request_id, "chat 消息需要 session_id 和 message")
+                return
+            try:
+                stream, _ = self.chat_service.start_stream(
+                    user_id=str(self.user.id),
+                    username=self.user.username,
+                    session_id=session_id,
+                    message=text,
+                    idempotency_key=message.get("idempotency_key"),
+                )
+            except IdempotencyConflict as e:
+                await self._send_error(request_id, str(e))
+                return
+            except (QueueFull, Overloaded, Draining) as e:
+                await self._send_json({
+                    "type": "error",
+                    "request_id": request_id,
+                    "error": str(e),
+                    "retry_after": e.retry_after,
+                })
+                return
+        else:
+            stream = self.chat_service.get_stream(message.get("stream_id") or "", str(self.user.id))
+            if stream is None:
+                await self._send_error(request_id, "流不存在或已过期")
+                return
+            last_event_id = message.get("last_event_id")
+            if not isinstance(last_event_id, int):
+                last_event_id = None
+        
+        credit = _Credit(self.initial_credit)
+        task = asyncio.create_task(self._forward(request_id, stream, credit, last_event_id))
+        self._requests[request_id] = (stream, credit, task)
+    
+    async def _forward(
+        self,
+        request_id: str,
+        stream: GenerationStream,
+        credit: _Credit,
+        last_event_id: Optional[int],
+    ) -> None:
+        """把生成流的帧转发到 WebSocket（帧数据已经 JSON 编码，这里只拼接外层）"""
+        prefix = '{"request_id":%s,"session_id":%s,"stream_id":%s,"id":' % (
+            json.dumps(request_id),
+            json.dumps(stream.session_id),
+            json.dumps(stream.stream_id),
+        )
+        try:
+            async with aclosing(stream.subscribe(last_event_id)) as frames:
+                async for frame in frames:
+                    await credit.take()
+                    await self._send_text(f'{prefix}{frame["id"]},"event":{frame["data"]}}}')
+        except (WebSocketDisconnect, RuntimeError):
+            # 连接已关闭
+            pass
+        finally:
+            self._requests.pop(request_id, None)
+    
+    async def _send_error(self, request_id: Optional[str], error: str) -> None:
+        await self._send_json({"type": "error", "request_id": request_id, "error": error})
+    
+    async def _send_json(self, payload: dict) -> None:
+        await self._send_text(json.dumps(payload, ensure_ascii=False))
+    
+    async def _send_text(self, text: str) -> None:
+        # 多个请求并发发送，逐帧加锁避免帧交错
+        async with self._send_lock:
+            await self.websocket.send_text(text)
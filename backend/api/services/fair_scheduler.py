@@ -0,0 +1,258 @@
+"""按用户的加权公平调度
+
+所有经过 OrchestratorAdapter 的生成先在这里排队，再占用全局的生成槽位：
+
+- 每个用户一个队列，用户之间按赤字轮转（Deficit Round Robin）分配槽位，
+  权重由用户所属的等级（tier）决定
+- 每个用户同时进行的生成数有上限，超出的请求排在该用户自己的队列中，
+  不会占用其他用户的份额
+- 用户排队的请求数达到上限时拒绝新请求（路由返回 429 和 Retry-After）
+
+这样单个用户连续发送消息或运行脚本时，只会拉长自己的排队时间。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional
+
+
+class QueueFull(Exception):
+    """用户的排队请求数已达上限"""
+    
+    def __init__(self, tier: str, retry_after: int):
+        super().__init__(f"请求过多，请 {retry_after} 秒后重试")
+        self.tier = tier
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次生成的调度凭证"""
+    
+    def __init__(self, scheduler: "FairScheduler", user: "_UserQueue"):
+        self.scheduler = scheduler
+        self.user = user
+        self.submitted_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self._granted = asyncio.get_running_loop().create_future()
+    
+    async def wait(self) -> float:
+        """等待调度器分配槽位
+        
+        Returns:
+            排队等待的秒数
+        """
+        await asyncio.shield(self._granted)
+        return self.granted_at - self.submitted_at
+    
+    def release(self) -> None:
+        """归还槽位（未分配时从队列中移除），可以重复调用"""
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+
+class _UserQueue:
+    """单个用户的队列状态"""
+    
+    def __init__(self, user_id: str, tier: str, weight: float, max_in_flight: int, max_queued: int):
+        self.user_id = user_id
+        self.tier = tier
+        self.weight = weight
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue: deque[Ticket] = deque()
+        self.in_flight = 0
+        self.deficit = 0.0
+    
+    @property
+    def eligible(self) -> bool:
+        return bool(self.queue) and self.in_flight < self.max_in_flight
+
+
+class FairScheduler:
+    """加权公平调度器"""
+    
+    DEFAULT_TIER = {"weight": 1.0, "max_in_flight": 2, "max_queued": 4}
+    
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        tiers: dict | None = None,
+        users: dict | None = None,
+    ):
+        """初始化调度器
+        
+        Args:
+            max_concurrency: 全局同时进行的生成数上限
+            tiers: 等级配置 {tier: {weight, max_in_flight, max_queued}}，必须包含 default
+            users: 用户名到等级的映射（未列出的用户使用 default）
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.tiers = {"default": dict(self.DEFAULT_TIER)}
+        for name, tier_cfg in (tiers or {}).items():
+            self.tiers[name] = {**self.DEFAULT_TIER, **(tier_cfg or {})}
+        self.user_tiers = {str(k): v for k, v in (users or {}).items()}
+        
+        self._users: dict[str, _UserQueue] = {}
+        self._active: deque[_UserQueue] = deque()  # 有排队请求的用户（轮转顺序）
+        self._running = 0
+        self._avg_service_time = 30.0  # 单次生成耗时的滑动平均（秒），用于估算 Retry-After
+        
+        self.stats = {"submitted": 0, "rejected": 0, "granted": 0}
+        self._wait_stats = {"count": 0, "total": 0.0, "max": 0.0}
+    
+    @classmethod
+    def from_config(cls, cfg: dict | None) -> Optional["FairScheduler"]:
+        """从 api.yaml 的 scheduler 配置块创建（未启用时返回 None）"""
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        return cls(
+            max_concurrency=cfg.get("max_concurrency", 16),
+            tiers=cfg.get("tiers"),
+            users=cfg.get("users"),
+        )
+    
+    def tier_of(self, username: Optional[str]) -> str:
+        """用户所属的等级"""
+        tier = self.user_tiers.get(str(username)) if username is not None else None
+        return tier if tier in self.tiers else "default"
+    
+    def submit(self, user_id: str, username: Optional[str] = None, enforce_limit: bool = True) -> Ticket:
+        """提交一次生成，返回排队凭证
+        
+        Args:
+            user_id: 用户ID（公平调度的单位）
+            username: 用户名（用于查找等级）
+            enforce_limit: 是否检查排队上限（批量任务已有自己的 worker 池，不检查）
+        
+        Returns:
+            Ticket 实例，调用方需要 wait() 后再开始生成，结束时 release()
+        
+        Raises:
+            QueueFull: 用户的排队请求数已达上限
+        """
+        user = self._get_user(str(user_id), self.tier_of(username))
+        ticket = Ticket(self, user)
+        if not user.queue:
+            self._active.append(user)
+        user.queue.append(ticket)
+        self._dispatch()
+        
+        if enforce_limit and ticket.granted_at is None and len(user.queue) > user.max_queued:
+            ticket.release()
+            self.stats["rejected"] += 1
+            raise QueueFull(user.tier, self._retry_after(user))
+        self.stats["submitted"] += 1
+        return ticket
+    
+    def _get_user(self, user_id: str, tier: str) -> _UserQueue:
+        user = self._users.get(user_id)
+        tier_cfg = self.tiers[tier]
+        if user is None:
+            user = _UserQueue(
+                user_id,
+                tier,
+                weight=max(0.1, float(tier_cfg["weight"])),
+                max_in_flight=max(1, int(tier_cfg["max_in_flight"])),
+                max_queued=max(0, int(tier_cfg["max_queued"])),
+            )
+            self._users[user_id] = user
+        return user
+    
+    def _retry_after(self, user: _UserQueue) -> int:
+        # 该用户排在前面的请求需要的轮数 × 平均生成耗时
+        rounds = (len(user.queue) + user.in_flight) / user.max_in_flight
+        return max(1, math.ceil(rounds * self._avg_service_time))
+    
+    def _dispatch(self) -> None:
+        """把空闲槽位按赤字轮转分配给各用户队列的队首请求"""
+        while self._running < self.max_concurrency:
+            if not any(user.eligible for user in self._active):
+                return
+            user = self._active[0]
+            if not user.eligible:
+                self._active.rotate(-1)
+                continue
+            if user.deficit < 1:
+                user.deficit += user.weight
+                if user.deficit < 1:
+                    self._active.rotate(-1)
+                    continue
+            
+            self._grant(user.queue.popleft())
+            user.deficit -= 1
+            if not user.queue:
+                # 队列清空的用户不保留赤字（不能攒份额）
+                self._active.popleft()
+                user.deficit = 0.0
+            elif user.deficit < 1 or not user.eligible:
+                self._active.rotate(-1)
+    
+    def _grant(self, ticket: Ticket) -> None:
+        user = ticket.user
+        user.in_flight += 1
+        self._running += 1
+        ticket.granted_at = time.monotonic()
+        ticket._granted.set_result(None)
+        
+        waited = ticket.granted_at - ticket.submitted_at
+        self.stats["granted"] += 1
+        self._wait_stats["count"] += 1
+        self._wait_stats["total"] += waited
+        self._wait_stats["max"] = max(self._wait_stats["max"], waited)
+    
+    def _release(self, ticket: Ticket) -> None:
+        user = ticket.user
+        if ticket.granted_at is None:
+            # 还在排队（生成在开始前被取消）
+            try:
+                user.queue.remove(ticket)
+            except ValueError:
+                pass
+            else:
+                if not user.queue:
+                    self._active.remove(user)
+                    user.deficit = 0.0
+            ticket._granted.cancel()
+        else:
+            user.in_flight -= 1
+            self._running -= 1
+            duration = time.monotonic() - ticket.granted_at
+            self._avg_service_time += 0.1 * (duration - self._avg_service_time)
+        
+        if not user.queue and user.in_flight == 0:
+            self._users.pop(user.user_id, None)
+        self._dispatch()
+    
+    def get_stats(self, user_id: Optional[str] = None) -> dict:
+        """调度统计
+        
+        Args:
+            user_id: 同时返回该用户的排队情况
+        """
+        count = self._wait_stats["count"]
+        stats = {
+            **self.stats,
+            "running": self._running,
+            "max_concurrency": self.max_concurrency,
+            "queued": sum(len(user.queue) for user in self._active),
+            "queued_users": len(self._active),
+            "queue_wait_seconds": {
+                "count": count,
+                "avg": round(self._wait_stats["total"] / count, 4) if count else 0.0,
+                "max": round(self._wait_stats["max"], 4),
+            },
+        }
+        if user_id is not None:
+            user = self._users.get(str(user_id))
+            stats["user"] = {
+                "in_flight": user.in_flight if user else 0,
+                "queued": len(user.queue) if user else 0,
+            }
+        return stats
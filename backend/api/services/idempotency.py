@@ -0,0 +1,134 @@
+"""聊天请求幂等表
+
+客户端双击或重试时可能重复提交同一条消息。带 Idempotency-Key 的请求
+在短时间内（ttl）映射到同一个生成流：
+
+- 生成仍在进行：新请求订阅已有的流（从头重放，然后继续跟随）
+- 生成已完成：重放已保存的帧（帧已被挤出时先发送 resync）；
+  生成流被注册表移除（``sse.resume.retention``）后只保留完整文本和结束帧，重放时先发送 resync
+- 生成失败或被取消：视为新请求，重新生成
+
+同一个 key 用于不同的会话 / 消息时拒绝请求。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from backend.api.services.stream_registry import GenerationStream
+
+
+class IdempotencyConflict(ValueError):
+    """同一个 Idempotency-Key 被用于不同的请求"""
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    stream: GenerationStream
+    expires_at: float
+
+
+class IdempotencyTable:
+    """(user_id, key) -> 生成流 的短期映射"""
+    
+    def __init__(self, ttl: float = 600, max_entries: int = 10000):
+        """初始化幂等表
+        
+        Args:
+            ttl: key 的有效期（秒）
+            max_entries: 最多保留的 key 数，超出时淘汰最早的
+        """
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._by_stream: dict[str, tuple[str, str]] = {}  # 仍引用完整生成流的记录：stream_id -> (user_id, key)
+        self.stats = {"hits": 0, "misses": 0, "conflicts": 0}
+    
+    @classmethod
+    def from_config(cls, cfg: dict | None) -> "IdempotencyTable":
+        """从 api.yaml 的 idempotency 配置块创建"""
+        cfg = cfg or {}
+        return cls(
+            ttl=float(cfg.get("ttl", 600)),
+            max_entries=int(cfg.get("max_entries", 10000)),
+        )
+    
+    @staticmethod
+    def fingerprint(session_id: str, message: str) -> str:
+        """请求指纹（同一个 key 必须对应相同的会话和消息）"""
+        return hashlib.sha256(f"{session_id}\0{message}".encode("utf-8")).hexdigest()
+    
+    def lookup(self, user_id: str, key: str, fingerprint: str) -> Optional[GenerationStream]:
+        """查找可以复用的生成流
+        
+        Returns:
+            可复用的生成流，没有时返回 None
+        
+        Raises:
+            IdempotencyConflict: key 已用于不同的请求
+        """
+        self._purge()
+        entry = self._entries.get((user_id, key))
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry.fingerprint != fingerprint:
+            self.stats["conflicts"] += 1
+            raise IdempotencyConflict("Idempotency-Key 已用于不同的请求")
+        
+        stream = entry.stream
+        if stream.failed or stream.cancel_reason:
+            # 失败或被取消的生成不重放，按新请求处理
+            self._drop((user_id, key))
+            self.stats["misses"] += 1
+            return None
+        
+        self.stats["hits"] += 1
+        return stream
+    
+    def remember(self, user_id: str, key: str, fingerprint: str, stream: GenerationStream) -> None:
+        """记录 key 对应的生成流"""
+        self._drop((user_id, key))
+        self._entries[(user_id, key)] = _Entry(fingerprint, stream, time.monotonic() + self.ttl)
+        self._by_stream[stream.stream_id] = (user_id, key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+    
+    def release(self, stream: GenerationStream) -> None:
+        """生成流被注册表移除：记录改为引用精简副本（失败或被取消的生成直接删除）"""
+        entry_key = self._by_stream.pop(stream.stream_id, None)
+        entry = self._entries.get(entry_key) if entry_key else None
+        if entry is None or entry.stream is not stream:
+            return
+        if stream.failed or stream.cancel_reason:
+            self._drop(entry_key)
+        else:
+            entry.stream = stream.compacted()
+    
+    def entries(self) -> list[tuple[str, _Entry]]:
+        """(用户ID, 记录) 列表（内存统计用）"""
+        return [(user_id, entry) for (user_id, _), entry in self._entries.items()]
+    
+    def get_stats(self) -> dict:
+        """统计信息"""
+        self._purge()
+        return {**self.stats, "entries": len(self._entries)}
+    
+    def _purge(self) -> None:
+        # 所有 key 的有效期相同，按插入顺序即按过期顺序
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._drop(key)
+    
+    def _drop(self, key: tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._by_stream.get(entry.stream.stream_id) == key:
+            del self._by_stream[entry.stream.stream_id]
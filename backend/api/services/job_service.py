@@ -0,0 +1,469 @@
+"""批量聊天任务服务
+
+用于离线 / 批量场景（例如批量生成营养计划）：客户端一次提交多条消息，
+拿到 job_id 后轮询或长轮询结果，不需要为每条消息保持一个 SSE 连接。
+
+- 服务内固定数量的 worker 处理所有任务，吞吐量由上游模型配额决定，
+  而不是由客户端连接数决定
+- 每个任务有并发上限，worker 在任务之间轮转，避免大任务占满 worker
+- 同一会话的消息按提交顺序串行处理（保证会话历史顺序）
+- 任务状态写入磁盘（data/jobs/{user_id}/{job_id}.json）：消息完成后延迟写入，
+  ``save_interval`` 内的多次变化合并为一次，写文件在线程中进行，不阻塞事件循环
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from contextlib import aclosing
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from sse_starlette.sse import AppStatus
+
+from backend.api.services.orchestrator_adapter import OrchestratorAdapter
+from backend.api.services.stream_registry import Draining
+from backend.src.rate_governor import Priority, priority_scope
+from backend.src.streaming import FINAL
+
+logger = logging.getLogger(__name__)
+
+
+class BatchJob:
+    """一个批量任务（内存中的状态）"""
+    
+    def __init__(self, job_id: str, user_id: str, username: str, items: list[dict], concurrency: int):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.username = username
+        self.concurrency = concurrency
+        self.status = "queued"
+        self.created_at = datetime.now()
+        self.updated_at = self.created_at
+        self.results = [
+            {
+                "index": i,
+                "session_id": item["session_id"],
+                "message": item["message"],
+                "status": "pending",
+                "content": None,
+                "error": None,
+                "started_at": None,
+                "finished_at": None,
+            }
+            for i, item in enumerate(items)
+        ]
+        self.pending: list[int] = list(range(len(items)))
+        self.running: dict[int, asyncio.Task] = {}
+        self._changed = asyncio.Event()
+        
+        # 持久化状态：有未写入的变化、延迟写入的任务、串行化写入的锁
+        self.dirty = True
+        self.save_task: Optional[asyncio.Task] = None
+        self.save_lock = asyncio.Lock()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled", "interrupted")
+    
+    def count(self, status: str) -> int:
+        return sum(1 for r in self.results if r["status"] == status)
+    
+    def touch(self) -> None:
+        """状态变化：更新时间并唤醒长轮询"""
+        self.updated_at = datetime.now()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+    
+    async def wait_changed(self, timeout: float) -> None:
+        """等待状态变化（长轮询）"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def to_dict(self, include_results: bool = True) -> dict:
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "total": len(self.results),
+            "completed": self.count("completed"),
+            "failed": self.count("failed"),
+            "concurrency": self.concurrency,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
+        if include_results:
+            data["results"] = self.results
+        return data
+    
+    def snapshot(self) -> dict:
+        """完整状态的副本（可以在线程中序列化，不受之后的修改影响）"""
+        data = self.to_dict(include_results=False)
+        data["results"] = [dict(result) for result in self.results]
+        return data
+
+
+class JobService:
+    """批量聊天任务服务"""
+    
+    def __init__(
+        self,
+        orchestrator_adapter: OrchestratorAdapter,
+        jobs_dir: str = "data/jobs",
+        workers: int = 4,
+        max_concurrency_per_job: int = 2,
+        max_items: int = 500,
+        retention: float = 600,
+        save_interval: float = 1.0,
+        retry_after: int = 5,
+    ):
+        """初始化任务服务
+        
+        Args:
+            orchestrator_adapter: 复用聊天服务的 Orchestrator 适配器
+            jobs_dir: 任务结果保存目录
+            workers: worker 数量（所有任务共享）
+            max_concurrency_per_job: 单个任务同时处理的消息数上限
+            max_items: 单个任务最多包含的消息数
+            retention: 任务结束后在内存中保留多久（秒），之后只从磁盘读取
+            save_interval: 任务状态的写入间隔（秒），期间的多次变化合并为一次写入
+            retry_after: 服务关闭期间拒绝提交时建议客户端等待的秒数
+        """
+        self.adapter = orchestrator_adapter
+        self.jobs_dir = Path(jobs_dir)
+        self.workers = max(1, int(workers))
+        self.max_concurrency_per_job = max(1, int(max_concurrency_per_job))
+        self.max_items = max(1, int(max_items))
+        self.retention = retention
+        self.save_interval = max(0.0, float(save_interval))
+        self.retry_after = int(retry_after)
+        
+        self.jobs: dict[str, BatchJob] = {}
+        self._order: list[str] = []  # 有待处理消息的任务（轮转顺序）
+        self._busy_sessions: set[tuple[str, str]] = set()
+        self._cond: Optional[asyncio.Condition] = None
+        self._worker_tasks: list[asyncio.Task] = []
+        self._draining = False
+    
+    @classmethod
+    def from_config(
+        cls,
+        orchestrator_adapter: OrchestratorAdapter,
+        jobs_cfg: dict | None,
+        base_dir: Path,
+        shutdown_cfg: dict | None = None,
+    ) -> "JobService":
+        """从 api.yaml 的 jobs 配置块创建（路径相对于 backend 目录，关闭期间的 Retry-After 取自 shutdown 配置块）"""
+        jobs_cfg = jobs_cfg or {}
+        return cls(
+            orchestrator_adapter,
+            jobs_dir=str(base_dir / jobs_cfg.get("path", "data/jobs")),
+            workers=jobs_cfg.get("workers", 4),
+            max_concurrency_per_job=jobs_cfg.get("max_concurrency_per_job", 2),
+            max_items=jobs_cfg.get("max_items", 500),
+            retention=float(jobs_cfg.get("retention", 600)),
+            save_interval=float(jobs_cfg.get("save_interval", 1.0)),
+            retry_after=int((shutdown_cfg or {}).get("retry_after", 5)),
+        )
+    
+    @property
+    def draining(self) -> bool:
+        """服务是否正在关闭（收到退出信号后即为 True，早于 lifespan 的关闭阶段）"""
+        return self._draining or AppStatus.should_exit
+    
+    async def start(self) -> None:
+        """启动 worker"""
+        self._cond = asyncio.Condition()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def drain(self, grace: float) -> dict:
+        """停止开始新的消息，等待正在处理的消息完成（最多 grace 秒）
+        
+        未开始的消息保持 pending，随后由 close 把任务标记为 interrupted。
+        
+        Returns:
+            {"drained": 完成的消息数, "aborted": 宽限期内未完成的消息数}
+        """
+        self._draining = True
+        tasks = [task for job in self.jobs.values() for task in job.running.values()]
+        pending = set()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=max(0.0, grace))
+        return {"drained": len(tasks) - len(pending), "aborted": len(pending)}
+    
+    async def close(self) -> None:
+        """停止 worker，未完成的任务标记为 interrupted"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in list(self.jobs.values()):
+            if not job.finished:
+                job.status = "interrupted"
+                job.touch()
+                job.dirty = True
+            # 立即写入，不等待延迟写入
+            await self._flush(job)
+            if job.save_task is not None:
+                job.save_task.cancel()
+                await asyncio.gather(job.save_task, return_exceptions=True)
+    
+    async def submit(self, user_id: str, username: str, items: list[dict], concurrency: Optional[int] = None) -> BatchJob:
+        """提交任务
+        
+        Args:
+            user_id: 用户ID
+            username: 用户名
+            items: [{"session_id", "message"}, ...]
+            concurrency: 该任务的并发数（不超过服务端上限）
+        
+        Returns:
+            BatchJob 实例
+        
+        Raises:
+            ValueError: 消息数超过上限
+            Draining: 服务正在关闭（新任务不会开始，关闭时会被标记为 interrupted）
+        """
+        if self.draining:
+            raise Draining(self.retry_after)
+        if len(items) > self.max_items:
+            raise ValueError(f"单个任务最多包含 {self.max_items} 条消息")
+        
+        job = BatchJob(
+            job_id=uuid.uuid4().hex,
+            user_id=str(user_id),
+            username=username,
+            items=items,
+            concurrency=min(concurrency or self.max_concurrency_per_job, self.max_concurrency_per_job),
+        )
+        self.jobs[job.job_id] = job
+        self._order.append(job.job_id)
+        await self._flush(job)
+        async with self._cond:
+            self._cond.notify_all()
+        return job
+    
+    def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        """获取任务状态（内存中没有时从磁盘读取）"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict() if job.user_id == str(user_id) else None
+        return self._load(job_id, str(user_id))
+    
+    async def wait(self, job_id: str, user_id: str, after_completed: int, timeout: float) -> Optional[dict]:
+        """长轮询：等待已完成的消息数超过 after_completed、任务结束或超时"""
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != str(user_id):
+            return self.get(job_id, user_id)
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, timeout)
+        while not job.finished and job.count("completed") + job.count("failed") <= after_completed:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await job.wait_changed(remaining)
+        return job.to_dict()
+    
+    def list_jobs(self, user_id: str) -> list[dict]:
+        """列出用户的任务（不含结果，按创建时间倒序）"""
+        jobs: dict[str, dict] = {}
+        user_dir = self.jobs_dir / str(user_id)
+        if user_dir.exists():
+            for path in user_dir.glob("*.json"):
+                data = self._load(path.stem, str(user_id))
+                if data is not None:
+                    jobs[data["job_id"]] = data
+        for job in self.jobs.values():
+            if job.user_id == str(user_id):
+                jobs[job.job_id] = job.to_dict()
+        
+        summaries = [{k: v for k, v in data.items() if k != "results"} for data in jobs.values()]
+        return sorted(summaries, key=lambda d: d["created_at"], reverse=True)
+    
+    async def cancel(self, job_id: str, user_id: str) -> Optional[dict]:
+        """取消任务：未开始的消息标记为 cancelled，进行中的消息被取消"""
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != str(user_id):
+            return self.get(job_id, user_id)
+        if job.finished:
+            return job.to_dict()
+        
+        for index in job.pending:
+            job.results[index]["status"] = "cancelled"
+        job.pending = []
+        running = list(job.running.values())
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        
+        job.status = "cancelled"
+        await self._finish(job)
+        return job.to_dict()
+    
+    def get_stats(self) -> dict:
+        """worker 和队列统计"""
+        active = [job for job in self.jobs.values() if not job.finished]
+        return {
+            "workers": self.workers,
+            "busy_workers": sum(len(job.running) for job in active),
+            "active_jobs": len(active),
+            "pending_items": sum(len(job.pending) for job in active),
+        }
+    
+    # ---------- worker ----------
+    
+    async def _finish(self, job: BatchJob) -> None:
+        """任务结束：立即保存结果，保留一段时间后从内存移除"""
+        job.touch()
+        job.dirty = True
+        try:
+            await self._flush(job)
+        except OSError as e:
+            logger.warning(f"⚠️ 保存批量任务 {job.job_id} 失败: {e}")
+        asyncio.get_running_loop().call_later(self.retention, self.jobs.pop, job.job_id, None)
+    
+    def _next_item(self) -> Optional[tuple[BatchJob, int]]:
+        """按轮转顺序选择下一条可以处理的消息"""
+        if self._draining:
+            return None
+        for _ in range(len(self._order)):
+            job_id = self._order.pop(0)
+            job = self.jobs.get(job_id)
+            if job is None or not job.pending:
+                continue  # 没有待处理的消息，移出轮转
+            self._order.append(job_id)
+            if len(job.running) >= job.concurrency:
+                continue
+            for pos, index in enumerate(job.pending):
+                key = (job.user_id, job.results[index]["session_id"])
+                if key not in self._busy_sessions:
+                    job.pending.pop(pos)
+                    self._busy_sessions.add(key)
+                    return job, index
+        return None
+    
+    async def _worker(self) -> None:
+        while True:
+            async with self._cond:
+                picked = self._next_item()
+                while picked is None:
+                    await self._cond.wait()
+                    picked = self._next_item()
+            
+            job, index = picked
+            task = asyncio.create_task(self._run_item(job, index))
+            job.running[index] = task
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done():
+                    # worker 自身被取消（服务关闭）
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise
+            finally:
+                job.running.pop(index, None)
+                self._busy_sessions.discard((job.user_id, job.results[index]["session_id"]))
+                if not job.pending and not job.running and not job.finished:
+                    job.status = "completed"
+                    await self._finish(job)
+                else:
+                    job.touch()
+                    self._save_soon(job)
+                async with self._cond:
+                    self._cond.notify_all()
+    
+    async def _run_item(self, job: BatchJob, index: int) -> None:
+        result = job.results[index]
+        result["status"] = "running"
+        result["started_at"] = datetime.now().isoformat()
+        if job.status == "queued":
+            job.status = "running"
+        job.touch()
+        
+        try:
+            # 批量任务的模型调用排在交互式对话之后
+            with priority_scope(Priority.BATCH):
+                events = self.adapter.handle_message_stream(
+                    user_id=job.user_id,
+                    username=job.username,
+                    session_id=result["session_id"],
+                    message=result["message"],
+                )
+                async with aclosing(events) as events:
+                    async for event in events:
+                        if event.type == FINAL:
+                            result["content"] = event.text
+                            result["error"] = event.error
+            result["status"] = "failed" if result["error"] else "completed"
+        except asyncio.CancelledError:
+            result["status"] = "cancelled"
+            raise
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        finally:
+            result["finished_at"] = datetime.now().isoformat()
+    
+    # ---------- 持久化 ----------
+    
+    def _job_path(self, job_id: str, user_id: str) -> Path:
+        return self.jobs_dir / str(user_id) / f"{job_id}.json"
+    
+    def _save_soon(self, job: BatchJob) -> None:
+        """标记任务状态已变化，在后台写入（save_interval 内的多次变化合并为一次写入）"""
+        job.dirty = True
+        if job.save_task is None or job.save_task.done():
+            job.save_task = asyncio.create_task(self._save_later(job))
+    
+    async def _save_later(self, job: BatchJob) -> None:
+        # 写入期间发生的变化由本任务继续写入（_save_soon 只在没有进行中的写入任务时创建新任务）
+        while job.dirty:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self._flush(job)
+            except OSError as e:
+                logger.warning(f"⚠️ 保存批量任务 {job.job_id} 失败: {e}")
+                return
+    
+    async def _flush(self, job: BatchJob) -> None:
+        """写入任务状态（有未写入的变化时；同一任务的写入串行进行）"""
+        async with job.save_lock:
+            if not job.dirty:
+                return
+            job.dirty = False
+            data = job.snapshot()
+            try:
+                await asyncio.to_thread(self._write, self._job_path(job.job_id, job.user_id), data)
+            except OSError:
+                job.dirty = True
+                raise
+    
+    @staticmethod
+    def _write(path: Path, data: dict) -> None:
+        """写入任务文件（先写临时文件再替换，避免读到半个文件）"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def _load(self, job_id: str, user_id: str) -> Optional[dict]:
+        path = self._job_path(job_id, user_id)
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        # 服务重启前未完成的任务
+        if data.get("status") in ("queued", "running"):
+            data["status"] = "interrupted"
+        return data
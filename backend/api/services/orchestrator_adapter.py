@@ -8,7 +8,10 @@ from __future__ import annotations
 
 import sys
 import os
+import asyncio
 import logging
+import time
+from contextlib import aclosing
 from pathlib import Path
 
 from agentscope.tool import Toolkit
@@ -27,8 +30,29 @@ from backend.src.agents.orchestrator_agent import OrchestratorAgent
 from backend.src.orchestrator import Orchestrator
 from backend.src.long_term_memory import build_mem0_long_term_memory
 from backend.src.logged_long_term_memory import wrap_with_logging
+from backend.src.logging_setup import log_context
 from backend.src.mcp_manager import MCPManager
+from backend.src.metrics import CACHE_REQUESTS, ROUTER_DECISIONS, SESSION_IO_SECONDS
 from backend.src.rag_manager import RAGManager
+from backend.api.services.fair_scheduler import FairScheduler, Ticket
+from backend.src.deadline import (
+    Deadline,
+    add_tool_budget,
+    current_deadline,
+    deadline_scope,
+    run_stage,
+    wrap_with_budget,
+)
+from backend.src.streaming import (
+    FINAL,
+    TEXT_DELTA,
+    TOOL_CALL_START,
+    StreamEvent,
+    estimate_tokens,
+    stream_agent_reply,
+)
+from backend.src.timings import record_stage, timed
+from backend.src.tracing import current_span, start_span
 
 
 class OrchestratorAdapter:
@@ -44,17 +68,36 @@ class OrchestratorAdapter:
       - Agents（新创建）, Orchestrator（新创建）
     """
     
-    def __init__(self, global_config, global_mcp_manager, global_rag_manager):
+    def __init__(
+        self,
+        global_config,
+        global_mcp_manager,
+        global_rag_manager,
+        stream_buffer: dict | None = None,
+        scheduler: FairScheduler | None = None,
+        deadlines: dict | None = None,
+    ):
         """初始化适配器
         
         Args:
             global_config: 全局配置
             global_mcp_manager: 全局 MCP 管理器（已初始化）
             global_rag_manager: 全局 RAG 管理器（已初始化）
+            stream_buffer: api.yaml 中的 sse.buffer 配置块（事件缓冲区容量和策略）
+            scheduler: 按用户的公平调度器（None 表示不排队）
+            deadlines: api.yaml 中的 deadlines 配置块（请求总预算和各阶段预算）
         """
         self.config = global_config
         self.global_mcp = global_mcp_manager
         self.global_rag = global_rag_manager
+        self.scheduler = scheduler
+        
+        stream_buffer = stream_buffer or {}
+        self.buffer_size = int(stream_buffer.get("max_events", 256))
+        self.buffer_policy = stream_buffer.get("policy", "block")
+        
+        self.deadline_config = deadlines or {}
+        self.idle_timeout = self.deadline_config.get("idle", 30)
         
         # 用户级资源缓存（key: user_id）
         self.user_mem0_cache: dict[str, any] = {}
@@ -72,7 +115,7 @@ class OrchestratorAdapter:
             user_id: 用户ID
             session_id: 会话ID
             message: 用户消息
-            
+        
         Returns:
             Agent 的响应
         """
@@ -105,278 +148,258 @@ class OrchestratorAdapter:
         username: str,
         session_id: str,
         message: str,
+        ticket: Ticket | None = None,
     ):
-        """处理用户消息并返回流式生成器（真正的流式输出）
+        """处理用户消息并返回流式生成器（模型层直接产出增量事件）
+        
+        启用公平调度时，先在用户自己的队列中等待生成槽位。
+        开始处理后创建请求级截止时间，路由、Agent、工具和记忆检索都在各自的预算内执行。
+        整个请求是一条追踪 trace（chat.request），各阶段是其中的 span。
         
         Args:
             user_id: 用户ID
             username: 用户名
             session_id: 会话ID
             message: 用户消息
-            
+            ticket: 已提交的调度凭证（None 表示在这里提交，不检查排队上限）
+        
         Yields:
-            (is_final: bool, delta_content: str, full_content: str) 元组
+            StreamEvent 流式事件（text_delta / tool_call_start / tool_call_end / final）
         """
+        if ticket is None and self.scheduler is not None:
+            ticket = self.scheduler.submit(user_id, username, enforce_limit=False)
+        with start_span("chat.request", root=True, user_id=user_id, username=username, session_id=session_id) as span, \
+                log_context(request_id=os.urandom(8).hex(), user_id=user_id, session_id=session_id):
+            try:
+                if ticket is not None:
+                    with timed("queue"), start_span("scheduler.wait"):
+                        waited = await ticket.wait()
+                    if waited > 0.01:
+                        logger.info(f"[调度] 用户 {username} 排队 {waited:.2f} 秒")
+                
+                # 排队时间不计入请求预算
+                deadline = Deadline.from_config(self.deadline_config)
+                with deadline_scope(deadline):
+                    events = self._handle_message_stream(user_id, username, session_id, message)
+                    async with aclosing(events) as events:
+                        async for event in events:
+                            yield event
+                if deadline is not None and deadline.overruns:
+                    span.set_attribute("deadline.overruns", ",".join(deadline.overruns))
+                    logger.warning(f"  ⏱️ 超出预算的阶段: {', '.join(deadline.overruns)}")
+            finally:
+                if ticket is not None:
+                    ticket.release()
+    
+    async def _handle_message_stream(
+        self,
+        user_id: str,
+        username: str,
+        session_id: str,
+        message: str,
+    ):
         from agentscope.message import Msg
         from backend.src.routing_schema import RoutingChoice
         
-        logger.info(f"\n{'='*80}")
         logger.info(f"[聊天请求] 用户: {username} (ID: {user_id}), 会话: {session_id[:8]}...")
-        logger.info(f"[用户消息] {message}")
-        logger.info(f"{'='*80}\n")
+        logger.debug(f"[用户消息] {message}")
         
         # 1. 获取或创建用户级资源
-        logger.info("[步骤 1/9] 初始化用户级资源...")
-        user_mem0 = await self._get_or_create_user_mem0(user_id)
-        user_rag = await self._get_or_create_user_rag(user_id)
-        logger.info("  ✓ 用户资源已就绪 (mem0 + RAG)")
+        logger.debug("[步骤 1/9] 初始化用户级资源...")
+        with timed("user_resources"), start_span("stage.user_resources"):
+            user_mem0 = await self._get_or_create_user_mem0(user_id)
+            user_rag = await self._get_or_create_user_rag(user_id)
+        logger.debug("  ✓ 用户资源已就绪 (mem0 + RAG)")
         
         # 2. 创建新的 Agents
-        logger.info("[步骤 2/9] 创建专业 Agents...")
-        domain_agents = await self._create_agents(
-            user_id=user_id,
-            user_mem0=user_mem0,
-            user_rag=user_rag,
-        )
-        logger.info(f"  ✓ 已创建 {len(domain_agents['domain_agents'])} 个领域 Agent + 通用 Agent")
+        logger.debug("[步骤 2/9] 创建专业 Agents...")
+        with timed("create_agents"), start_span("stage.create_agents"):
+            domain_agents = await self._create_agents(
+                user_id=user_id,
+                user_mem0=user_mem0,
+                user_rag=user_rag,
+            )
+        logger.debug(f"  ✓ 已创建 {len(domain_agents['domain_agents'])} 个领域 Agent + 通用 Agent")
         
         # 3. 创建新的 Orchestrator
-        logger.info("[步骤 3/9] 创建 Orchestrator 并恢复会话...")
-        orchestrator = await self._create_orchestrator_for_session(
-            user_id=user_id,
-            username=username,
-            session_id=session_id,
-            domain_agents=domain_agents,
-        )
-        logger.info("  ✓ Orchestrator 已就绪")
+        logger.debug("[步骤 3/9] 创建 Orchestrator 并恢复会话...")
+        with timed("restore_session"), start_span("stage.restore_session"):
+            orchestrator = await self._create_orchestrator_for_session(
+                user_id=user_id,
+                username=username,
+                session_id=session_id,
+                domain_agents=domain_agents,
+            )
+        logger.debug("  ✓ Orchestrator 已就绪")
         
         # 4. 路由到合适的 Agent
-        logger.info("[步骤 4/9] 路由决策...")
+        logger.debug("[步骤 4/9] 路由决策...")
         msg_user = Msg("user", message, "user")
-        router_res = await orchestrator.general_router(msg_user, structured_model=RoutingChoice)
-        choice = (router_res.metadata or {}).get("your_choice", "general")
-        logger.info(f"  → 路由结果: [{choice}]")
+        router_res = await run_stage(
+            "router",
+            orchestrator.general_router(msg_user, structured_model=RoutingChoice),
+            fallback=None,
+        )
+        if router_res is None:
+            logger.warning("  ⏱️ 路由超时，使用通用 Agent")
+        choice = ((router_res.metadata if router_res is not None else None) or {}).get("your_choice", "general")
+        logger.debug(f"  → 路由结果: [{choice}]")
+        ROUTER_DECISIONS.inc(choice=choice if router_res is not None else "timeout")
+        current_span().set_attribute("route", choice)
         
         # 5. 选择目标 Agent
-        logger.info("[步骤 5/9] 选择目标 Agent...")
+        logger.debug("[步骤 5/9] 选择目标 Agent...")
         if choice in ("general", "none"):
             target_agent = orchestrator.general_answer
-            logger.info(f"  → 使用通用 Agent")
+            logger.debug(f"  → 使用通用 Agent")
         else:
             target_agent = orchestrator.domain_agents.get(choice, orchestrator.general_answer)
-            logger.info(f"  → 使用专业 Agent: {choice}")
-        
-        # 6. 准备 prompt（手动构建，绕过 Agent 以支持流式输出）
-        logger.info("[步骤 6/9] 准备 Agent 执行...")
-        
-        # 获取 Agent 的系统提示和历史消息
-        agent_memory = target_agent.memory if hasattr(target_agent, 'memory') else None
-        agent_sys_prompt = target_agent.sys_prompt if hasattr(target_agent, 'sys_prompt') else ""
-        
-        # 构建消息列表
-        messages = []
-        if agent_sys_prompt:
-            messages.append({"role": "system", "content": agent_sys_prompt})
+            logger.debug(f"  → 使用专业 Agent: {choice}")
         
-        # 添加历史消息（异步获取）
-        if agent_memory:
-            try:
-                history = await agent_memory.get_memory()
-                for hist_msg in history:
-                    role = getattr(hist_msg, 'role', 'user')
-                    content = getattr(hist_msg, 'content', str(hist_msg))
-                    messages.append({"role": role, "content": content})
-            except Exception as e:
-                logger.warning(f"获取历史消息失败: {e}")
-        
-        # 添加当前用户消息
-        messages.append({"role": "user", "content": message})
-        
-        # 7. 直接调用模型获取流式输出（AgentScope 正确方式）
-        logger.info("[步骤 7/9] 调用 LLM 模型生成响应...")
+        # 6. 准备 Agent 执行
+        logger.debug("[步骤 6/9] 准备 Agent 执行...")
         
         # 检查 Agent 是否有可用工具
-        has_tools = hasattr(target_agent, 'get_tools') or (hasattr(target_agent, 'toolkit') and target_agent.toolkit)
-        if has_tools:
-            # 列出可用工具
-            tools_list = []
-            if hasattr(target_agent, 'toolkit') and target_agent.toolkit:
-                tools_list = list(target_agent.toolkit.tools.keys())
-            logger.info(f"  🔧 Agent 已装备 {len(tools_list)} 个工具")
+        toolkit = getattr(target_agent, 'toolkit', None)
+        if toolkit:
+            tools_list = list(toolkit.tools.keys())
+            logger.debug(f"  🔧 Agent 已装备 {len(tools_list)} 个工具")
             if tools_list:
-                logger.info(f"     可用工具: {', '.join(tools_list)}")
-        
-        # 🔧 使用 Hooks 机制实现流式输出 + 工具调用
-        logger.info("  📡 使用 hooks 捕获 Agent 流式输出...")
-        
-        # 创建消息队列
-        import asyncio
-        message_queue = asyncio.Queue()
-        last_full_text = ""
-        
-        # 创建 streaming hook
-        async def streaming_hook(self, kwargs: dict):
-            """捕获 Agent 的每条消息"""
-            msg = kwargs.get("msg")
-            if msg:
-                # 提取消息内容 - 只提取纯文本部分
-                content = ""
-                if hasattr(msg, 'content'):
-                    raw_content = msg.content
-                    
-                    # 如果是字符串，直接使用
-                    if isinstance(raw_content, str):
-                        content = raw_content
-                    # 如果是列表（结构化数据），提取 text 类型的内容
-                    elif isinstance(raw_content, list):
-                        text_parts = []
-                        for item in raw_content:
-                            if isinstance(item, dict):
-                                # 只提取 type='text' 的内容
-                                if item.get('type') == 'text':
-                                    text_parts.append(item.get('text', ''))
-                            elif isinstance(item, str):
-                                text_parts.append(item)
-                        content = ''.join(text_parts)
-                    else:
-                        content = str(raw_content)
-                else:
-                    content = str(msg)
-                
-                # 只有非空内容才发送
-                if content.strip():
-                    await message_queue.put({
-                        "name": getattr(msg, 'name', 'agent'),
-                        "role": getattr(msg, 'role', 'assistant'),
-                        "content": content
-                    })
-        
-        # 注册 hook
-        hook_name = f"streaming_hook_{session_id}"
-        try:
-            target_agent.register_instance_hook(
-                hook_type="pre_print",
-                hook_name=hook_name,
-                hook=streaming_hook
-            )
-            
-            # 后台运行 Agent
-            async def run_agent():
-                try:
-                    response = await target_agent(msg_user)
-                    await message_queue.put(None)  # 结束标记
-                except Exception as e:
-                    logger.error(f"Agent 执行异常: {e}", exc_info=True)
-                    await message_queue.put({"error": str(e)})
-                    await message_queue.put(None)
-            
-            # 启动 Agent 任务
-            agent_task = asyncio.create_task(run_agent())
-            
-            # 流式输出消息
+                logger.debug(f"     可用工具: {', '.join(tools_list)}")
+        
+        # 7. 运行 Agent，直接从模型流获取增量事件
+        logger.debug("[步骤 7/9] 调用 LLM 模型生成响应...")
+        
+        final_text = ""
+        parts: list[str] = []
+        deadline = current_deadline()
+        agent_started = time.perf_counter()
+        with start_span("stage.agent", agent=target_agent.name) as agent_span:
             try:
-                while True:
-                    # 等待消息（超时30秒）
-                    message_data = await asyncio.wait_for(message_queue.get(), timeout=30.0)
-                    
-                    if message_data is None:  # 结束标记
-                        logger.info("  ✅ Agent 执行完成")
-                        break
-                    
-                    if isinstance(message_data, dict) and "error" in message_data:
-                        logger.error(f"  ❌ Agent 错误: {message_data['error']}")
-                        break
-                    
-                    # 提取内容
-                    content = message_data.get("content", "")
-                    if content:
-                        # 计算真正的增量（只发送新增部分）
-                        if content.startswith(last_full_text):
-                            # 内容是累积的，提取新增部分
-                            delta = content[len(last_full_text):]
-                            last_full_text = content
-                            
-                            # 只发送非空的增量
-                            if delta:
-                                yield (False, delta, last_full_text)
-                        else:
-                            # 内容不是累积的（可能是新的独立消息，如工具结果）
-                            # 添加换行分隔
-                            if last_full_text:
-                                delta = "\n" + content
-                                last_full_text += delta
+                events = stream_agent_reply(
+                    target_agent,
+                    msg_user,
+                    buffer_size=self.buffer_size,
+                    buffer_policy=self.buffer_policy,
+                    idle_timeout=self.idle_timeout,
+                    timeout=deadline.budget("agent") if deadline is not None else None,
+                )
+                async with aclosing(events) as events:
+                    async for event in events:
+                        if event.type == FINAL:
+                            final_text = event.text
+                            if event.error == "timeout":
+                                logger.error("  ⏱️ Agent 执行超时")
+                                if not final_text:
+                                    final_text = "执行超时"
+                                    yield StreamEvent(TEXT_DELTA, text=final_text)
+                            elif event.error:
+                                logger.error(f"  ❌ Agent 错误: {event.error}")
                             else:
-                                delta = content
-                                last_full_text = content
-                            
-                            yield (False, delta, last_full_text)
-                
-                # 发送最终完整内容
-                if last_full_text:
-                    yield (True, "", last_full_text)
-                    
-            except asyncio.TimeoutError:
-                logger.error("  ⏱️ Agent 执行超时")
-                if last_full_text:
-                    yield (True, "", last_full_text)
-                else:
-                    yield (True, "执行超时", "执行超时")
-                    
-        finally:
-            # 清理 hook
-            try:
-                target_agent.remove_instance_hook(
-                    hook_type="pre_print",
-                    hook_name=hook_name
+                                logger.debug("  ✅ Agent 执行完成")
+                            record_stage("agent", time.perf_counter() - agent_started)
+                            agent_span.set_attributes(error=event.error, reply_tokens=estimate_tokens(final_text))
+                            yield StreamEvent(FINAL, text=final_text, error=event.error, metadata=event.metadata)
+                            break
+                        
+                        if event.type == TEXT_DELTA:
+                            parts.append(event.text)
+                        elif event.type == TOOL_CALL_START:
+                            logger.debug(f"  🔧 调用工具: {event.tool_name}")
+                        yield event
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开导致生成被取消：保存已生成的部分内容后继续传播取消
+                logger.info("  ⏹️ 生成已取消，保存已生成的部分内容")
+                await self._persist_turn(
+                    orchestrator,
+                    user_id=user_id,
+                    username=username,
+                    session_id=session_id,
+                    message=message,
+                    agent_name=target_agent.name,
+                    text="".join(parts),
+                    interrupted=True,
                 )
-            except:
-                pass
-            
-            # 取消任务（如果还在运行）
-            if 'agent_task' in locals() and not agent_task.done():
-                agent_task.cancel()
+                raise
+        
+        with timed("persist"), start_span("stage.persist"):
+            await self._persist_turn(
+                orchestrator,
+                user_id=user_id,
+                username=username,
+                session_id=session_id,
+                message=message,
+                agent_name=target_agent.name,
+                text=final_text,
+            )
+        logger.info(f"[完成] {target_agent.name} 响应已发送")
+    
+    async def _persist_turn(
+        self,
+        orchestrator: Orchestrator,
+        user_id: str,
+        username: str,
+        session_id: str,
+        message: str,
+        agent_name: str,
+        text: str,
+        interrupted: bool = False,
+    ):
+        """保存会话状态和本轮对话（步骤 8、9）
         
+        Args:
+            orchestrator: 本次请求的 Orchestrator
+            user_id: 用户ID
+            username: 用户名
+            session_id: 会话ID
+            message: 用户消息
+            agent_name: 回复的 Agent 名称
+            text: 回复文本（被取消时为已生成的部分）
+            interrupted: 回复是否因取消而不完整
+        """
         # 8. 保存会话状态（使用最终的响应）
-        logger.info("[步骤 8/9] 保存会话状态...")
+        logger.debug("[步骤 8/9] 保存会话状态...")
         
         # 使用 {user_id}_{username} 格式与 SessionService 保持一致
         session_user_id = f"{user_id}_{username}"
         
         agents_dict = {"general-router": orchestrator.general_router, "general": orchestrator.general_answer}
         agents_dict.update(orchestrator.domain_agents)
-        await orchestrator.session.save_session_state(
-            session_id=session_id,
-            user_id=session_user_id,
-            **agents_dict
-        )
-        logger.info(f"  ✓ 会话状态已保存到 {session_user_id}/{session_id[:8]}.../state.json")
+        with SESSION_IO_SECONDS.time(op="save_state"), start_span("session.save_state"):
+            await orchestrator.session.save_session_state(
+                session_id=session_id,
+                user_id=session_user_id,
+                **agents_dict
+            )
+        logger.debug(f"  ✓ 会话状态已保存到 {session_user_id}/{session_id[:8]}.../state.json")
         
         # 9. 保存时间线事件
-        logger.info("[步骤 9/9] 保存对话历史...")
-        final_response = Msg(target_agent.name, last_full_text, "assistant")
+        logger.debug("[步骤 9/9] 保存对话历史...")
+        assistant_event = {"role": "assistant", "content": text, "name": agent_name}
+        if interrupted:
+            assistant_event["interrupted"] = True
         events = [
             {"role": "user", "content": message, "name": "user"},
-            {"role": "assistant", "content": last_full_text, "name": target_agent.name}
+            assistant_event,
         ]
-        await orchestrator.session.append_events(
-            session_id=session_id,
-            user_id=session_user_id,
-            events=events
-        )
-        logger.info(f"  ✓ 对话历史已保存到 timeline.json")
-        logger.info(f"{'='*80}")
-        logger.info(f"[完成] 响应已发送")
-        logger.info(f"{'='*80}\n")
+        with SESSION_IO_SECONDS.time(op="append_events"), start_span("session.append_events", events=len(events)):
+            await orchestrator.session.append_events(
+                session_id=session_id,
+                user_id=session_user_id,
+                events=events
+            )
+        logger.debug(f"  ✓ 对话历史已保存到 timeline.json")
     
     async def _get_or_create_user_mem0(self, user_id: str):
         """获取或创建用户的 mem0 长期记忆（缓存）
         
         Args:
             user_id: 用户ID
-            
+        
         Returns:
             mem0 实例
         """
+        CACHE_REQUESTS.inc(cache="user_mem0", result="hit" if user_id in self.user_mem0_cache else "miss")
         if user_id not in self.user_mem0_cache:
             # 创建 mem0
             user_ltm = build_mem0_long_term_memory(
@@ -384,7 +407,8 @@ class OrchestratorAdapter:
                 self.config.llm, 
                 user_id=user_id
             )
-            user_ltm = wrap_with_logging(user_ltm)
+            # 检索超出 memory 预算时跳过
+            user_ltm = wrap_with_budget(wrap_with_logging(user_ltm))
             self.user_mem0_cache[user_id] = user_ltm
         
         return self.user_mem0_cache[user_id]
@@ -394,10 +418,11 @@ class OrchestratorAdapter:
         
         Args:
             user_id: 用户ID
-            
+        
         Returns:
             {agent_name: AgentKnowledgeBase} 字典
         """
+        CACHE_REQUESTS.inc(cache="user_rag", result="hit" if user_id in self.user_rag_cache else "miss")
         if user_id not in self.user_rag_cache:
             user_rag = {}
             if self.global_rag:
@@ -421,7 +446,7 @@ class OrchestratorAdapter:
             user_id: 用户ID
             user_mem0: 用户的 mem0 实例
             user_rag: 用户的 RAG 知识库字典
-            
+        
         Returns:
             {agent_name: agent_instance} 字典
         """
@@ -468,6 +493,10 @@ class OrchestratorAdapter:
             
             domain_agents[agent_name] = agent
         
+        # 工具调用（MCP、知识库、记忆工具）在各自的预算内执行
+        for agent in [general_answer, *domain_agents.values()]:
+            add_tool_budget(getattr(agent, "toolkit", None))
+        
         return {
             "general_answer": general_answer,
             "domain_agents": domain_agents,
@@ -487,7 +516,7 @@ class OrchestratorAdapter:
             username: 用户名
             session_id: 会话ID
             domain_agents: 领域 agents 字典
-            
+        
         Returns:
             Orchestrator 实例
         """
@@ -509,7 +538,8 @@ class OrchestratorAdapter:
         )
         
         # 3. 恢复会话状态（如果存在）
-        await orchestrator.restore()
+        with SESSION_IO_SECONDS.time(op="load_state"), start_span("session.load_state"):
+            await orchestrator.restore()
         
         return orchestrator
     
@@ -6,14 +6,17 @@
 
 from __future__ import annotations
 
+import asyncio
 import os
 import json
+import shutil
 import uuid
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
 from backend.api.models import SessionInfo, SessionDetail, Message
+from backend.src.session_adapter import session_lock, session_tombstone
 
 
 class SessionService:
@@ -121,7 +124,8 @@ class SessionService:
         
         sessions = []
         for session_path in sessions_dir.iterdir():
-            if not session_path.is_dir():
+            # 跳过非目录和 .locks 等内部目录
+            if not session_path.is_dir() or session_path.name.startswith("."):
                 continue
             
             session_id = session_path.name
@@ -291,7 +295,7 @@ class SessionService:
         
         return messages
     
-    def delete_session(self, user_id: str, username: str, session_id: str) -> bool:
+    async def delete_session(self, user_id: str, username: str, session_id: str) -> bool:
         """删除会话
         
         Args:
@@ -301,15 +305,24 @@ class SessionService:
             
         Returns:
             是否删除成功
+        
+        Raises:
+            LockTimeout: 会话正在被其他请求写入，超时仍未释放
         """
         session_dir = self._get_session_dir(str(user_id), username, session_id)
         
         if not session_dir.exists():
             return False
         
-        # 删除会话目录
-        import shutil
-        shutil.rmtree(session_dir)
+        # 删除会话目录（持有会话锁，避免与其他 worker 正在进行的写入交错）
+        # 锁文件在会话目录之外，删除目录不影响正在等锁的写入方；
+        # 先写删除标记，之后拿到锁的写入方跳过写入，不会重新创建只有部分文件的会话
+        # 异步加锁（等待期间不阻塞事件循环），删除目录在线程中进行
+        async with session_lock(str(session_dir)):
+            if not session_dir.exists():
+                return False
+            Path(session_tombstone(str(session_dir))).touch()
+            await asyncio.to_thread(shutil.rmtree, session_dir)
         
         return True
 
@@ -0,0 +1,155 @@
+"""SSE 增量合并器
+
+位于 Adapter 事件流和 EventSourceResponse 之间，把短时间内到达的
+多个文本增量合并为一个 SSE 帧，减少 JSON 编码、SSE 分帧和 TCP 写入次数。
+
+规则：
+- 首个 token（以及每次工具调用之后的首个 token）立即发送，不影响首字延迟
+- 之后的文本增量按时间窗口（window_ms）或字节数（max_bytes）合并
+- 遇到工具边界 / 结束事件时立即刷新缓冲
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import aclosing
+from typing import AsyncGenerator
+
+from backend.src.streaming import TEXT_DELTA, StreamBuffer, StreamEvent
+
+
+_END = object()
+
+
+class StreamCoalescer:
+    """按时间窗口 / 字节数合并文本增量"""
+    
+    def __init__(
+        self,
+        enabled: bool = True,
+        window_ms: float = 30,
+        max_bytes: int = 2048,
+        buffer_size: int = 256,
+        buffer_policy: str = "block",
+    ):
+        """初始化合并器
+        
+        Args:
+            enabled: 是否启用合并（关闭时原样透传）
+            window_ms: 合并时间窗口（毫秒）
+            max_bytes: 缓冲达到该字节数时立即刷新
+            buffer_size: 上游事件缓冲区容量（事件数）
+            buffer_policy: 上游事件缓冲区满时的策略（block / coalesce / drop）
+        """
+        self.enabled = enabled
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_bytes = max(1, int(max_bytes))
+        self.buffer_size = buffer_size
+        self.buffer_policy = buffer_policy
+    
+    @classmethod
+    def from_config(cls, sse_cfg: dict | None) -> "StreamCoalescer":
+        """从 api.yaml 的 sse 配置块创建"""
+        coalesce_cfg = (sse_cfg or {}).get("coalesce", {}) or {}
+        buffer_cfg = (sse_cfg or {}).get("buffer", {}) or {}
+        return cls(
+            enabled=bool(coalesce_cfg.get("enabled", True)),
+            window_ms=coalesce_cfg.get("window_ms", 30),
+            max_bytes=coalesce_cfg.get("max_bytes", 2048),
+            buffer_size=int(buffer_cfg.get("max_events", 256)),
+            buffer_policy=buffer_cfg.get("policy", "block"),
+        )
+    
+    async def coalesce(self, events: AsyncGenerator[StreamEvent, None]) -> AsyncGenerator[StreamEvent, None]:
+        """合并事件流
+        
+        Args:
+            events: 上游事件流（StreamEvent）
+        
+        Yields:
+            合并后的 StreamEvent
+        """
+        if not self.enabled or self.window <= 0:
+            async with aclosing(events) as events:
+                async for event in events:
+                    yield event
+            return
+        
+        # 上游在独立任务中整体运行（保证其上下文变量一致），通过有界缓冲区交给合并循环
+        queue = StreamBuffer(self.buffer_size, self.buffer_policy, name="coalescer")
+        
+        async def _pump():
+            try:
+                # 取消可能发生在 queue.put 中，显式关闭上游，保证其清理在本任务中完成
+                async with aclosing(events) as upstream:
+                    async for event in upstream:
+                        await queue.put(event)
+            except BaseException as e:
+                await queue.put(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                return
+            await queue.put(_END)
+        
+        pump_task = asyncio.create_task(_pump())
+        loop = asyncio.get_running_loop()
+        
+        buffer: list[str] = []
+        buffer_bytes = 0
+        flush_at = None
+        pass_next = True  # 下一个文本增量是否立即发送
+        
+        def _flush() -> StreamEvent:
+            nonlocal buffer, buffer_bytes, flush_at
+            event = StreamEvent(TEXT_DELTA, text="".join(buffer))
+            buffer = []
+            buffer_bytes = 0
+            flush_at = None
+            return event
+        
+        try:
+            while True:
+                if buffer:
+                    timeout = max(0.0, flush_at - loop.time())
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        yield _flush()
+                        continue
+                else:
+                    item = await queue.get()
+                
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    if buffer:
+                        yield _flush()
+                    raise item
+                
+                if item.type != TEXT_DELTA:
+                    # 工具边界 / 结束事件：先刷新缓冲，再原样发送
+                    if buffer:
+                        yield _flush()
+                    pass_next = True
+                    yield item
+                    continue
+                
+                if pass_next:
+                    pass_next = False
+                    yield item
+                    continue
+                
+                buffer.append(item.text)
+                buffer_bytes += len(item.text.encode("utf-8"))
+                if flush_at is None:
+                    flush_at = loop.time() + self.window
+                if buffer_bytes >= self.max_bytes:
+                    yield _flush()
+            
+            if buffer:
+                yield _flush()
+        finally:
+            if not pump_task.done():
+                pump_task.cancel()
+                # 等待上游处理取消（例如保存已生成的部分内容）
+                await asyncio.gather(pump_task, return_exceptions=True)
@@ -0,0 +1,478 @@
+"""可恢复的 SSE 流注册表
+
+每次生成（一次聊天回复）在后台任务中独立运行，与 HTTP 连接的生命周期解耦：
+
+- 每个 SSE 帧带递增的事件 ID
+- 每个生成保留一个有界的环形缓冲区，保存最近的帧
+- 断线重连时根据 Last-Event-ID 重放遗漏的帧，然后继续跟随仍在运行的生成
+- 如果遗漏的帧已被挤出缓冲区，先发送一个 resync 帧（包含此前的完整文本）
+- 所有订阅者断开且在宽限期内没有重连时取消生成，取消会传递到
+  Agent、模型流和工具调用，避免为无人接收的回复继续消耗 token
+- 缓冲策略为 block 时，订阅者落后整个缓冲区后生成暂停（背压传递到模型流）；
+  其他策略下旧帧被挤出，订阅者收到 resync 帧
+- 生成超过 max_age 后被取消
+- 关闭时先排空（``drain``）：拒绝新的生成，进行中的生成在宽限期内正常完成并保存，
+  超时的才被取消（已生成的部分内容仍会保存）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from contextlib import aclosing
+from dataclasses import dataclass
+from itertools import count, islice
+from typing import AsyncGenerator, Callable, Optional
+
+from backend.src.streaming import bind_buffer_stats, estimate_tokens
+
+
+_subscription_ids = count(1)
+
+
+class Draining(Exception):
+    """服务正在关闭，拒绝新的生成"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"服务正在重启，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+@dataclass
+class StreamFrame:
+    """已发布的 SSE 帧"""
+    id: int
+    data: str
+    text_start: int  # 该帧之前已生成文本的长度（用于 resync）
+
+
+class GenerationStream:
+    """单次生成的帧缓冲区"""
+    
+    def __init__(self, stream_id: str, user_id: str, session_id: str, replay_size: int = 512):
+        """初始化生成流
+        
+        Args:
+            stream_id: 流ID
+            user_id: 所属用户ID
+            session_id: 会话ID
+            replay_size: 环形缓冲区保留的最大帧数
+        """
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.frames: deque[StreamFrame] = deque(maxlen=max(1, int(replay_size)))
+        self.next_id = 1
+        self.done = False
+        self.failed = False  # 是否发布过 error 帧
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.cancel_reason: Optional[str] = None  # client / disconnect / max_age / shutdown
+        # 各级缓冲区的高水位（事件数）：agent / coalescer / subscriber_lag
+        self.high_water: dict[str, int] = {}
+        self._cursors: dict[int, int] = {}  # 订阅 -> 已消费的最后一个帧ID
+        self._consumed = asyncio.Event()
+        self.on_subscribers_changed: Optional[Callable[["GenerationStream"], None]] = None
+        self._text_parts: list[str] = []
+        self._text_len = 0
+        self._changed = asyncio.Event()
+    
+    @property
+    def text(self) -> str:
+        """到目前为止生成的完整文本"""
+        return "".join(self._text_parts)
+    
+    def publish(self, payload: dict) -> None:
+        """发布一个帧（JSON 编码只在这里进行一次）"""
+        frame = StreamFrame(
+            id=self.next_id,
+            data=json.dumps(payload, ensure_ascii=False),
+            text_start=self._text_len,
+        )
+        self.next_id += 1
+        if payload.get("type") == "token" and payload.get("content"):
+            self._text_parts.append(payload["content"])
+            self._text_len += len(payload["content"])
+        elif payload.get("type") == "error":
+            self.failed = True
+        elif payload.get("type") == "resync":
+            self._text_parts = [payload.get("content") or ""]
+            self._text_len = len(self._text_parts[0])
+        self.frames.append(frame)
+        self._notify()
+    
+    async def wait_for_room(self) -> None:
+        """等待所有订阅者读到可以安全挤出最旧帧的位置（block 策略的背压）"""
+        while self._cursors and min(self._cursors.values()) < self.next_id - self.frames.maxlen:
+            await self._consumed.wait()
+    
+    def close(self) -> None:
+        """标记生成结束"""
+        self.done = True
+        self.finished_at = time.time()
+        self._notify()
+    
+    def compacted(self) -> "GenerationStream":
+        """已结束生成的精简副本：只保留完整文本和最后一帧（重放时先发送 resync，再发送结束帧）"""
+        copy = GenerationStream(self.stream_id, self.user_id, self.session_id, replay_size=1)
+        copy.created_at = self.created_at
+        copy.finished_at = self.finished_at
+        copy._text_parts = [self.text]
+        copy._text_len = self._text_len
+        if self.frames:
+            copy.frames.append(self.frames[-1])
+        copy.next_id = self.next_id
+        copy.done = self.done
+        copy.failed = self.failed
+        copy.cancel_reason = self.cancel_reason
+        return copy
+    
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+    
+    def _ack(self, token: int, frame_id: int) -> None:
+        """记录订阅者已消费到 frame_id，并更新订阅者积压的高水位"""
+        self._cursors[token] = frame_id
+        lag = self.next_id - 1 - frame_id
+        if lag > self.high_water.get("subscriber_lag", 0):
+            self.high_water["subscriber_lag"] = lag
+        self._signal_consumed()
+    
+    async def subscribe(self, last_event_id: Optional[int] = None) -> AsyncGenerator[dict, None]:
+        """订阅帧（从 last_event_id 之后开始）
+        
+        Args:
+            last_event_id: 客户端最后收到的事件ID，None 表示从头开始
+        
+        Yields:
+            EventSourceResponse 可直接发送的 {"id", "data"} 字典
+        """
+        cursor = last_event_id or 0
+        token = next(_subscription_ids)
+        self.subscribers += 1
+        self._subscribers_changed()
+        self._ack(token, cursor)
+        try:
+            while True:
+                changed = self._changed
+                first_id = self.frames[0].id if self.frames else self.next_id
+                
+                # 遗漏的帧已被挤出缓冲区：先补发此前的完整文本
+                if cursor < first_id - 1:
+                    text_before = self.text[:self.frames[0].text_start] if self.frames else self.text
+                    cursor = first_id - 1
+                    yield {
+                        "id": str(cursor),
+                        "data": json.dumps({"type": "resync", "content": text_before}, ensure_ascii=False),
+                    }
+                    self._ack(token, cursor)
+                
+                pending = list(islice(self.frames, max(0, cursor - first_id + 1), None))
+                for frame in pending:
+                    cursor = frame.id
+                    yield {"id": str(frame.id), "data": frame.data}
+                    # 生成器恢复执行说明上一帧已被发送
+                    self._ack(token, cursor)
+                
+                if self.done and cursor >= self.next_id - 1:
+                    return
+                if self.next_id - 1 > cursor:
+                    continue
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            self._cursors.pop(token, None)
+            self._signal_consumed()
+            self._subscribers_changed()
+    
+    def _signal_consumed(self) -> None:
+        consumed, self._consumed = self._consumed, asyncio.Event()
+        consumed.set()
+    
+    def _subscribers_changed(self) -> None:
+        if self.on_subscribers_changed is not None:
+            self.on_subscribers_changed(self)
+
+
+class StreamRegistry:
+    """进行中 / 最近完成的生成流注册表"""
+    
+    def __init__(
+        self,
+        replay_size: int = 512,
+        retention: float = 120,
+        cancel_on_disconnect: bool = True,
+        disconnect_grace: float = 15,
+        buffer_policy: str = "block",
+        max_age: Optional[float] = 3600,
+    ):
+        """初始化注册表
+        
+        Args:
+            replay_size: 每个生成保留的最大帧数
+            retention: 生成结束后保留多久以便重连（秒）
+            cancel_on_disconnect: 所有客户端断开后是否取消生成
+            disconnect_grace: 断开后等待重连的宽限期（秒），超时后取消生成
+            buffer_policy: 缓冲策略（block 时慢订阅者会让生成暂停，而不是挤出未读帧）
+            max_age: 单次生成的最长时长（秒），None 表示不限制
+        """
+        self.replay_size = replay_size
+        self.retention = retention
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.disconnect_grace = disconnect_grace
+        self.buffer_policy = buffer_policy
+        self.max_age = max_age
+        self.streams: dict[str, GenerationStream] = {}
+        self._cancel_handles: dict[str, asyncio.TimerHandle] = {}
+        self.draining = False
+        # 生成流在保留期后被移除时调用（幂等表据此释放对完整生成流的引用）
+        self.on_evict: Optional[Callable[[GenerationStream], None]] = None
+        
+        # 统计信息
+        self.stats = {
+            "started": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "expired": 0,
+            "tokens_generated_before_cancel": 0,
+            "tokens_saved_estimate": 0,
+            "drained": 0,
+            "aborted": 0,
+        }
+        self._avg_reply_tokens = 0.0  # 已完成回复的 token 数（指数滑动平均）
+    
+    @classmethod
+    def from_config(cls, sse_cfg: dict | None) -> "StreamRegistry":
+        """从 api.yaml 的 sse 配置块创建"""
+        resume_cfg = (sse_cfg or {}).get("resume", {}) or {}
+        buffer_cfg = (sse_cfg or {}).get("buffer", {}) or {}
+        max_age = (sse_cfg or {}).get("max_age", 3600)
+        return cls(
+            replay_size=int(resume_cfg.get("replay_buffer", 512)),
+            retention=float(resume_cfg.get("retention", 120)),
+            cancel_on_disconnect=bool(resume_cfg.get("cancel_on_disconnect", True)),
+            disconnect_grace=float(resume_cfg.get("disconnect_grace", 15)),
+            buffer_policy=buffer_cfg.get("policy", "block"),
+            max_age=float(max_age) if max_age else None,
+        )
+    
+    def start(self, user_id: str, session_id: str, producer_factory) -> GenerationStream:
+        """在后台任务中启动一次生成
+        
+        Args:
+            user_id: 用户ID
+            session_id: 会话ID
+            producer_factory: 接收 stream_id、返回 payload 字典异步生成器的函数
+        
+        Returns:
+            GenerationStream 实例
+        """
+        stream_id = uuid.uuid4().hex
+        stream = GenerationStream(stream_id, user_id, session_id, replay_size=self.replay_size)
+        stream.on_subscribers_changed = self._on_subscribers_changed
+        self.streams[stream_id] = stream
+        self.stats["started"] += 1
+        stream.task = asyncio.create_task(self._run(stream, producer_factory(stream_id)))
+        return stream
+    
+    async def _run(self, stream: GenerationStream, producer: AsyncGenerator[dict, None]) -> None:
+        bind_buffer_stats(stream.high_water)
+        expire_handle = None
+        if self.max_age:
+            expire_handle = asyncio.get_running_loop().call_later(
+                self.max_age, self._cancel, stream, "max_age"
+            )
+        try:
+            # 取消可能发生在生成器之外（等待缓冲区空间时），显式关闭生成器，
+            # 保证其 finally（保存已生成的部分内容、重置上下文变量）在本任务中、任务结束前执行
+            async with aclosing(producer) as events:
+                async for payload in events:
+                    if self.buffer_policy == "block":
+                        await stream.wait_for_room()
+                    stream.publish(payload)
+            self.stats["completed"] += 1
+            self._record_reply_tokens(estimate_tokens(stream.text))
+        except asyncio.CancelledError:
+            self._record_cancelled(stream)
+            stream.publish({
+                "type": "cancelled",
+                "reason": stream.cancel_reason or "shutdown",
+                "content": stream.text,
+            })
+            raise
+        except Exception as e:
+            stream.publish({"type": "error", "error": str(e)})
+        finally:
+            if expire_handle is not None:
+                expire_handle.cancel()
+            stream.close()
+            self._clear_cancel_timer(stream.stream_id)
+            asyncio.get_running_loop().call_later(self.retention, self._evict, stream.stream_id)
+    
+    def _evict(self, stream_id: str) -> None:
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None and self.on_evict is not None:
+            self.on_evict(stream)
+    
+    def _on_subscribers_changed(self, stream: GenerationStream) -> None:
+        """订阅者变化：全部断开时启动取消计时，有客户端重连时撤销"""
+        if stream.subscribers > 0 or stream.done:
+            self._clear_cancel_timer(stream.stream_id)
+            return
+        if not self.cancel_on_disconnect or stream.stream_id in self._cancel_handles:
+            return
+        self._cancel_handles[stream.stream_id] = asyncio.get_running_loop().call_later(
+            self.disconnect_grace, self._cancel_abandoned, stream
+        )
+    
+    def _cancel_abandoned(self, stream: GenerationStream) -> None:
+        self._cancel_handles.pop(stream.stream_id, None)
+        if stream.subscribers == 0:
+            self._cancel(stream, "disconnect")
+    
+    def _cancel(self, stream: GenerationStream, reason: str) -> None:
+        if stream.done or stream.task is None or stream.cancel_reason:
+            return
+        stream.cancel_reason = reason
+        stream.task.cancel()
+    
+    def _clear_cancel_timer(self, stream_id: str) -> None:
+        handle = self._cancel_handles.pop(stream_id, None)
+        if handle is not None:
+            handle.cancel()
+    
+    def _record_reply_tokens(self, tokens: int) -> None:
+        if self._avg_reply_tokens == 0:
+            self._avg_reply_tokens = float(tokens)
+        else:
+            self._avg_reply_tokens = 0.9 * self._avg_reply_tokens + 0.1 * tokens
+    
+    def _record_cancelled(self, stream: GenerationStream) -> None:
+        generated = estimate_tokens(stream.text)
+        if stream.cancel_reason == "max_age":
+            self.stats["expired"] += 1
+        else:
+            self.stats["cancelled"] += 1
+        self.stats["tokens_generated_before_cancel"] += generated
+        # 以已完成回复的平均长度估算节省的 token
+        self.stats["tokens_saved_estimate"] += max(0, int(self._avg_reply_tokens) - generated)
+    
+    def get_stats(self, user_id: Optional[str] = None) -> dict:
+        """统计信息
+        
+        Args:
+            user_id: 只列出该用户进行中的生成（None 表示全部）
+        
+        Returns:
+            计数、进行中的生成数、各级缓冲区高水位的最大值，
+            以及进行中生成的缓冲区高水位明细
+        """
+        peak: dict[str, int] = {}
+        for stream in self.streams.values():
+            for name, size in stream.high_water.items():
+                peak[name] = max(peak.get(name, 0), size)
+        
+        in_flight = self.in_flight()
+        now = time.time()
+        return {
+            **self.stats,
+            "in_flight": len(in_flight),
+            "avg_reply_tokens": round(self._avg_reply_tokens, 1),
+            "buffer_policy": self.buffer_policy,
+            "replay_buffer": self.replay_size,
+            "high_water_peak": peak,
+            "streams": [
+                {
+                    "stream_id": s.stream_id,
+                    "session_id": s.session_id,
+                    "age": round(now - s.created_at, 1),
+                    "subscribers": s.subscribers,
+                    "frames": len(s.frames),
+                    "high_water": dict(s.high_water),
+                }
+                for s in in_flight
+                if user_id is None or s.user_id == user_id
+            ],
+        }
+    
+    def get(self, stream_id: str, user_id: str) -> Optional[GenerationStream]:
+        """获取属于指定用户的生成流"""
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.user_id != user_id:
+            return None
+        return stream
+    
+    def cancel(self, stream_id: str, user_id: str, reason: str = "client") -> bool:
+        """取消属于指定用户的进行中的生成
+        
+        Returns:
+            是否找到并取消了生成
+        """
+        stream = self.get(stream_id, user_id)
+        if stream is None or stream.done:
+            return False
+        self._cancel(stream, reason)
+        return True
+    
+    def in_flight(self) -> list[GenerationStream]:
+        """仍在运行的生成"""
+        return [s for s in self.streams.values() if not s.done]
+    
+    async def drain(self, grace: float) -> dict:
+        """停止接收新的生成，等待进行中的生成完成（最多 grace 秒），之后取消剩余的生成
+        
+        Args:
+            grace: 宽限期（秒）
+        
+        返回时被取消的生成已经保存了部分内容（取消在生成任务内完成）。
+        
+        Returns:
+            {"drained": 宽限期内完成的生成数, "aborted": 被取消的生成数, "seconds": 耗时}
+        """
+        self.draining = True
+        started = time.monotonic()
+        tasks = {s.task: s for s in self.in_flight() if s.task}
+        pending = set()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=max(0.0, grace))
+        for task in pending:
+            self._cancel(tasks[task], "shutdown")
+        if pending:
+            # 生成器链在生成任务内关闭（见 _run），任务结束时已生成的部分内容已经保存，
+            # 之后才能关闭 MCP、缓存等共享资源
+            await asyncio.gather(*pending, return_exceptions=True)
+        # 宽限期内因其他原因（例如客户端断开）被取消的生成同样计为取消
+        aborted = sum(1 for task in tasks if task.cancelled())
+        self.stats["drained"] += len(tasks) - aborted
+        self.stats["aborted"] += aborted
+        return {
+            "drained": len(tasks) - aborted,
+            "aborted": aborted,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+    
+    async def cancel_all(self) -> None:
+        """取消所有仍在运行的生成"""
+        streams = [s for s in self.in_flight() if s.task]
+        for stream in streams:
+            self._cancel(stream, "shutdown")
+        tasks = [s.task for s in streams]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.streams.clear()
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    """解析 Last-Event-ID 请求头"""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
@@ -100,7 +100,7 @@ async def main() -> None:
     if os.path.isdir(sessions_dir):
         for fn in os.listdir(sessions_dir):
             full = os.path.join(sessions_dir, fn)
-            if os.path.isdir(full):
+            if os.path.isdir(full) and not fn.startswith("."):
                 # session_id directories
                 existing.append(fn)
     session_id = None
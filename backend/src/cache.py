@@ -0,0 +1,482 @@
+"""共享缓存
+
+多个 worker 进程各自的内存缓存命中率会随 worker 数下降，
+缓存统一经过 ``caches``（进程内单例），按 api.yaml 的 ``cache`` 配置块选择后端：
+
+- ``memory``：进程内 LRU（不跨进程，单 worker 或测试使用）
+- ``sqlite``：本机 SQLite 文件（WAL 模式），同一台机器上的所有 worker 共享
+- ``redis``：Redis 协议（需要安装 ``redis`` 包），多台机器共享；
+  也可以传入兼容 redis-py 的客户端工厂（例如测试中使用 ``fakeredis.aioredis.FakeRedis``）
+
+各子系统通过命名空间使用缓存（``caches.namespace("embedding")``），键的格式为
+``{key_prefix}:{命名空间}:{标识的哈希}``，每个命名空间可以单独配置 TTL。
+值需要可以 JSON 序列化。缓存读写失败只记录警告并视为未命中，不影响请求。
+
+目前文本嵌入（RAG 检索和 mem0）通过 ``embedding_cache()`` 接入 AgentScope 的嵌入缓存接口。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from .metrics import CACHE_REQUESTS
+
+try:
+    from agentscope.embedding import EmbeddingCacheBase
+except Exception:  # pragma: no cover - allow import-time missing deps
+    EmbeddingCacheBase = object  # type: ignore
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# SQLite 后端每写入多少次清理一次过期 / 超出上限的条目
+_TRIM_EVERY = 200
+
+
+class CacheBackend(ABC):
+    """缓存后端（键为字符串，TTL 为秒，None 表示不过期）"""
+
+    name = ""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        """读取，不存在或已过期时返回 None"""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入（覆盖已有的值）"""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """删除"""
+
+    @abstractmethod
+    async def clear(self, prefix: str = "") -> int:
+        """删除以 prefix 开头的所有键，返回删除的条数"""
+
+    def get_stats(self) -> dict:
+        return {}
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """进程内 LRU（线程安全，mem0 的后台线程也可以使用）"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max(1, int(max_entries))
+        self.evictions = 0
+        self._data: OrderedDict[str, tuple[Any, Optional[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    async def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    async def clear(self, prefix: str = "") -> int:
+        with self._lock:
+            keys = [key for key in self._data if key.startswith(prefix)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def get_stats(self) -> dict:
+        return {"entries": len(self._data), "max_entries": self.max_entries, "evictions": self.evictions}
+
+
+class SQLiteCache(CacheBackend):
+    """本机共享的 SQLite 缓存（每个线程一个连接，读写在线程中执行）
+
+    超出 ``max_entries`` 时按写入时间淘汰最早的条目（读取不更新时间，避免每次命中都写入）。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str | Path, max_entries: int = 100000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max(1, int(max_entries))
+        self.entries = 0
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 连接只在创建它的线程中使用，关闭时统一由 close 处理
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _get(self, key: str) -> Optional[Any]:
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None, now),
+        )
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % _TRIM_EVERY == 1
+        if trim:
+            self._trim(conn)
+
+    def _trim(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            evicted = conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created_at LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+            self.evictions += evicted
+            count -= evicted
+        self.entries = count
+
+    def _delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _clear(self, prefix: str) -> int:
+        # 前缀中的 LIKE 通配符需要转义
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return self._conn().execute("DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'", (pattern,)).rowcount
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._delete, key)
+
+    async def clear(self, prefix: str = "") -> int:
+        return await asyncio.to_thread(self._clear, prefix)
+
+    def get_stats(self) -> dict:
+        # entries 为最近一次清理时的条目数（避免抓取指标时查询数据库）
+        return {
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "path": str(self.path),
+        }
+
+    async def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+class RedisCache(CacheBackend):
+    """Redis 协议的缓存（多台机器共享，条目上限由 Redis 的 maxmemory 策略控制）
+
+    redis.asyncio 的连接属于创建它的事件循环，mem0 在后台线程的事件循环中调用嵌入模型，
+    因此每个事件循环使用各自的客户端。
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str = "redis://localhost:6379/0", client_factory: Optional[Callable[[], Any]] = None):
+        """
+        Args:
+            url: Redis 地址
+            client_factory: 创建异步客户端的函数（默认使用 redis.asyncio.from_url）
+
+        Raises:
+            RuntimeError: 未安装 redis 包且没有传入 client_factory
+        """
+        if client_factory is None:
+            if aioredis is None:
+                raise RuntimeError("redis 缓存需要安装 redis 包（pip install redis）")
+            client_factory = lambda: aioredis.from_url(url)
+        self.url = url
+        self._client_factory = client_factory
+        self._clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any] = weakref.WeakKeyDictionary()
+
+    def _client(self) -> Any:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._client_factory()
+        return client
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self._client().get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        # EX 只接受整数秒
+        await self._client().set(key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)) if ttl else None)
+
+    async def delete(self, key: str) -> None:
+        await self._client().delete(key)
+
+    async def clear(self, prefix: str = "") -> int:
+        client = self._client()
+        deleted = 0
+        batch = []
+        async for key in client.scan_iter(match=prefix + "*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                deleted += await client.delete(*batch)
+                batch = []
+        if batch:
+            deleted += await client.delete(*batch)
+        return deleted
+
+    def get_stats(self) -> dict:
+        return {"clients": len(self._clients)}
+
+    async def close(self) -> None:
+        # 只能关闭当前事件循环的客户端，其他事件循环的客户端随循环结束释放
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def build_cache_backend(cfg: dict, base_dir: str | Path = ".") -> Optional[CacheBackend]:
+    """按 cache 配置块创建后端（backend 为 none 时返回 None）
+
+    Args:
+        cfg: cache 配置块
+        base_dir: SQLite 文件相对路径的基准目录
+
+    Raises:
+        ValueError: 未知的后端类型
+    """
+    backend = cfg.get("backend", "memory")
+    if backend in (None, "none"):
+        return None
+    if backend == "memory":
+        return MemoryCache(max_entries=cfg.get("max_entries", 10000))
+    if backend == "sqlite":
+        sqlite_cfg = cfg.get("sqlite", {}) or {}
+        return SQLiteCache(
+            Path(base_dir) / sqlite_cfg.get("path", "data/cache.db"),
+            max_entries=cfg.get("max_entries", 100000),
+        )
+    if backend == "redis":
+        return RedisCache(url=(cfg.get("redis", {}) or {}).get("url", "redis://localhost:6379/0"))
+    raise ValueError(f"未知的缓存后端: {backend}")
+
+
+class Cache:
+    """一个命名空间的缓存（通过 ``caches.namespace`` 获取）"""
+
+    def __init__(self, manager: "CacheManager", namespace: str, ttl: Optional[float]):
+        self.manager = manager
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.manager.backend is not None
+
+    def key(self, identifier: Any) -> str:
+        """标识（可以 JSON 序列化的对象）对应的键"""
+        digest = hashlib.sha256(
+            json.dumps(identifier, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+        return f"{self.prefix}{digest[:40]}"
+
+    @property
+    def prefix(self) -> str:
+        return f"{self.manager.key_prefix}:{self.namespace}:"
+
+    def _failed(self, op: str, error: Exception) -> None:
+        self.stats["errors"] += 1
+        logger.warning(f"⚠️ 缓存 {self.namespace} {op} 失败: {error}")
+
+    async def get(self, identifier: Any) -> Optional[Any]:
+        backend = self.manager.backend
+        if backend is None:
+            return None
+        try:
+            value = await backend.get(self.key(identifier))
+        except Exception as e:
+            self._failed("读取", e)
+            value = None
+        hit = value is not None
+        self.stats["hits" if hit else "misses"] += 1
+        CACHE_REQUESTS.inc(cache=self.namespace, result="hit" if hit else "miss")
+        return value
+
+    async def set(self, identifier: Any, value: Any, ttl: Optional[float] = None) -> None:
+        backend = self.manager.backend
+        if backend is None:
+            return
+        try:
+            await backend.set(self.key(identifier), value, ttl if ttl is not None else self.ttl)
+        except Exception as e:
+            self._failed("写入", e)
+            return
+        self.stats["sets"] += 1
+
+    async def delete(self, identifier: Any) -> None:
+        backend = self.manager.backend
+        if backend is None:
+            return
+        try:
+            await backend.delete(self.key(identifier))
+        except Exception as e:
+            self._failed("删除", e)
+
+    async def clear(self) -> int:
+        """删除此命名空间的所有条目"""
+        backend = self.manager.backend
+        if backend is None:
+            return 0
+        try:
+            return await backend.clear(self.prefix)
+        except Exception as e:
+            self._failed("清空", e)
+            return 0
+
+
+class CacheManager:
+    """缓存后端和各命名空间（进程内单例 ``caches``）"""
+
+    def __init__(self) -> None:
+        self.backend: Optional[CacheBackend] = None
+        self.key_prefix = "howtolive"
+        self.default_ttl: Optional[float] = None
+        self._namespace_cfg: dict[str, dict] = {}
+        self._namespaces: dict[str, Cache] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def configure(self, cfg: Optional[dict], base_dir: str | Path = ".") -> None:
+        """按 api.yaml 的 cache 配置块创建后端（已创建的命名空间继续有效）
+
+        Args:
+            cfg: cache 配置块
+            base_dir: SQLite 文件相对路径的基准目录
+        """
+        cfg = cfg or {}
+        self.backend = build_cache_backend(cfg, base_dir) if cfg.get("enabled", True) else None
+        self.key_prefix = cfg.get("key_prefix", "howtolive")
+        self.default_ttl = cfg.get("default_ttl") or None
+        self._namespace_cfg = cfg.get("namespaces") or {}
+        for name, cache in self._namespaces.items():
+            cache.ttl = self._ttl(name)
+
+    def _ttl(self, name: str) -> Optional[float]:
+        return (self._namespace_cfg.get(name) or {}).get("ttl", self.default_ttl) or None
+
+    def namespace(self, name: str) -> Cache:
+        """获取命名空间（未配置后端时读取总是未命中、写入被忽略）"""
+        cache = self._namespaces.get(name)
+        if cache is None:
+            cache = self._namespaces[name] = Cache(self, name, self._ttl(name))
+        return cache
+
+    def get_stats(self) -> dict:
+        if self.backend is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "backend": self.backend.name,
+            **self.backend.get_stats(),
+            "namespaces": {name: dict(cache.stats) for name, cache in self._namespaces.items()},
+        }
+
+    async def close(self) -> None:
+        if self.backend is not None:
+            await self.backend.close()
+
+
+# 进程内共享的缓存
+caches = CacheManager()
+
+
+class EmbeddingCache(EmbeddingCacheBase):
+    """AgentScope 嵌入缓存接口（标识包含模型名称、维度和输入文本）"""
+
+    def __init__(self, cache: Cache):
+        self.cache = cache
+
+    async def store(self, embeddings: list, identifier: Any, overwrite: bool = False, **kwargs: Any) -> None:
+        await self.cache.set(identifier, embeddings)
+
+    async def retrieve(self, identifier: Any) -> Optional[list]:
+        return await self.cache.get(identifier)
+
+    async def remove(self, identifier: Any) -> None:
+        await self.cache.delete(identifier)
+
+    async def clear(self) -> None:
+        await self.cache.clear()
+
+
+def embedding_cache() -> Optional[EmbeddingCache]:
+    """嵌入模型使用的缓存（未配置缓存后端时返回 None）"""
+    if not caches.enabled:
+        return None
+    return EmbeddingCache(caches.namespace("embedding"))
@@ -7,6 +7,18 @@ from typing import Optional
 import yaml
 
 
+@dataclass
+class RateLimitConfig:
+    enabled: bool = False
+    # Defaults applied per model name; override per model via `models`
+    max_concurrency: int = 8
+    requests_per_minute: int = 0  # 0 = unlimited
+    tokens_per_minute: int = 0  # 0 = unlimited
+    expected_output_tokens: int = 800  # reserved up front, corrected from usage
+    cooldown_on_429: float = 5.0
+    models: dict[str, dict] = field(default_factory=dict)
+
+
 @dataclass
 class LLMConfig:
     provider: str
@@ -17,6 +29,7 @@ class LLMConfig:
     timeout: int = 30
     streaming: bool = True
     enable_search: bool = True
+    rate_limits: RateLimitConfig = field(default_factory=RateLimitConfig)
 
 
 @dataclass
@@ -136,6 +149,16 @@ def load_app_config(config_dir: str = "backend/config") -> AppConfig:
     llm_raw = _load_yaml(os.path.join(config_dir, "llm.yaml")).get("llm", {})
     # env 优先覆盖
     qwen_api_key = os.getenv("QWEN_API_KEY", llm_raw.get("qwen_api_key"))
+    rl_raw = llm_raw.get("rate_limits") or {}
+    rate_limits = RateLimitConfig(
+        enabled=bool(rl_raw.get("enabled", False)),
+        max_concurrency=int(rl_raw.get("max_concurrency", 8)),
+        requests_per_minute=int(rl_raw.get("requests_per_minute", 0)),
+        tokens_per_minute=int(rl_raw.get("tokens_per_minute", 0)),
+        expected_output_tokens=int(rl_raw.get("expected_output_tokens", 800)),
+        cooldown_on_429=float(rl_raw.get("cooldown_on_429", 5.0)),
+        models=dict(rl_raw.get("models") or {}),
+    )
     llm = LLMConfig(
         provider=llm_raw.get("provider", "qwen"),
         qwen_api_key=qwen_api_key,
@@ -145,6 +168,7 @@ def load_app_config(config_dir: str = "backend/config") -> AppConfig:
         timeout=int(llm_raw.get("timeout", 30)),
         streaming=bool(llm_raw.get("streaming", True)),
         enable_search=bool(llm_raw.get("enable_search", True)),
+        rate_limits=rate_limits,
     )
 
     ltm_yaml = _load_yaml(os.path.join(config_dir, "ltm.yaml"))
@@ -0,0 +1,282 @@
+"""请求级截止时间与分阶段预算
+
+每次聊天请求创建一个 ``Deadline``，通过 ContextVar 传递到路由、Agent、工具调用、
+知识库检索和长期记忆检索。各阶段用 ``run_stage`` 执行，可用时间取该阶段的预算与
+请求剩余时间中的较小值；超出时按阶段降级，而不是让一个慢依赖耗尽整个请求：
+
+- router: 使用通用 Agent 回答
+- memory: 跳过长期记忆检索
+- rag: 不使用知识库结果回答
+- tool: 把超时作为工具结果返回给模型
+- agent: 以已生成的部分内容结束（``stream_agent_reply`` 的 timeout）
+
+各阶段的调用次数、超时次数和降级次数见 ``get_stage_stats``。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import aclosing, contextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable, Iterator, Optional
+
+try:
+    from agentscope.message import TextBlock
+    from agentscope.tool import ToolResponse
+except Exception:  # pragma: no cover - allow import-time missing deps
+    TextBlock = None  # type: ignore
+    ToolResponse = None  # type: ignore
+
+from .metrics import DEPENDENCY_SECONDS
+from .timings import record_stage, timed
+from .tracing import start_span, tracer, use_span
+
+logger = logging.getLogger(__name__)
+
+
+# 工具名称到预算阶段的映射（其余工具使用 tool 阶段）
+TOOL_STAGES = {
+    "retrieve_knowledge": "rag",
+    "retrieve_from_memory": "memory",
+}
+
+# 预算阶段到依赖名称的映射（用于 howtolive_dependency_seconds）
+_STAGE_DEPENDENCIES = {"rag": "rag", "memory": "ltm", "tool": "tool"}
+
+
+class StageTimeout(TimeoutError):
+    """阶段超出预算且没有降级方案"""
+
+    def __init__(self, stage: str, budget: float):
+        super().__init__(f"{stage} 阶段超时（{budget:.1f} 秒）")
+        self.stage = stage
+        self.budget = budget
+
+
+class Deadline:
+    """一次请求的截止时间和各阶段预算"""
+
+    def __init__(self, total: Optional[float] = None, budgets: Optional[dict] = None):
+        """
+        Args:
+            total: 整个请求的时间预算（秒），None 表示不限制
+            budgets: 各阶段的时间预算 {stage: 秒}
+        """
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + total if total else None
+        self.budgets = {k: float(v) for k, v in (budgets or {}).items() if v}
+        self.overruns: list[str] = []
+
+    @classmethod
+    def from_config(cls, cfg: Optional[dict]) -> Optional["Deadline"]:
+        """从 api.yaml 的 deadlines 配置块创建（未启用时返回 None）"""
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        return cls(total=cfg.get("total"), budgets=cfg.get("stages"))
+
+    def remaining(self) -> Optional[float]:
+        """请求剩余时间（秒）"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, stage: str) -> Optional[float]:
+        """阶段可用的时间（阶段预算与剩余时间中的较小值）"""
+        limits = [b for b in (self.budgets.get(stage), self.remaining()) if b is not None]
+        return min(limits) if limits else None
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar(
+    "howtolive_deadline", default=None
+)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """当前请求的截止时间（不在请求中时为 None）"""
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[None]:
+    """在此作用域内（包括其中创建的任务）使用指定的截止时间"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+_stage_stats: dict[str, dict[str, int]] = {}
+_MISSING = object()
+
+
+def _stats_for(stage: str) -> dict[str, int]:
+    stats = _stage_stats.get(stage)
+    if stats is None:
+        stats = _stage_stats[stage] = {"calls": 0, "overruns": 0, "degraded": 0}
+    return stats
+
+
+def record_call(stage: str) -> None:
+    """记录一次阶段调用（由自行处理超时的阶段调用）"""
+    _stats_for(stage)["calls"] += 1
+
+
+def record_overrun(stage: str, degraded: bool = True) -> None:
+    """记录一次超出预算（由自行处理超时的阶段调用，例如 Agent 流式回复）"""
+    stats = _stats_for(stage)
+    stats["overruns"] += 1
+    if degraded:
+        stats["degraded"] += 1
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.overruns.append(stage)
+
+
+async def run_stage(
+    stage: str,
+    awaitable: Awaitable[Any],
+    *,
+    fallback: Any = _MISSING,
+    attributes: Optional[dict] = None,
+) -> Any:
+    """在阶段预算内执行
+
+    Args:
+        stage: 阶段名称
+        awaitable: 要执行的协程
+        fallback: 超时后的降级结果（不提供时抛出 StageTimeout）
+        attributes: 追踪 span 的附加属性
+
+    Returns:
+        协程的结果，超时时为 fallback
+
+    Raises:
+        StageTimeout: 超时且没有降级结果
+    """
+    record_call(stage)
+    deadline = current_deadline()
+    budget = deadline.budget(stage) if deadline is not None else None
+    with start_span(f"stage.{stage}", budget=round(budget, 3) if budget is not None else None, **(attributes or {})) as span:
+        if budget is None:
+            with timed(stage):
+                return await awaitable
+
+        result = _MISSING
+        try:
+            with timed(stage):
+                async with asyncio.timeout(budget) as timeout:
+                    result = await awaitable
+        except TimeoutError:
+            pass
+        else:
+            if not timeout.expired():
+                return result
+        span.set_attributes(timed_out=True, degraded=fallback is not _MISSING)
+
+    # Agent 等调用方会自己处理取消并返回中断结果，此时 timeout 不抛出异常
+    logger.warning(f"⏱️ {stage} 阶段超出预算（{budget:.1f} 秒）")
+    record_overrun(stage, degraded=fallback is not _MISSING)
+    if fallback is not _MISSING:
+        return fallback
+    if result is not _MISSING:
+        return result
+    raise StageTimeout(stage, budget)
+
+
+async def budget_tool_middleware(
+    kwargs: dict,
+    next_handler: Callable,
+) -> AsyncGenerator[Any, None]:
+    """Toolkit 中间件：每次工具调用在对应阶段的预算内执行
+
+    工具的输出块到达即转发（流式工具不会被合并成一批）。预算作用于整个调用，
+    只在等待工具时生效（下游处理已转发的输出块的时间不计入阶段耗时），
+    span 也只在等待工具时是当前 span，不会泄漏到 yield 之后的调用方代码中。
+    超时时追加一条说明超时的工具结果，模型可以在没有该结果的情况下继续回答。
+    """
+    tool_call = kwargs["tool_call"]
+    name = tool_call.get("name")
+    stage = TOOL_STAGES.get(name, "tool")
+    record_call(stage)
+    deadline = current_deadline()
+    budget = deadline.budget(stage) if deadline is not None else None
+    expires_at = asyncio.get_running_loop().time() + budget if budget is not None else None
+    span = tracer.start_span(f"stage.{stage}", {"budget": round(budget, 3) if budget is not None else None, "tool": name})
+
+    waited = 0.0
+    timed_out = False
+    try:
+        started = time.perf_counter()
+        with use_span(span):
+            async with asyncio.timeout_at(expires_at) as timeout:
+                chunks = await next_handler(**kwargs)
+        waited += time.perf_counter() - started
+        async with aclosing(chunks) as chunks:
+            while True:
+                started = time.perf_counter()
+                with use_span(span):
+                    async with asyncio.timeout_at(expires_at) as timeout:
+                        chunk = await anext(chunks, _MISSING)
+                waited += time.perf_counter() - started
+                if chunk is not _MISSING:
+                    yield chunk
+                # 工具自行处理了取消时 timeout 不抛出异常
+                if chunk is _MISSING or timeout.expired():
+                    timed_out = timeout.expired()
+                    break
+    except TimeoutError:
+        waited += time.perf_counter() - started
+        timed_out = True
+    except Exception as e:
+        span.record_error(e)
+        raise
+    finally:
+        record_stage(stage, waited)
+        DEPENDENCY_SECONDS.observe(waited, dependency=_STAGE_DEPENDENCIES[stage], op=name)
+        if timed_out:
+            span.set_attributes(timed_out=True, degraded=True)
+        span.end()
+
+    if timed_out:
+        logger.warning(f"⏱️ {stage} 阶段超出预算（{budget:.1f} 秒）")
+        record_overrun(stage, degraded=True)
+        yield ToolResponse(
+            content=[TextBlock(type="text", text=f"工具 {name} 超时未返回结果，请在没有该结果的情况下回答用户")],
+        )
+
+
+def add_tool_budget(toolkit: Any) -> None:
+    """为 Toolkit 注册预算中间件（幂等，可用于全局共享的 Toolkit）"""
+    if toolkit is None or not hasattr(toolkit, "register_middleware"):
+        return
+    if budget_tool_middleware not in getattr(toolkit, "_middlewares", []):
+        toolkit.register_middleware(budget_tool_middleware)
+
+
+class BudgetedLongTermMemory:
+    """长期记忆检索超出 memory 预算时跳过（返回空结果）"""
+
+    def __init__(self, ltm: Any):
+        self._ltm = ltm
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._ltm, name)
+
+    async def retrieve(self, *args, **kwargs) -> Any:
+        return await run_stage("memory", self._ltm.retrieve(*args, **kwargs), fallback="")
+
+
+def wrap_with_budget(ltm: Any) -> Any:
+    """为长期记忆实例添加检索预算（None 原样返回）"""
+    if ltm is None or isinstance(ltm, BudgetedLongTermMemory):
+        return ltm
+    return BudgetedLongTermMemory(ltm)
+
+
+def get_stage_stats() -> dict:
+    """各阶段的调用次数、超时次数和降级次数"""
+    return {stage: dict(stats) for stage, stats in _stage_stats.items()}
@@ -8,6 +8,7 @@ try:
 except Exception:
     DashScopeTextEmbedding = None  # type: ignore
 
+from .cache import embedding_cache
 from .config import LTMConfig, LLMConfig
 
 
@@ -35,6 +36,7 @@ def build_text_embedding(ltm_cfg: LTMConfig | None, fallback_llm: LLMConfig) ->
     return DashScopeTextEmbedding(
         model_name=ltm_cfg.embedding.model_name,
         api_key=api_key,
+        embedding_cache=embedding_cache(),
     )
 
 
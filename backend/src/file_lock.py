@@ -0,0 +1,102 @@
+"""跨进程文件锁
+
+多个 worker 进程（``HOWTOLIVE_WORKERS``，见 API 指南）共享 ``.sessions/`` 目录，
+时间线追加是"读取 - 修改 - 写回"，两个进程同时写同一会话会丢失其中一方的事件。
+会话文件的读写都在该会话的锁文件（``.locks/{session_id}.lock``，放在会话目录之外）上加建议锁
+（POSIX ``flock`` / Windows ``msvcrt.locking``）。
+
+- 每次加锁都重新打开锁文件，同一进程内的两个协程 / 线程之间同样互斥
+- 异步加锁以非阻塞方式轮询，等待期间不阻塞事件循环
+- 超时抛出 ``LockTimeout``，持有锁的进程崩溃时由操作系统释放锁
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# 轮询间隔（秒）
+_POLL_INTERVAL = 0.01
+
+
+class LockTimeout(TimeoutError):
+    """在超时时间内未能获得文件锁"""
+
+
+class FileLock:
+    """基于锁文件的独占锁（支持 ``with`` 和 ``async with``）"""
+
+    def __init__(self, path: str | Path, timeout: float = 10.0):
+        """
+        Args:
+            path: 锁文件路径（不存在时创建，父目录需要已存在）
+            timeout: 等待锁的最长时间（秒）
+        """
+        self.path = str(path)
+        self.timeout = timeout
+        self._fd: Optional[int] = None
+
+    def _try_acquire(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def acquire(self) -> None:
+        """同步加锁（阻塞当前线程，不要在事件循环中调用）"""
+        deadline = time.monotonic() + self.timeout
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                raise LockTimeout(f"等待文件锁超时: {self.path}")
+            time.sleep(_POLL_INTERVAL)
+
+    async def acquire_async(self) -> None:
+        """异步加锁（轮询期间让出事件循环）"""
+        deadline = time.monotonic() + self.timeout
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                raise LockTimeout(f"等待文件锁超时: {self.path}")
+            await asyncio.sleep(_POLL_INTERVAL)
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    async def __aenter__(self) -> "FileLock":
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
@@ -0,0 +1,284 @@
+"""日志管道
+
+所有日志记录先进入内存队列（``QueueHandler``），由后台线程（``QueueListener``）
+格式化并写入控制台 / 文件，事件循环中记录日志不会因为 stdout 或磁盘阻塞。
+
+- 结构化：``format: json`` 时每行一个 JSON 对象，包含请求 ID、会话 ID、用户 ID 和 trace ID
+  （通过 ``log_context`` 在请求中设置，记录日志时从 ContextVar 读取）
+- 采样 / 限流：按 logger 名称前缀配置，INFO 及以下的记录按比例采样，
+  所有级别都受每秒条数限制，被丢弃的条数见 ``howtolive_log_records_dropped_total``
+- 队列满时直接丢弃新记录，而不是阻塞调用方
+
+未配置（``log_pipeline.configure``）时日志行为与标准库默认一致。
+"""
+
+from __future__ import annotations
+
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from .tracing import current_span
+
+# 请求级日志字段（request_id / session_id / user_id）
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("howtolive_log_context", default={})
+
+# 标准 LogRecord 属性之外附加到 JSON 中的字段
+_CONTEXT_FIELDS = ("request_id", "session_id", "user_id", "trace_id")
+
+# 在调用方线程中格式化异常
+_EXC_FORMATTER = logging.Formatter()
+
+# 默认的日志格式（与原来的 basicConfig 一致）
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """在此作用域内（包括其中创建的任务）的日志附加字段"""
+    token = _log_context.set({**_log_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """把请求上下文写入日志记录（在记录日志的线程中执行，进入队列之前）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            setattr(record, key, value)
+        span = current_span()
+        if span.recording:
+            record.trace_id = span.trace.trace_id
+        return True
+
+
+class _Limit:
+    """一个 logger 前缀的采样率和令牌桶"""
+
+    def __init__(self, prefix: str, sample: float = 1.0, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.prefix = prefix
+        self.sample = sample
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0) * 2
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.dropped = {"sampled": 0, "rate_limited": 0}
+
+    def allow(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and self.sample < 1.0 and random.random() >= self.sample:
+            self.dropped["sampled"] += 1
+            return False
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped["rate_limited"] += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """按 logger 名称前缀采样和限流（匹配最长的前缀）"""
+
+    def __init__(self, limits: dict[str, dict]):
+        super().__init__()
+        self.limits = sorted(
+            (
+                _Limit(
+                    prefix,
+                    sample=float(cfg.get("sample", 1.0)),
+                    rate=float(cfg["rate"]) if cfg.get("rate") else None,
+                    burst=float(cfg["burst"]) if cfg.get("burst") else None,
+                )
+                for prefix, cfg in limits.items()
+            ),
+            key=lambda limit: len(limit.prefix),
+            reverse=True,
+        )
+        self._lock = threading.Lock()
+
+    def _match(self, name: str) -> Optional[_Limit]:
+        for limit in self.limits:
+            if name == limit.prefix or name.startswith(limit.prefix + "."):
+                return limit
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        limit = self._match(record.name)
+        if limit is None:
+            return True
+        with self._lock:
+            return limit.allow(record)
+
+    def dropped(self) -> dict[str, dict[str, int]]:
+        """{前缀: {原因: 条数}}"""
+        return {limit.prefix: dict(limit.dropped) for limit in self.limits}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in _CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+class TextFormatter(logging.Formatter):
+    """原来的文本格式，末尾附加请求 ID 和会话 ID"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        if request_id is None:
+            return text
+        session_id = getattr(record, "session_id", None) or "-"
+        return f"{text} [req={request_id} session={session_id[:8]}]"
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录（不阻塞调用方）"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 在调用方线程中合并消息参数、格式化异常（参数和 traceback 可能随后被修改或释放），
+        # 异常文本单独保留在 exc_text 中，由后台线程的格式化器决定如何输出
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """日志管道（进程内单例 ``log_pipeline``）"""
+
+    def __init__(self) -> None:
+        self.configured = False
+        self._handler: Optional[_QueueHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._limits: Optional[RateLimitFilter] = None
+
+    def configure(self, cfg: Optional[dict], base_dir: str | Path = ".") -> None:
+        """按 api.yaml 的 logging 配置块替换根 logger 的处理器
+
+        Args:
+            cfg: logging 配置块
+            base_dir: 日志文件相对路径的基准目录
+        """
+        cfg = cfg or {}
+        self.shutdown()
+
+        formatter = JsonFormatter() if cfg.get("format", "text") == "json" else TextFormatter(TEXT_FORMAT)
+        handlers: list[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+        file_cfg = cfg.get("file") or {}
+        if file_cfg.get("path"):
+            path = Path(base_dir) / file_cfg["path"]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            handlers.append(logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=int(file_cfg.get("max_bytes", 10 * 1024 * 1024)),
+                backupCount=int(file_cfg.get("backup_count", 5)),
+                encoding="utf-8",
+            ))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self._handler = _QueueHandler(queue.Queue(maxsize=int(cfg.get("queue_size", 10000))))
+        self._handler.addFilter(ContextFilter())
+        self._limits = RateLimitFilter(cfg.get("limits") or {})
+        self._handler.addFilter(self._limits)
+        self._listener = logging.handlers.QueueListener(
+            self._handler.queue, *handlers, respect_handler_level=True
+        )
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(cfg.get("level", "INFO"))
+
+        # uvicorn 的 logger 自带处理器且不向上传播，改为经过队列输出
+        if cfg.get("capture_uvicorn", True):
+            for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+                uvicorn_logger = logging.getLogger(name)
+                uvicorn_logger.handlers.clear()
+                uvicorn_logger.propagate = True
+
+        for name, level in (cfg.get("levels") or {}).items():
+            logging.getLogger(name).setLevel(level)
+
+        # 调试模式：输出请求各步骤的详细日志
+        if cfg.get("debug", False):
+            for name in cfg.get("debug_loggers") or ["backend", "LTM"]:
+                logging.getLogger(name).setLevel(logging.DEBUG)
+
+        self._listener.start()
+        self.configured = True
+
+    def get_stats(self) -> dict:
+        """队列长度和被丢弃的记录数"""
+        if not self.configured:
+            return {"configured": False}
+        return {
+            "configured": True,
+            "queued": self._handler.queue.qsize(),
+            "dropped_queue_full": self._handler.dropped,
+            "dropped": self._limits.dropped(),
+        }
+
+    def shutdown(self) -> None:
+        """输出队列中剩余的记录并停止后台线程"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        if self._handler is not None:
+            logging.getLogger().removeHandler(self._handler)
+            self._handler = None
+        self.configured = False
+
+
+# 进程内共享的日志管道
+log_pipeline = LogPipeline()
@@ -12,6 +12,7 @@ except Exception:
 
 from .config import LTMConfig, LLMConfig
 from .embedding_factory import build_text_embedding
+from .rate_governor import Priority, wrap_with_rate_limit
 
 
 def _resolve_api_key(env_name: str | None, fallback_key: str | None) -> str | None:
@@ -51,6 +52,8 @@ def build_mem0_long_term_memory(
         api_key=api_key,
         stream=bool(chat_cfg.stream),
     )
+    # Memory extraction shares the global LLM quota but yields to interactive turns
+    chat_model = wrap_with_rate_limit(chat_model, fallback_llm.rate_limits, priority=Priority.BACKGROUND)
 
     # Embedding model
     embedding_model = build_text_embedding(ltm_cfg, fallback_llm)
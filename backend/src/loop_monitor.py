@@ -0,0 +1,244 @@
+"""事件循环延迟监控
+
+异步路径中的同步调用（SQLite、JSON 文件读写、读取提示词文件等）会阻塞事件循环，
+期间所有并发的流都会停顿。监控器由两部分组成：
+
+- 心跳任务：每隔 ``interval`` 秒唤醒一次，实际唤醒时间与预期的差即为事件循环延迟，
+  记录到 ``howtolive_event_loop_lag_seconds``
+- 看门狗线程：心跳超过 ``threshold`` 未唤醒时，抓取事件循环线程当前的调用栈，
+  按项目代码中最内层的调用位置归类，累计阻塞次数和时间
+
+可选开启 asyncio 调试模式（``slow_callbacks``），额外记录 asyncio 报告的慢回调。
+阻塞最多的位置通过 ``/api/admin/event-loop`` 查看。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from .metrics import LOOP_LAG, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+# 项目根目录（归类调用位置时优先使用项目内的栈帧）
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _is_project_frame(frame: traceback.FrameSummary) -> bool:
+    filename = os.path.abspath(frame.filename)
+    return filename.startswith(_PROJECT_ROOT) and "site-packages" not in filename
+
+
+def _location(frame: traceback.FrameSummary) -> str:
+    filename = os.path.relpath(frame.filename, _PROJECT_ROOT) if _is_project_frame(frame) else frame.filename
+    return f"{filename}:{frame.lineno} in {frame.name}"
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """收集 asyncio 调试模式报告的慢回调（"Executing ... took ... seconds"）"""
+
+    def __init__(self, monitor: "LoopMonitor"):
+        super().__init__(level=logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.startswith("Executing "):
+            self.monitor.slow_callbacks.append({"at": record.created, "message": message[:500]})
+
+
+class LoopMonitor:
+    """事件循环延迟监控器"""
+
+    def __init__(
+        self,
+        interval: float = 0.05,
+        threshold: float = 0.1,
+        stack_limit: int = 30,
+        max_offenders: int = 100,
+        slow_callbacks: bool = False,
+        log_interval: float = 60.0,
+    ):
+        """
+        Args:
+            interval: 心跳间隔（秒）
+            threshold: 延迟超过该值（秒）视为阻塞，抓取调用栈
+            stack_limit: 保留的调用栈深度
+            max_offenders: 最多记录的阻塞位置数（超出时丢弃累计时间最少的）
+            slow_callbacks: 是否开启 asyncio 调试模式记录慢回调（有额外开销）
+            log_interval: 同一位置的阻塞警告日志的最小间隔（秒）
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_limit = stack_limit
+        self.max_offenders = max_offenders
+        self.enable_slow_callbacks = slow_callbacks
+        self.log_interval = log_interval
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._slow_handler: Optional[_SlowCallbackHandler] = None
+
+        self._tick = 0
+        self._expected_at = time.monotonic()
+        self._captured: Optional[tuple[int, list[traceback.FrameSummary]]] = None  # (心跳序号, 调用栈)
+        self._offenders: dict[str, dict] = {}
+        self._last_logged: dict[str, float] = {}
+        self.recent: deque = deque(maxlen=20)
+        self.slow_callbacks: deque = deque(maxlen=50)
+        self.stats = {"stalls": 0, "stall_seconds": 0.0, "max_lag": 0.0, "last_lag": 0.0}
+
+    @classmethod
+    def from_config(cls, cfg: dict | None) -> Optional["LoopMonitor"]:
+        """从 api.yaml 的 loop_monitor 配置块创建（未启用时返回 None）"""
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        return cls(
+            interval=float(cfg.get("interval", 0.05)),
+            threshold=float(cfg.get("threshold", 0.1)),
+            stack_limit=int(cfg.get("stack_limit", 30)),
+            max_offenders=int(cfg.get("max_offenders", 100)),
+            slow_callbacks=bool(cfg.get("slow_callbacks", False)),
+        )
+
+    async def start(self) -> None:
+        """在当前事件循环中启动心跳任务和看门狗线程"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._expected_at = time.monotonic() + self.interval
+        self._task = self._loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+        if self.enable_slow_callbacks:
+            self._loop.slow_callback_duration = self.threshold
+            self._loop.set_debug(True)
+            self._slow_handler = _SlowCallbackHandler(self)
+            logging.getLogger("asyncio").addHandler(self._slow_handler)
+
+    async def stop(self) -> None:
+        """停止监控"""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        if self._slow_handler is not None:
+            logging.getLogger("asyncio").removeHandler(self._slow_handler)
+            self._loop.set_debug(False)
+            self._slow_handler = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self._expected_at)
+            LOOP_LAG.observe(lag)
+            self.stats["last_lag"] = lag
+            self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+            if lag >= self.threshold:
+                self._on_stall(lag)
+            self._tick += 1
+
+    def _watchdog(self) -> None:
+        # 以阈值的一半为周期检查，阻塞期间只抓取一次调用栈
+        period = max(0.01, self.threshold / 2)
+        while not self._stop.wait(period):
+            tick = self._tick
+            if time.monotonic() - self._expected_at < self.threshold:
+                continue
+            with self._lock:
+                if self._captured is not None and self._captured[0] == tick:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=self.stack_limit)
+            with self._lock:
+                self._captured = (tick, stack)
+
+    def _on_stall(self, lag: float) -> None:
+        with self._lock:
+            captured = self._captured
+            self._captured = None
+        stack = captured[1] if captured is not None and captured[0] == self._tick else []
+
+        # 按项目代码中最内层的栈帧归类（阻塞通常发生在第三方库 / 标准库内部）
+        frame = next((f for f in reversed(stack) if _is_project_frame(f)), stack[-1] if stack else None)
+        location = _location(frame) if frame is not None else "unknown（阻塞时间短于看门狗周期）"
+        formatted = [line.rstrip() for line in traceback.format_list(stack)]
+
+        LOOP_STALLS.inc()
+        self.stats["stalls"] += 1
+        self.stats["stall_seconds"] += lag
+        now = time.time()
+        with self._lock:
+            offender = self._offenders.get(location)
+            if offender is None:
+                if len(self._offenders) >= self.max_offenders:
+                    least = min(self._offenders, key=lambda k: self._offenders[k]["total_seconds"])
+                    del self._offenders[least]
+                offender = self._offenders[location] = {
+                    "location": location, "count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "stack": [],
+                }
+            offender["count"] += 1
+            offender["total_seconds"] += lag
+            offender["max_seconds"] = max(offender["max_seconds"], lag)
+            offender["last_seen"] = now
+            if formatted:
+                offender["stack"] = formatted
+        self.recent.append({"at": now, "lag_seconds": round(lag, 4), "location": location})
+
+        if now - self._last_logged.get(location, 0.0) >= self.log_interval:
+            self._last_logged[location] = now
+            logger.warning(f"🐢 事件循环阻塞 {lag * 1000:.0f} ms: {location}")
+
+    def top_offenders(self, limit: int = 10) -> list[dict]:
+        """累计阻塞时间最多的位置"""
+        with self._lock:
+            offenders = sorted(self._offenders.values(), key=lambda o: o["total_seconds"], reverse=True)[:limit]
+            return [
+                {**o, "total_seconds": round(o["total_seconds"], 4), "max_seconds": round(o["max_seconds"], 4)}
+                for o in offenders
+            ]
+
+    def get_stats(self) -> dict:
+        """延迟统计"""
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "stalls": self.stats["stalls"],
+            "stall_seconds": round(self.stats["stall_seconds"], 4),
+            "max_lag": round(self.stats["max_lag"], 4),
+            "last_lag": round(self.stats["last_lag"], 4),
+            "slow_callbacks_enabled": self.enable_slow_callbacks,
+        }
+
+    def get_report(self, limit: int = 10) -> dict:
+        """调试报告（统计、阻塞最多的位置、最近的阻塞和慢回调）"""
+        return {
+            **self.get_stats(),
+            "top_offenders": self.top_offenders(limit),
+            "recent_stalls": list(self.recent),
+            "slow_callbacks": list(self.slow_callbacks),
+        }
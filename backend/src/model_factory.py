@@ -11,6 +11,8 @@ except Exception as e:  # pragma: no cover - allow import-time missing deps
     DashScopeChatFormatter = None  # type: ignore
 
 from .config import LLMConfig
+from .rate_governor import wrap_with_rate_limit
+from .streaming import wrap_with_streaming
 
 
 class ModelBundle:
@@ -38,6 +40,9 @@ def build_chat_model(llm: LLMConfig, *, force_stream: bool | None = None) -> Mod
         stream=stream,
     )
     formatter = DashScopeChatFormatter()
-    return ModelBundle(model=model, formatter=formatter)
+    # Shared concurrency / rpm / tpm limits across all agents (llm.yaml rate_limits)
+    model = wrap_with_rate_limit(model, llm.rate_limits)
+    # 包装后可通过 streaming.stream_agent_reply 直接获取增量事件
+    return ModelBundle(model=wrap_with_streaming(model), formatter=formatter)
 
 
@@ -0,0 +1,415 @@
+"""按需采样分析器
+
+不需要重启进程，也不依赖第三方 profiler，结果为折叠栈格式
+（``帧1;帧2;帧3 次数``），可直接交给 flamegraph.pl / speedscope / Pyroscope 生成火焰图。
+
+事件循环（主线程）通过 SIGPROF 定时器采样：信号处理函数在主线程的字节码之间执行，
+拿到的就是正在执行的帧。从其他线程读取 ``sys._current_frames()`` 的方式只能在
+事件循环释放 GIL（通常是 select）时取样，会把繁忙的事件循环误报为空闲，因此只用于
+其他线程，以及不支持 SIGPROF（Windows、事件循环不在主线程）时的回退。
+
+两种模式：
+
+- 进程采样（``Profiler.profile_process``）：在限定时长内采样所有线程（或只采样事件循环线程）
+- 单次请求采样（``Profiler.start_task_profile``）：只在事件循环正在执行指定任务
+  及其创建的子任务（Agent 任务、工具调用等）时采样，用于分析一次聊天请求的完整流程；
+  通过线程池执行的调用（例如 mem0）不计入
+
+采样的是正在执行（非等待）的调用栈，近似反映 CPU 时间的去向。
+SIGPROF 定时器是进程级的，每个进程同时只进行一次采样（两种模式共用），已有采样时抛出 ``ProfilerBusy``。
+结果保存为 ``<profile_id>.folded``，只保留最近的 ``keep`` 个。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+# 项目根目录（项目内的帧显示相对路径）
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 线程在等待（而不是执行）时栈顶所在的模块
+_IDLE_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+_PROFILE_ID = re.compile(r"^[0-9]{8}-[0-9]{6}-[a-z]+-[0-9a-f]{8}$")
+
+_labels: dict = {}
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        if filename.startswith(_PROJECT_ROOT) and "site-packages" not in filename:
+            filename = os.path.relpath(filename, _PROJECT_ROOT)
+        else:
+            filename = os.path.basename(filename)
+        label = _labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    return label
+
+
+def _stack(frame, max_depth: int) -> tuple[str, ...]:
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
+
+
+def _is_idle(frame) -> bool:
+    return os.path.basename(frame.f_code.co_filename) in _IDLE_FILES
+
+
+class ProfilerBusy(Exception):
+    """已有采样正在进行"""
+
+
+# 每个进程同时只进行一次采样
+_slot = threading.Lock()
+
+
+class ProfileSlot:
+    """采样占用（由 ``Profiler.reserve`` 获得，release 可以重复调用）"""
+
+    def __init__(self) -> None:
+        self._held = True
+
+    def release(self) -> None:
+        if self._held:
+            self._held = False
+            _slot.release()
+
+
+class Profile:
+    """一次采样的结果"""
+
+    def __init__(self, kind: str, interval: float):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{uuid.uuid4().hex[:8]}"
+        self.kind = kind
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.samples: Counter = Counter()
+
+    @property
+    def total(self) -> int:
+        return sum(self.samples.values())
+
+    def collapsed(self) -> str:
+        """折叠栈格式（按次数降序）"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
+
+    def top_functions(self, limit: int = 20) -> list[dict]:
+        """采样次数最多的函数（self: 位于栈顶，total: 出现在栈中）"""
+        own: Counter = Counter()
+        cumulative: Counter = Counter()
+        for stack, count in self.samples.items():
+            if not stack:
+                continue
+            own[stack[-1]] += count
+            for label in set(stack):
+                cumulative[label] += count
+        total = self.total or 1
+        return [
+            {
+                "function": label,
+                "self": own[label],
+                "total": cumulative[label],
+                "self_percent": round(own[label] * 100 / total, 1),
+            }
+            for label, _ in own.most_common(limit)
+        ]
+
+    def summary(self, limit: int = 10) -> dict:
+        """摘要（不含完整的折叠栈）"""
+        return {
+            "profile_id": self.id,
+            "kind": self.kind,
+            "duration": round(self.duration, 3),
+            "interval": self.interval,
+            "samples": self.total,
+            "top_functions": self.top_functions(limit),
+        }
+
+
+class _SignalSampler:
+    """SIGPROF 定时采样主线程（按进程 CPU 时间触发，多个采样共用一个定时器）"""
+
+    def __init__(self) -> None:
+        self.callbacks: list = []
+        self._previous = None
+
+    @staticmethod
+    def available() -> bool:
+        """当前线程能否使用（需要在主线程中安装信号处理函数）"""
+        return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+    def add(self, callback, interval: float) -> None:
+        if not self.callbacks:
+            self._previous = signal.signal(signal.SIGPROF, self._handle)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        self.callbacks.append(callback)
+
+    def remove(self, callback) -> None:
+        if callback not in self.callbacks:
+            return
+        self.callbacks.remove(callback)
+        if not self.callbacks:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            # 默认处理方式会终止进程，没有原处理函数时忽略之后到达的信号
+            signal.signal(signal.SIGPROF, self._previous if callable(self._previous) else signal.SIG_IGN)
+
+    def _handle(self, signum, frame) -> None:
+        if frame is None:
+            return
+        for callback in list(self.callbacks):
+            callback(frame)
+
+
+_signal_sampler = _SignalSampler()
+
+
+class TaskProfile:
+    """单个任务（及其子任务）的采样"""
+
+    def __init__(self, profiler: "Profiler", task: asyncio.Task, slot: ProfileSlot):
+        self.profiler = profiler
+        self.slot = slot
+        self.profile = Profile("request", profiler.interval)
+        self.tasks: weakref.WeakSet = weakref.WeakSet([task])
+        self._loop = task.get_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._use_signal = _SignalSampler.available()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self) -> None:
+        _install_task_factory(self)
+        if self._use_signal:
+            _signal_sampler.add(self._on_signal, self.profiler.interval)
+        else:
+            self._thread = threading.Thread(target=self._run, name="task-profiler", daemon=True)
+            self._thread.start()
+
+    def _on_signal(self, frame) -> None:
+        if asyncio.tasks._current_tasks.get(self._loop) in self.tasks:
+            self.profile.samples[_stack(frame, self.profiler.max_depth)] += 1
+
+    def _run(self) -> None:
+        current_tasks = asyncio.tasks._current_tasks
+        while not self._stop.wait(self.profiler.interval):
+            if current_tasks.get(self._loop) not in self.tasks:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self.profile.samples[_stack(frame, self.profiler.max_depth)] += 1
+
+    async def stop(self) -> Profile:
+        """停止采样并保存结果（可以重复调用）"""
+        if not self._stop.is_set():
+            self._stop.set()
+            _uninstall_task_factory(self)
+            if self._use_signal:
+                _signal_sampler.remove(self._on_signal)
+            self.slot.release()
+            self.profile.duration = time.time() - self.profile.started_at
+            if self._thread is not None:
+                await asyncio.to_thread(self._thread.join, 1.0)
+            await asyncio.to_thread(self.profiler.save, self.profile)
+        return self.profile
+
+
+# 进行中的单次请求采样（任务工厂把子任务加入父任务所在的采样）
+_task_profiles: set[TaskProfile] = set()
+
+
+def _task_factory(loop, coro, context=None):
+    task = asyncio.Task(coro, loop=loop, context=context)
+    parent = asyncio.current_task(loop)
+    if parent is not None:
+        for session in list(_task_profiles):
+            if parent in session.tasks:
+                session.tasks.add(task)
+    return task
+
+
+def _install_task_factory(session: TaskProfile) -> None:
+    _task_profiles.add(session)
+    if session._loop.get_task_factory() is None:
+        session._loop.set_task_factory(_task_factory)
+
+
+def _uninstall_task_factory(session: TaskProfile) -> None:
+    _task_profiles.discard(session)
+    if not _task_profiles and session._loop.get_task_factory() is _task_factory:
+        session._loop.set_task_factory(None)
+
+
+class Profiler:
+    """采样分析器"""
+
+    def __init__(
+        self,
+        interval: float = 0.005,
+        max_duration: float = 60.0,
+        output_dir: Optional[str | Path] = None,
+        keep: int = 20,
+        max_depth: int = 128,
+    ):
+        """
+        Args:
+            interval: 采样间隔（秒）
+            max_duration: 进程采样的最长时间（秒）
+            output_dir: 保存折叠栈文件的目录（None 表示不保存）
+            keep: 保留的结果文件数
+            max_depth: 调用栈的最大深度
+        """
+        self.interval = interval
+        self.max_duration = max_duration
+        self.output_dir = Path(output_dir) if output_dir else None
+        self.keep = keep
+        self.max_depth = max_depth
+
+    @classmethod
+    def from_config(cls, cfg: dict | None, base_dir: str | Path = ".") -> Optional["Profiler"]:
+        """从 api.yaml 的 profiling 配置块创建（未启用时返回 None）"""
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        return cls(
+            interval=float(cfg.get("interval", 0.005)),
+            max_duration=float(cfg.get("max_duration", 60)),
+            output_dir=Path(base_dir) / cfg.get("path", "data/profiles"),
+            keep=int(cfg.get("keep", 20)),
+        )
+
+    def reserve(self) -> ProfileSlot:
+        """占用本进程的采样（开始采样前调用，用于提前拒绝）
+
+        Raises:
+            ProfilerBusy: 已有采样正在进行
+        """
+        if not _slot.acquire(blocking=False):
+            raise ProfilerBusy("已有采样正在进行")
+        return ProfileSlot()
+
+    async def profile_process(
+        self,
+        duration: float,
+        loop_only: bool = False,
+        include_idle: bool = False,
+    ) -> Profile:
+        """在限定时长内采样整个进程（不阻塞事件循环）
+
+        Args:
+            duration: 采样时长（秒，不超过 max_duration）
+            loop_only: 只采样事件循环线程
+            include_idle: 是否包含等待中的线程（selector、锁、队列）
+
+        Raises:
+            ProfilerBusy: 已有采样正在进行
+        """
+        slot = self.reserve()
+        profile = Profile("process", self.interval)
+        duration = min(duration, self.max_duration)
+
+        def on_signal(frame) -> None:
+            if include_idle or not _is_idle(frame):
+                profile.samples[("thread:MainThread",) + _stack(frame, self.max_depth)] += 1
+
+        loop_thread_id = threading.get_ident()
+        use_signal = _SignalSampler.available()
+        if use_signal:
+            _signal_sampler.add(on_signal, self.interval)
+        try:
+            if use_signal and loop_only:
+                await asyncio.sleep(duration)
+            else:
+                await asyncio.to_thread(
+                    self._sample_threads,
+                    profile,
+                    duration,
+                    only=loop_thread_id if loop_only else None,
+                    skip=loop_thread_id if use_signal else None,
+                    include_idle=include_idle,
+                )
+        finally:
+            if use_signal:
+                _signal_sampler.remove(on_signal)
+            slot.release()
+        profile.duration = duration
+        await asyncio.to_thread(self.save, profile)
+        return profile
+
+    def _sample_threads(
+        self,
+        profile: Profile,
+        duration: float,
+        only: Optional[int],
+        skip: Optional[int],
+        include_idle: bool,
+    ) -> None:
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident in (own_id, skip) or (only is not None and ident != only):
+                    continue
+                if not include_idle and _is_idle(frame):
+                    continue
+                profile.samples[(f"thread:{names.get(ident, ident)}",) + _stack(frame, self.max_depth)] += 1
+            time.sleep(self.interval)
+
+    def start_task_profile(self, slot: Optional[ProfileSlot] = None) -> TaskProfile:
+        """开始采样当前任务（必须在事件循环中调用），结束时 ``await session.stop()``
+
+        Args:
+            slot: 已通过 reserve 占用的采样（None 表示在这里占用）
+
+        Raises:
+            ProfilerBusy: 未传入 slot 且已有采样正在进行
+        """
+        session = TaskProfile(self, asyncio.current_task(), slot or self.reserve())
+        session._start()
+        return session
+
+    def save(self, profile: Profile) -> Optional[Path]:
+        """保存折叠栈文件并清理旧文件"""
+        if self.output_dir is None:
+            return None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / f"{profile.id}.folded"
+        path.write_text(profile.collapsed(), encoding="utf-8")
+
+        files = sorted(self.output_dir.glob("*.folded"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for old in files[self.keep:]:
+            old.unlink(missing_ok=True)
+        return path
+
+    def load(self, profile_id: str) -> Optional[str]:
+        """读取已保存的折叠栈（不存在时返回 None）"""
+        if self.output_dir is None or not _PROFILE_ID.match(profile_id):
+            return None
+        path = self.output_dir / f"{profile_id}.folded"
+        if not path.exists():
+            return None
+        return path.read_text(encoding="utf-8")
+
+    def list_profiles(self) -> list[dict]:
+        """已保存的结果（新的在前）"""
+        if self.output_dir is None or not self.output_dir.exists():
+            return []
+        files = sorted(self.output_dir.glob("*.folded"), key=lambda p: p.stat().st_mtime, reverse=True)
+        return [{"profile_id": p.stem, "size": p.stat().st_size, "created_at": p.stat().st_mtime} for p in files]
@@ -15,6 +15,8 @@ from agentscope.rag import SimpleKnowledge, QdrantStore, Document
 from agentscope.embedding import DashScopeTextEmbedding, DashScopeMultiModalEmbedding
 from agentscope.tool import Toolkit
 
+from .cache import embedding_cache
+
 if TYPE_CHECKING:
     from .config import RAGConfig, RAGAgentConfig
 
@@ -224,6 +226,7 @@ class RAGManager:
                 api_key=api_key,
                 model_name=emb_cfg.model_name,
                 dimensions=emb_cfg.dimensions,
+                embedding_cache=embedding_cache(),
             )
             print(f"[RAG]   ✓ 文本嵌入模型已创建: {emb_cfg.model_name}")
         
@@ -234,6 +237,7 @@ class RAGManager:
                 api_key=api_key,
                 model_name=mm_emb_cfg.model_name,
                 dimensions=mm_emb_cfg.dimensions,
+                embedding_cache=embedding_cache(),
             )
             print(f"[RAG]   ✓ 多模态嵌入模型已创建: {mm_emb_cfg.model_name}")
     
@@ -0,0 +1,413 @@
+"""全局模型限流
+
+所有 Agent、路由和 mem0 的模型调用共享同一个限流器，按模型名称分别计算：
+
+- 并发上限（信号量）：超出时按优先级排队
+- 每分钟请求数 / token 数（令牌桶）：调用前按估算预留，完成后按实际用量修正
+- 收到限流错误（429）后短暂暂停该模型的新调用，避免各处独立重试加剧限流
+
+优先级通过 ContextVar 传递（``priority_scope``），交互式对话优先于
+mem0 记忆提取和批量任务。mem0 的模型调用运行在 AgentScope 的后台事件循环线程中，
+因此限流器的状态用线程锁保护，等待者通过各自的事件循环唤醒。
+
+多 worker 部署时每个进程各自限流，配置的限额按 worker 数平分（``set_workers``）。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import heapq
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from itertools import count
+from typing import Any, Iterator, Optional
+
+from .config import RateLimitConfig
+from .streaming import estimate_tokens
+
+try:
+    from agentscope.model import ChatModelBase
+except Exception:  # pragma: no cover - allow import-time missing deps
+    ChatModelBase = object  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """调用优先级（数值越小越优先）"""
+    INTERACTIVE = 0  # 用户正在等待的对话
+    BACKGROUND = 1  # mem0 记忆提取等后台操作
+    BATCH = 2  # 批量任务
+
+
+_current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "howtolive_llm_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def priority_scope(priority: Priority) -> Iterator[None]:
+    """在此作用域内（包括其中创建的任务）发起的模型调用使用指定优先级"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class _TokenBucket:
+    """每分钟配额的令牌桶（允许透支，透支部分由后续调用等待偿还）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """预留 amount，返回需要等待的秒数"""
+        self._refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def adjust(self, amount: float, now: float) -> None:
+        """修正预留量（正数为退还，负数为补扣）"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ModelGovernor:
+    """单个模型的限流器"""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 8,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        cooldown_on_429: float = 5.0,
+    ):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.cooldown_on_429 = cooldown_on_429
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._cooldown_until = 0.0
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._seq = count()
+
+        self.stats = {
+            "calls": 0,
+            "queued": 0,  # 需要等待的调用数
+            "throttled": 0,  # 收到限流错误的调用数
+            "tokens": 0,
+        }
+        self._wait_stats = {p.name.lower(): {"count": 0, "total": 0.0, "max": 0.0} for p in Priority}
+
+    async def acquire(self, tokens: int, priority: Priority) -> float:
+        """获取调用许可（并发槽位 + 速率配额）
+
+        Returns:
+            排队等待的秒数
+        """
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = None
+        with self._lock:
+            if self._in_flight < self.max_concurrency and not self._waiters:
+                self._in_flight += 1
+            else:
+                future = loop.create_future()
+                heapq.heappush(self._waiters, (int(priority), next(self._seq), loop, future))
+
+        if future is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                # 槽位已经转交给本调用时需要归还
+                if future.done() and not future.cancelled():
+                    self._release_slot()
+                raise
+
+        try:
+            with self._lock:
+                now = time.monotonic()
+                delay = max(0.0, self._cooldown_until - now)
+                if self._requests is not None:
+                    delay = max(delay, self._requests.reserve(1, now))
+                if self._tokens is not None:
+                    delay = max(delay, self._tokens.reserve(tokens, now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self._release_slot()
+            raise
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats["calls"] += 1
+            if waited > 0.001:
+                self.stats["queued"] += 1
+            wait_stats = self._wait_stats[priority.name.lower()]
+            wait_stats["count"] += 1
+            wait_stats["total"] += waited
+            wait_stats["max"] = max(wait_stats["max"], waited)
+        return waited
+
+    def release(self, reserved_tokens: int, used_tokens: Optional[int], throttled: bool = False) -> None:
+        """归还许可并按实际用量修正 token 配额"""
+        with self._lock:
+            now = time.monotonic()
+            if used_tokens is not None:
+                self.stats["tokens"] += used_tokens
+                if self._tokens is not None:
+                    self._tokens.adjust(reserved_tokens - used_tokens, now)
+            if throttled:
+                self.stats["throttled"] += 1
+                self._cooldown_until = max(self._cooldown_until, now + self.cooldown_on_429)
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            while self._waiters:
+                _, _, loop, future = heapq.heappop(self._waiters)
+                if future.cancelled():
+                    continue
+                # 槽位直接转交给优先级最高的等待者（in_flight 不变）
+                loop.call_soon_threadsafe(self._grant, future)
+                return
+            self._in_flight -= 1
+
+    def _grant(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            # 等待者在唤醒前被取消：继续转交
+            self._release_slot()
+        else:
+            future.set_result(None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            waits = {
+                name: {
+                    "count": w["count"],
+                    "avg": round(w["total"] / w["count"], 4) if w["count"] else 0.0,
+                    "max": round(w["max"], 4),
+                }
+                for name, w in self._wait_stats.items()
+            }
+            return {
+                **self.stats,
+                "in_flight": self._in_flight,
+                "waiting": sum(1 for *_, f in self._waiters if not f.cancelled()),
+                "max_concurrency": self.max_concurrency,
+                "queue_wait_seconds": waits,
+            }
+
+
+class RateGovernor:
+    """按模型名称管理限流器"""
+
+    def __init__(self) -> None:
+        self.config = RateLimitConfig()
+        self._models: dict[str, ModelGovernor] = {}
+        self._lock = threading.Lock()
+        self.workers = 1
+
+    def configure(self, config: RateLimitConfig) -> None:
+        """更新配置（已创建的模型限流器保持不变）"""
+        self.config = config
+
+    def set_workers(self, workers: int) -> None:
+        """设置 worker 进程数，之后创建的模型限流器使用平分后的限额"""
+        self.workers = max(1, int(workers))
+
+    def _share(self, value: int) -> int:
+        # 0 表示不限制；平分后至少为 1，所有 worker 的总和不超过配置的限额
+        return max(1, int(value) // self.workers) if value else value
+
+    def for_model(self, model_name: str) -> ModelGovernor:
+        with self._lock:
+            governor = self._models.get(model_name)
+            if governor is None:
+                cfg = self.config
+                override = cfg.models.get(model_name) or {}
+                governor = ModelGovernor(
+                    model_name,
+                    max_concurrency=self._share(override.get("max_concurrency", cfg.max_concurrency)),
+                    requests_per_minute=self._share(override.get("requests_per_minute", cfg.requests_per_minute)),
+                    tokens_per_minute=self._share(override.get("tokens_per_minute", cfg.tokens_per_minute)),
+                    cooldown_on_429=override.get("cooldown_on_429", cfg.cooldown_on_429),
+                )
+                self._models[model_name] = governor
+            return governor
+
+    def get_stats(self) -> dict:
+        """各模型的限流统计"""
+        with self._lock:
+            models = dict(self._models)
+        return {name: governor.get_stats() for name, governor in models.items()}
+
+
+# 进程内共享的限流器
+rate_governor = RateGovernor()
+
+
+# DashScope 流式调用失败时 AgentScope 把响应格式化进异常消息（JSON），只匹配其中的字段，
+# 不在整段文本里找 "429"（request_id、token 数里都可能出现）
+_THROTTLE_FIELDS = re.compile(r'"status_code":\s*429\b|"code":\s*"Throttling')
+
+
+def _is_throttled_response(obj: Any) -> bool:
+    if getattr(obj, "status_code", None) == 429:
+        return True
+    code = getattr(obj, "code", None)
+    return isinstance(code, str) and code.startswith("Throttling")
+
+
+def _is_throttle_error(error: BaseException) -> bool:
+    """判断模型调用异常是否为限流
+
+    依次检查异常本身（OpenAI 的 ``RateLimitError`` 带 ``status_code``）、
+    异常携带的响应对象（``error.response``，以及 DashScope 的 ``RuntimeError(response)``）
+    和异常链上的原始异常。
+    """
+    seen: set[int] = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        candidates = [current, getattr(current, "response", None), *current.args[:1]]
+        if any(_is_throttled_response(obj) for obj in candidates if obj is not None):
+            return True
+        if current.args and isinstance(current.args[0], str) and _THROTTLE_FIELDS.search(current.args[0]):
+            return True
+        current = current.__cause__ or current.__context__
+    return False
+
+
+def _usage_tokens(response: Any) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return int(getattr(usage, "input_tokens", 0) or 0) + int(getattr(usage, "output_tokens", 0) or 0)
+
+
+class GovernedChatModel(ChatModelBase):
+    """经过全局限流的聊天模型
+
+    继承 ``ChatModelBase``（mem0 会检查模型类型），
+    ``stream`` 等属性读写都转发到原始模型。
+    """
+
+    def __init__(self, model: Any, expected_output_tokens: int = 800, priority: Optional[Priority] = None):
+        object.__setattr__(self, "_model", model)
+        object.__setattr__(self, "_expected_output_tokens", expected_output_tokens)
+        object.__setattr__(self, "_priority", priority)
+        object.__setattr__(self, "_governor", rate_governor.for_model(getattr(model, "model_name", "default")))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._model, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._model, name, value)
+
+    async def __call__(self, *args, **kwargs):
+        priority = self._priority if self._priority is not None else _current_priority.get()
+        messages = args[0] if args else kwargs.get("messages")
+        reserved = estimate_tokens(str(messages or "")) + self._expected_output_tokens
+
+        await self._governor.acquire(reserved, priority)
+        try:
+            res = await self._model(*args, **kwargs)
+        except BaseException as e:
+            # 取消（阶段预算、空闲超时、客户端断开、drain）同样要归还槽位
+            self._governor.release(reserved, None, throttled=isinstance(e, Exception) and _is_throttle_error(e))
+            raise
+
+        if not self._model.stream or not hasattr(res, "__aiter__"):
+            self._governor.release(reserved, _usage_tokens(res))
+            return res
+        return _GovernedStream(self._governor, res, reserved)
+
+
+class _GovernedStream:
+    """流式响应的包装：迭代结束、出错、``aclose`` 或被回收时归还许可（只归还一次）
+
+    不用异步生成器实现：生成器在第一次 ``__anext__`` 之前被关闭时不会执行 ``finally``，
+    槽位就永远不会归还。
+    """
+
+    def __init__(self, governor: ModelGovernor, res: Any, reserved: int):
+        self._governor = governor
+        self._res = res
+        self._reserved = reserved
+        self._last = None
+        self._released = False
+        self._loop = asyncio.get_running_loop()
+
+    def __aiter__(self) -> "_GovernedStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._released:
+            raise StopAsyncIteration
+        try:
+            chunk = await self._res.__anext__()
+        except StopAsyncIteration:
+            self._release()
+            raise
+        except BaseException as e:
+            self._release(throttled=isinstance(e, Exception) and _is_throttle_error(e))
+            raise
+        self._last = chunk
+        return chunk
+
+    async def aclose(self) -> None:
+        try:
+            aclose = getattr(self._res, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self._release()
+
+    def _release(self, throttled: bool = False) -> None:
+        if self._released:
+            return
+        self._released = True
+        # 流式响应的 usage 是累计值，以最后一个块为准
+        self._governor.release(self._reserved, _usage_tokens(self._last), throttled=throttled)
+
+    def __del__(self) -> None:
+        if getattr(self, "_released", True):
+            return
+        # 回收可能发生在任意位置（包括持有限流器线程锁时），交给事件循环归还
+        try:
+            self._loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # 事件循环已关闭
+            self._release()
+
+
+def wrap_with_rate_limit(model: Any, config: RateLimitConfig, *, priority: Optional[Priority] = None) -> Any:
+    """为模型实例添加全局限流（未启用时原样返回）
+
+    Args:
+        model: 聊天模型实例
+        config: llm.yaml 中的 rate_limits 配置
+        priority: 固定优先级（None 表示使用调用方上下文中的优先级）
+    """
+    if model is None or not config.enabled or isinstance(model, GovernedChatModel):
+        return model
+    rate_governor.configure(config)
+    return GovernedChatModel(model, expected_output_tokens=config.expected_output_tokens, priority=priority)
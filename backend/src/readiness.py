@@ -0,0 +1,235 @@
+"""就绪检查和预热
+
+``/health`` 只表示进程存活；``/ready`` 在依赖可用且预热完成后才返回 200，
+负载均衡器据此只把流量发给已预热的 worker。
+
+依赖探测（结果缓存 ``cache_ttl`` 秒，避免每次就绪检查都访问依赖）：
+
+- ``mcp:<服务名>``：调用一次 ``list_tools``（同时验证 stdio 会话仍然存活）
+- ``qdrant:<Agent>``：检查全局知识库的 collection 是否存在（建立本地存储 / 远程连接）
+
+探测按配置中启用的 MCP 服务和 RAG Agent 注册，而不是按初始化成功的客户端：
+启动时连接失败的服务没有客户端，对应的探测直接失败，``/ready`` 返回 503。
+``required`` 中列出的启动阶段（例如 ``mcp``、``rag``）失败时同样视为未就绪。
+
+预热在 ``lifespan`` 中执行一次探测，并可选地发送一次很小的模型 / 嵌入请求，
+提前完成 TLS 握手、DNS 解析和 API Key 校验，首个用户请求不再承担这些冷启动开销。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 探测: 无参数的协程函数，失败时抛出异常
+Probe = Callable[[], Awaitable[Any]]
+
+
+def mcp_probe(mcp_manager: Any, name: str) -> Probe:
+    """MCP 服务探测（list_tools，服务未能启动时失败）"""
+    async def probe() -> None:
+        client = mcp_manager.clients.get(name) if mcp_manager is not None else None
+        if client is None:
+            raise RuntimeError(f"MCP 服务 {name} 未启动")
+        await client.list_tools()
+    return probe
+
+
+def qdrant_probe(rag_manager: Any, agent_name: str) -> Probe:
+    """知识库 collection 探测（知识库未能创建时失败）"""
+    async def probe() -> None:
+        knowledge = rag_manager.global_knowledges.get(agent_name) if rag_manager is not None else None
+        if knowledge is None:
+            raise RuntimeError(f"{agent_name} 全局知识库未创建")
+        store = knowledge.embedding_store
+        if not await store.get_client().collection_exists(store.collection_name):
+            raise RuntimeError(f"collection {store.collection_name} 不存在")
+    return probe
+
+
+def llm_probe(llm_cfg: Any) -> Probe:
+    """模型探测：发送一次只生成 1 个 token 的请求"""
+    async def probe() -> None:
+        from .model_factory import build_chat_model
+        bundle = build_chat_model(llm_cfg, force_stream=False)
+        await bundle.model([{"role": "user", "content": "ping"}], max_tokens=1)
+    return probe
+
+
+def embedding_probe(embedding_model: Any) -> Probe:
+    """嵌入模型探测：嵌入一个很短的文本"""
+    async def probe() -> None:
+        await embedding_model(["ping"])
+    return probe
+
+
+def _enabled_mcp_servers(app_config: Any, mcp_manager: Any) -> list[str]:
+    """配置中启用的 MCP 服务（没有配置时使用已初始化的客户端）"""
+    mcp_cfg = getattr(app_config, "mcp", None)
+    if mcp_cfg is not None:
+        return [name for name, server_cfg in mcp_cfg.servers.items() if server_cfg.enabled]
+    return list(mcp_manager.clients) if mcp_manager is not None else []
+
+
+def _enabled_rag_agents(app_config: Any, rag_manager: Any) -> list[str]:
+    """配置中启用的 RAG Agent（没有配置时使用已创建的全局知识库）"""
+    rag_cfg = getattr(app_config, "rag", None)
+    if rag_cfg is not None:
+        if not rag_cfg.enabled:
+            return []
+        return [name for name, agent_cfg in rag_cfg.agents.items() if agent_cfg.enabled]
+    return list(rag_manager.global_knowledges) if rag_manager is not None else []
+
+
+class Readiness:
+    """依赖探测结果和就绪状态"""
+
+    def __init__(
+        self,
+        timeout: float = 5.0,
+        cache_ttl: float = 10.0,
+        required: tuple[str, ...] = ("mcp", "qdrant"),
+        startup_report: Any = None,
+    ):
+        """
+        Args:
+            timeout: 单个探测的超时（秒）
+            cache_ttl: 探测结果的缓存时间（秒）
+            required: 失败时视为未就绪的探测类型（探测名称中 ":" 之前的部分）和启动阶段名称
+            startup_report: 启动耗时报告（None 表示不检查启动阶段）
+        """
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.required = tuple(required)
+        self.startup_report = startup_report
+        self.warm = False
+
+        self._probes: dict[str, Probe] = {}
+        self._warm_up_probes: dict[str, Probe] = {}
+        self.results: dict[str, dict] = {}
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(
+        cls,
+        cfg: dict | None,
+        mcp_manager: Any = None,
+        rag_manager: Any = None,
+        app_config: Any = None,
+        startup_report: Any = None,
+    ) -> Optional["Readiness"]:
+        """从 api.yaml 的 readiness 配置块创建（未启用时返回 None）
+
+        Args:
+            cfg: readiness 配置块
+            mcp_manager: 全局 MCP 管理器（None 表示未启用或初始化失败）
+            rag_manager: 全局 RAG 管理器（None 表示未启用或初始化失败）
+            app_config: 应用配置（按其中启用的 MCP 服务 / RAG Agent 注册探测，模型探测使用其中的 llm 配置）
+            startup_report: 启动耗时报告（required 中的阶段失败时视为未就绪）
+        """
+        cfg = cfg or {}
+        if not cfg.get("enabled", True):
+            return None
+        readiness = cls(
+            timeout=float(cfg.get("timeout", 5)),
+            cache_ttl=float(cfg.get("cache_ttl", 10)),
+            required=tuple(cfg.get("required", ["mcp", "qdrant"])),
+            startup_report=startup_report,
+        )
+        for name in _enabled_mcp_servers(app_config, mcp_manager):
+            readiness.add_probe(f"mcp:{name}", mcp_probe(mcp_manager, name))
+        for agent_name in _enabled_rag_agents(app_config, rag_manager):
+            readiness.add_probe(f"qdrant:{agent_name}", qdrant_probe(rag_manager, agent_name))
+
+        # 模型 / 嵌入请求会消耗少量 token，只在预热时执行一次
+        warm_up_cfg = cfg.get("warm_up", {}) or {}
+        if warm_up_cfg.get("llm_call", False) and app_config is not None:
+            readiness.add_probe("llm", llm_probe(app_config.llm), warm_up_only=True)
+        if warm_up_cfg.get("embedding_call", False) and rag_manager is not None and rag_manager.embedding_model:
+            readiness.add_probe("embedding", embedding_probe(rag_manager.embedding_model), warm_up_only=True)
+        return readiness
+
+    def add_probe(self, name: str, probe: Probe, warm_up_only: bool = False) -> None:
+        """注册依赖探测
+
+        Args:
+            name: 探测名称（"类型:名称"，类型用于匹配 required）
+            probe: 探测函数
+            warm_up_only: 只在预热时执行（例如会产生费用的模型请求）
+        """
+        if warm_up_only:
+            self._warm_up_probes[name] = probe
+        else:
+            self._probes[name] = probe
+
+    async def _run_probe(self, name: str, probe: Probe) -> None:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(probe(), timeout=self.timeout)
+        except Exception as e:
+            error = "timeout" if isinstance(e, asyncio.TimeoutError) else f"{type(e).__name__}: {e}"
+            ok = False
+        else:
+            error = None
+            ok = True
+        result = {
+            "ok": ok,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "checked_at": time.time(),
+        }
+        if error:
+            result["error"] = error[:300]
+            if self.results.get(name, {}).get("ok", True):
+                logger.warning(f"⚠️ 依赖探测 {name} 失败: {error}")
+        self.results[name] = result
+
+    async def _run(self, probes: dict[str, Probe]) -> None:
+        await asyncio.gather(*(self._run_probe(name, probe) for name, probe in probes.items()))
+
+    async def warm_up(self) -> dict:
+        """执行所有探测（包括只在预热时执行的），完成后标记为已预热"""
+        async with self._lock:
+            await self._run({**self._probes, **self._warm_up_probes})
+            self._checked_at = time.monotonic()
+        self.warm = True
+        failed = [name for name, r in self.results.items() if not r["ok"]]
+        if failed:
+            logger.warning(f"⚠️ 预热完成，失败的依赖: {', '.join(failed)}")
+        return self.results
+
+    async def check(self) -> dict:
+        """就绪状态（探测结果超过 cache_ttl 时重新探测）"""
+        async with self._lock:
+            if time.monotonic() - self._checked_at >= self.cache_ttl:
+                await self._run(self._probes)
+                self._checked_at = time.monotonic()
+        return self.get_status()
+
+    def _is_required(self, name: str) -> bool:
+        return name.split(":", 1)[0] in self.required
+
+    def _failed_phases(self) -> list[str]:
+        if self.startup_report is None:
+            return []
+        return [
+            phase["name"] for phase in self.startup_report.phases
+            if phase["status"] == "failed" and phase["name"] in self.required
+        ]
+
+    def get_status(self) -> dict:
+        """最近一次探测的结果（不触发探测）"""
+        failed = [f"startup:{name}" for name in self._failed_phases()] + [
+            name for name, r in self.results.items()
+            if not r["ok"] and name in self._probes and self._is_required(name)
+        ]
+        return {
+            "ready": self.warm and not failed,
+            "warm": self.warm,
+            "failed": failed,
+            "checks": self.results,
+        }
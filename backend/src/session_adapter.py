@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import json
+import logging
 import os
 from typing import Any, Dict, List, Optional
 from datetime import datetime, timezone
@@ -8,6 +9,28 @@ from datetime import datetime, timezone
 from agentscope.message import Msg
 from agentscope.session import SessionBase
 
+from .file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# per-session lock files live in a sibling directory of the session directories,
+# so deleting a session directory never removes a lock file that writers are polling
+LOCKS_DIR = ".locks"
+
+
+def session_lock(session_dir: str, timeout: float = 10.0) -> FileLock:
+    """Cross-process lock of one session directory (lock file kept outside the directory)."""
+    parent, name = os.path.split(os.path.normpath(session_dir))
+    locks_dir = os.path.join(parent, LOCKS_DIR)
+    os.makedirs(locks_dir, exist_ok=True)
+    return FileLock(os.path.join(locks_dir, f"{name}.lock"), timeout=timeout)
+
+
+def session_tombstone(session_dir: str) -> str:
+    """Marker written (under the session lock) when a session is deleted; writers skip tombstoned sessions."""
+    parent, name = os.path.split(os.path.normpath(session_dir))
+    return os.path.join(parent, LOCKS_DIR, f"{name}.deleted")
+
 
 class HowtoLiveSession(SessionBase):
     """Session implementation based on AgentScope SessionBase.
@@ -16,6 +39,7 @@ class HowtoLiveSession(SessionBase):
     - user_id -> session_id directory layout
     - optional compact mode (persist only user/assistant text messages)
     - optional skip for router agent
+    - cross-process file lock per session directory (safe with multiple workers)
     """
 
     def __init__(
@@ -25,6 +49,7 @@ class HowtoLiveSession(SessionBase):
         include_router: bool = False,
         compact: bool = False,
         max_messages_per_agent: int = 12,
+        lock_timeout: float = 10.0,
     ) -> None:
         # SessionBase may not define an __init__ that accepts parameters in some versions.
         # We set save_dir directly to remain compatible.
@@ -32,6 +57,7 @@ class HowtoLiveSession(SessionBase):
         self.include_router = include_router
         self.compact = compact
         self.max_messages_per_agent = max_messages_per_agent
+        self.lock_timeout = lock_timeout
 
     # --- path helpers ---
     def _state_path(self, session_id: str, user_id: Optional[str]) -> str:
@@ -46,6 +72,19 @@ class HowtoLiveSession(SessionBase):
             return os.path.join(self.save_dir, user_id, session_id, "timeline.json")
         return os.path.join(self.save_dir, session_id, "timeline.json")
 
+    def _lock(self, path: str) -> FileLock:
+        # one lock per session directory, shared by state.json and timeline.json
+        return session_lock(os.path.dirname(path), timeout=self.lock_timeout)
+
+    def _writable(self, path: str) -> bool:
+        # called under the session lock: a deleted session must not be recreated by a late writer
+        session_dir = os.path.dirname(path)
+        if os.path.exists(session_tombstone(session_dir)):
+            logger.info("session %s was deleted, skip writing %s", os.path.basename(session_dir), os.path.basename(path))
+            return False
+        os.makedirs(session_dir, exist_ok=True)
+        return True
+
     def _now_iso(self) -> str:
         return datetime.now(timezone.utc).isoformat()
 
@@ -71,6 +110,9 @@ class HowtoLiveSession(SessionBase):
             role = getattr(m, "role", None)
             if role not in ("user", "assistant"):
                 continue
+            # skip the framework's interruption notice; the partial reply itself is kept
+            if (getattr(m, "metadata", None) or {}).get("_is_interrupted"):
+                continue
             name = getattr(m, "name", None) or (agent.name if role == "assistant" else "user")
             text: Optional[str] = None
             if hasattr(m, "get_content_blocks"):
@@ -105,7 +147,6 @@ class HowtoLiveSession(SessionBase):
     # --- SessionBase interface ---
     async def save_session_state(self, *, session_id: str, user_id: Optional[str] = None, strict: bool = True, **state_modules: Any) -> None:  # type: ignore[override]
         path = self._state_path(session_id, user_id)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
 
         agents_payload: Dict[str, Any] = {}
         for name, module in state_modules.items():
@@ -121,10 +162,13 @@ class HowtoLiveSession(SessionBase):
                     pass
 
         payload = {"user_id": user_id, "session_id": session_id, "agents": agents_payload}
-        tmp_path = path + ".tmp"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, path)
+        async with self._lock(path):
+            if not self._writable(path):
+                return
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
 
     async def load_session_state(self, *, session_id: str, user_id: Optional[str] = None, strict: bool = True, **state_modules: Any) -> None:  # type: ignore[override]
         path = self._state_path(session_id, user_id)
@@ -175,49 +219,51 @@ class HowtoLiveSession(SessionBase):
           - seq: int (filled automatically)
         """
         path = self._timeline_path(session_id, user_id)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        blob: Dict[str, Any]
-        if os.path.exists(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    blob = json.load(f)
-            except Exception:
+        async with self._lock(path):
+            if not self._writable(path):
+                return
+            blob: Dict[str, Any]
+            if os.path.exists(path):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        blob = json.load(f)
+                except Exception:
+                    blob = {}
+            else:
+                blob = {}
+
+            if not isinstance(blob, dict):
                 blob = {}
-        else:
-            blob = {}
-
-        if not isinstance(blob, dict):
-            blob = {}
-        blob.setdefault("user_id", user_id)
-        blob.setdefault("session_id", session_id)
-        blob.setdefault("version", "1.0")
-        timeline = blob.get("timeline")
-        if not isinstance(timeline, list):
-            timeline = []
-
-        # determine next seq
-        next_seq = 1
-        if timeline:
-            last = timeline[-1]
-            if isinstance(last, dict) and isinstance(last.get("seq"), int):
-                next_seq = last["seq"] + 1
-
-        # normalize and append
-        for ev in events:
-            ev = dict(ev) if isinstance(ev, dict) else {}
-            if "ts" not in ev:
-                ev["ts"] = self._now_iso()
-            ev["seq"] = next_seq
-            next_seq += 1
-            timeline.append(ev)
-
-        blob["timeline"] = timeline
-        blob["stats"] = {"num_events": len(timeline)}
-
-        tmp_path = path + ".tmp"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(blob, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, path)
+            blob.setdefault("user_id", user_id)
+            blob.setdefault("session_id", session_id)
+            blob.setdefault("version", "1.0")
+            timeline = blob.get("timeline")
+            if not isinstance(timeline, list):
+                timeline = []
+
+            # determine next seq
+            next_seq = 1
+            if timeline:
+                last = timeline[-1]
+                if isinstance(last, dict) and isinstance(last.get("seq"), int):
+                    next_seq = last["seq"] + 1
+
+            # normalize and append
+            for ev in events:
+                ev = dict(ev) if isinstance(ev, dict) else {}
+                if "ts" not in ev:
+                    ev["ts"] = self._now_iso()
+                ev["seq"] = next_seq
+                next_seq += 1
+                timeline.append(ev)
+
+            blob["timeline"] = timeline
+            blob["stats"] = {"num_events": len(timeline)}
+
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(blob, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
 
 
@@ -0,0 +1,140 @@
+"""SQLite 连接池
+
+在固定大小的专用线程池中执行 SQLite 操作，每个线程持有一个长期连接：
+
+- 事件循环不再同步等待磁盘 I/O，也不再为每次查询打开 / 关闭连接
+- WAL 模式下读不阻塞写，多个线程（以及多个 worker 进程）可以并发读
+- ``sqlite3`` 按连接缓存预编译语句（``cached_statements``），固定的 SQL 只解析一次
+- 排队时间和执行时间分别记录为 ``howtolive_db_pool_wait_seconds`` 和
+  ``howtolive_dependency_seconds{dependency=<名称>}``
+
+使用专用线程池而不是 ``asyncio.to_thread``，避免数据库操作与其他阻塞任务争用默认线程池。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from .metrics import DB_POOL_WAIT_SECONDS, DEPENDENCY_SECONDS
+
+T = TypeVar("T")
+
+# 默认 PRAGMA（每个连接创建时执行）
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # WAL 模式下只在检查点时同步，断电可能丢失最后的事务但不会损坏
+    "busy_timeout": 5000,     # 其他进程持有写锁时等待（毫秒）
+    "temp_store": "MEMORY",
+    "cache_size": -8000,      # 页缓存约 8MB（负数表示 KB）
+    "foreign_keys": "ON",
+}
+
+
+class SQLitePool:
+    """固定大小的 SQLite 连接池（每个线程一个连接）"""
+
+    def __init__(
+        self,
+        path: str,
+        size: int = 4,
+        name: str = "sqlite",
+        pragmas: Optional[dict[str, Any]] = None,
+        cached_statements: int = 64,
+    ):
+        """
+        Args:
+            path: 数据库文件路径
+            size: 线程 / 连接数
+            name: 指标中的依赖名称和线程名前缀
+            pragmas: 覆盖默认的 PRAGMA
+            cached_statements: 每个连接缓存的预编译语句数
+        """
+        self.path = path
+        self.size = max(1, int(size))
+        self.name = name
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.cached_statements = cached_statements
+
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix=f"{name}-db")
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "errors": 0, "queued": 0, "active": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 连接只在所属线程中使用，关闭时由 close 统一处理
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.pragmas["busy_timeout"] / 1000,
+                check_same_thread=False,
+                cached_statements=self.cached_statements,
+            )
+            conn.row_factory = sqlite3.Row
+            for key, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {key}={value}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def run(self, fn: Callable[..., T], *args: Any, op: str = "query") -> T:
+        """在连接池的线程中执行 fn(conn, *args)
+
+        fn 中的多条语句使用同一个连接，需要原子性时由 fn 自行提交 / 回滚。
+
+        Args:
+            fn: 接收连接和参数的函数
+            op: 指标中的操作名称
+        """
+        submitted = time.perf_counter()
+        with self._lock:
+            self.stats["queued"] += 1
+
+        def call() -> T:
+            started = time.perf_counter()
+            DB_POOL_WAIT_SECONDS.observe(started - submitted, db=self.name)
+            with self._lock:
+                self.stats["queued"] -= 1
+                self.stats["active"] += 1
+            try:
+                return fn(self._connect(), *args)
+            except Exception:
+                with self._lock:
+                    self.stats["errors"] += 1
+                raise
+            finally:
+                DEPENDENCY_SECONDS.observe(time.perf_counter() - started, dependency=self.name, op=op)
+                with self._lock:
+                    self.stats["active"] -= 1
+                    self.stats["queries"] += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def fetchone(self, sql: str, params: tuple = (), op: str = "query") -> Optional[sqlite3.Row]:
+        """执行查询并返回第一行"""
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), op=op)
+
+    async def execute(self, sql: str, params: tuple = (), op: str = "execute") -> int:
+        """执行写入并提交，返回 lastrowid"""
+        def write(conn: sqlite3.Connection) -> int:
+            with conn:
+                return conn.execute(sql, params).lastrowid
+        return await self.run(write, op=op)
+
+    def get_stats(self) -> dict:
+        return {"size": self.size, **self.stats}
+
+    def close(self) -> None:
+        """等待进行中的操作完成并关闭所有连接"""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
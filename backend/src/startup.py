@@ -0,0 +1,117 @@
+"""启动耗时报告
+
+``lifespan`` 中的每个初始化步骤是一个阶段，记录开始时间（相对启动）、耗时和结果。
+相互独立的步骤（MCP、RAG、Studio、认证数据库）并发执行，报告中的 ``start`` 可以看出重叠。
+
+报告写入 ``data/startup.json``，并通过 ``GET /api/admin/startup`` 和
+``howtolive_startup_seconds`` 指标查看，便于比较不同版本 / 机器的冷启动时间。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """一次启动的各阶段耗时"""
+
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.phases: list[dict] = []
+        self.total: Optional[float] = None
+
+    def _record(self, name: str, start: float, status: str, error: Optional[str] = None) -> dict:
+        phase = {
+            "name": name,
+            "start": round(start - self._started, 3),
+            "duration": round(time.perf_counter() - start, 3),
+            "status": status,
+        }
+        if error:
+            phase["error"] = error
+        self.phases.append(phase)
+        return phase
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """记录代码块的耗时（异常时记为 failed 并继续抛出）"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._record(name, start, "failed", f"{type(e).__name__}: {e}")
+            raise
+        self._record(name, start, "ok")
+
+    async def run(self, name: str, awaitable: Awaitable[Any], required: bool = False) -> Any:
+        """等待一个初始化步骤
+
+        Args:
+            name: 阶段名称
+            awaitable: 初始化步骤
+            required: 失败时是否继续抛出（否则记录错误并返回 None，不影响其他步骤）
+        """
+        start = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._record(name, start, "failed", f"{type(e).__name__}: {e}")
+            if required:
+                raise
+            logger.warning(f"⚠️ 启动阶段 {name} 失败: {e}")
+            return None
+        self._record(name, start, "ok")
+        return result
+
+    def skip(self, name: str) -> None:
+        """记录未启用的步骤"""
+        self._record(name, time.perf_counter(), "skipped")
+
+    def finish(self) -> float:
+        """结束计时，返回总启动时间（秒）"""
+        self.total = round(time.perf_counter() - self._started, 3)
+        return self.total
+
+    def as_dict(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "pid": os.getpid(),
+            "total": self.total,
+            "phases": sorted(self.phases, key=lambda p: p["start"]),
+        }
+
+    def save(self, path: str | Path) -> None:
+        """写入 JSON 文件（失败时只记录警告）"""
+        path = Path(path)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(self.as_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+        except OSError as e:
+            logger.warning(f"⚠️ 启动报告写入失败: {e}")
+
+
+async def preload(modules: Iterable[str]) -> list[str]:
+    """在线程中导入模块（导入期间事件循环可以继续处理 I/O），返回导入成功的模块
+
+    未安装的模块跳过，真正使用时再报错。
+    """
+    loaded = []
+    for name in modules:
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except ImportError as e:
+            logger.debug(f"预加载 {name} 跳过: {e}")
+            continue
+        loaded.append(name)
+    return loaded
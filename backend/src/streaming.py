@@ -0,0 +1,397 @@
+"""Agent 流式输出接口
+
+直接从模型的流式响应中产出类型化的事件，替代基于 ``pre_print`` hook
+对累积文本做前缀比较的方式：
+
+- ``text_delta``: 模型新增的文本片段
+- ``tool_call_start`` / ``tool_call_end``: 工具调用边界
+- ``final``: Agent 执行结束（包含完整回复文本）
+
+模型层通过 ``StreamingChatModel`` 包装，按当前请求上下文（ContextVar）
+把增量事件分发给对应的接收器；没有接收器时（例如 CLI）完全透传。
+
+事件通过有界的 ``StreamBuffer`` 传递，缓冲区满时按策略处理：
+
+- ``block``: 生产者等待（背压传递到模型流）
+- ``coalesce``: 新的文本增量合并到缓冲区末尾的文本事件
+- ``drop``: 丢弃文本增量，``final`` 事件的 ``metadata["dropped_chars"]``
+  记录丢弃的字符数，调用方用完整文本重新同步
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from contextlib import aclosing, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Optional
+
+from .deadline import record_call, record_overrun
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+# 事件类型
+TEXT_DELTA = "text_delta"
+TOOL_CALL_START = "tool_call_start"
+TOOL_CALL_END = "tool_call_end"
+FINAL = "final"
+
+# 缓冲区满时的处理策略
+BUFFER_POLICIES = ("block", "coalesce", "drop")
+
+
+@dataclass
+class StreamEvent:
+    """流式事件"""
+    type: str
+    text: str = ""
+    tool_name: Optional[str] = None
+    tool_id: Optional[str] = None
+    error: Optional[str] = None
+    metadata: dict = field(default_factory=dict)
+
+
+class StreamBuffer:
+    """有界事件缓冲区（替代无界的 ``asyncio.Queue``）
+
+    容量按事件个数计算；缓冲区满时按 ``policy`` 处理文本增量，
+    其他事件（工具边界、结束事件、哨兵等）总是保留。
+    """
+
+    def __init__(self, maxsize: int = 256, policy: str = "block", name: str = "agent"):
+        """初始化缓冲区
+
+        Args:
+            maxsize: 最大事件数
+            policy: 缓冲区满时的策略（block / coalesce / drop）
+            name: 缓冲区名称（用于高水位统计）
+        """
+        if policy not in BUFFER_POLICIES:
+            raise ValueError(f"未知的缓冲策略: {policy}（可选: {', '.join(BUFFER_POLICIES)}）")
+        self.maxsize = max(1, int(maxsize))
+        self.policy = policy
+        self.name = name
+        self.high_water = 0
+        self.dropped_chars = 0
+        self._items: deque = deque()
+        self._cond = asyncio.Condition()
+        self._stats = _current_buffer_stats.get()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def put(self, item: Any) -> None:
+        """放入一个事件（block 策略下缓冲区满时等待）"""
+        async with self._cond:
+            is_text = isinstance(item, StreamEvent) and item.type == TEXT_DELTA
+            if len(self._items) >= self.maxsize and is_text:
+                if self.policy == "block":
+                    await self._cond.wait_for(lambda: len(self._items) < self.maxsize)
+                elif self.policy == "coalesce":
+                    last = self._items[-1]
+                    if isinstance(last, StreamEvent) and last.type == TEXT_DELTA:
+                        self._items[-1] = StreamEvent(TEXT_DELTA, text=last.text + item.text)
+                        return
+                else:
+                    self.dropped_chars += len(item.text)
+                    return
+
+            if isinstance(item, StreamEvent) and item.type == FINAL and self.dropped_chars:
+                item.metadata["dropped_chars"] = item.metadata.get("dropped_chars", 0) + self.dropped_chars
+            self._items.append(item)
+            self._record_high_water()
+            self._cond.notify_all()
+
+    async def get(self) -> Any:
+        """取出一个事件（缓冲区为空时等待）"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._items)
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def _record_high_water(self) -> None:
+        size = len(self._items)
+        if size <= self.high_water:
+            return
+        self.high_water = size
+        if self._stats is not None and size > self._stats.get(self.name, 0):
+            self._stats[self.name] = size
+
+
+class _ReplyCollector:
+    """单次 Agent 执行的事件接收器
+
+    记录每个文本块已发送的长度，增量只截取新增的尾部，
+    因此每个 token 的开销与已生成的总长度无关。
+    """
+
+    def __init__(self, buffer: StreamBuffer):
+        self._buffer = buffer
+        self._parts: list[str] = []
+        self._emitted: list[int] = []  # 当前模型调用中每个文本块已发送的长度
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def emit(self, event: StreamEvent) -> None:
+        await self._buffer.put(event)
+
+    async def _emit_text(self, delta: str) -> None:
+        self._parts.append(delta)
+        await self.emit(StreamEvent(TEXT_DELTA, text=delta))
+
+    def begin_model_call(self) -> None:
+        """新的一次模型调用（ReAct 循环中的一轮推理）"""
+        self._emitted = []
+
+    async def on_chunk(self, chunk: Any) -> None:
+        """处理一个模型响应块（DashScope 流式块的文本是累积的）"""
+        index = 0
+        for block in getattr(chunk, "content", None) or []:
+            if not isinstance(block, dict) or block.get("type") != "text":
+                continue
+            text = block.get("text") or ""
+            if index == len(self._emitted):
+                self._emitted.append(0)
+            sent = self._emitted[index]
+            if len(text) > sent:
+                delta = text[sent:]
+                # 不同轮次 / 不同文本块之间用换行分隔
+                if sent == 0 and self._parts:
+                    delta = "\n" + delta
+                self._emitted[index] = len(text)
+                await self._emit_text(delta)
+            index += 1
+
+    async def finish(self, reply: Any = None, error: Optional[str] = None) -> None:
+        text = self.text
+        if not text and reply is not None:
+            # 兜底：回复不是由模型流产生的（例如中断处理）
+            text = _extract_text(reply)
+            if text:
+                await self._emit_text(text)
+        await self.emit(StreamEvent(FINAL, text=text, error=error))
+
+
+_current_collector: contextvars.ContextVar[Optional[_ReplyCollector]] = contextvars.ContextVar(
+    "howtolive_stream_collector", default=None
+)
+
+# 当前生成的缓冲区高水位统计（{缓冲区名称: 最大事件数}），由调用方绑定
+_current_buffer_stats: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar(
+    "howtolive_stream_buffer_stats", default=None
+)
+
+
+def bind_buffer_stats(stats: dict) -> None:
+    """把当前上下文中创建的缓冲区的高水位记录到 stats（在生成任务内调用）"""
+    _current_buffer_stats.set(stats)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数（中文约 1 字 1 token，其余约 4 字符 1 token）"""
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def _extract_text(msg: Any) -> str:
+    content = getattr(msg, "content", msg)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            str(item.get("text", ""))
+            for item in content
+            if isinstance(item, dict) and item.get("type") == "text"
+        )
+    return str(content or "")
+
+
+class StreamingChatModel:
+    """为聊天模型添加流式事件分发的包装器
+
+    代理所有属性读写到原始模型实例（例如 ReActAgent 临时修改 ``stream``），
+    只拦截 ``__call__``。
+    """
+
+    def __init__(self, model: Any):
+        object.__setattr__(self, "_model", model)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._model, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._model, name, value)
+
+    async def __call__(self, *args, **kwargs):
+        span = tracer.start_span("llm.call", {
+            "model": getattr(self._model, "model_name", None),
+            "stream": bool(getattr(self._model, "stream", False)),
+        })
+        try:
+            res = await self._model(*args, **kwargs)
+        except BaseException as e:
+            span.record_error(e)
+            span.end()
+            raise
+
+        collector = _current_collector.get()
+        if collector is None and not span.recording:
+            return res
+
+        if collector is not None:
+            collector.begin_model_call()
+        if not self._model.stream or not hasattr(res, "__aiter__"):
+            _record_usage(span, res)
+            span.end()
+            if collector is not None:
+                await collector.on_chunk(res)
+            return res
+        return self._relay(res, collector, span)
+
+    async def _relay(self, res, collector: Optional[_ReplyCollector], span: Any):
+        last = None
+        try:
+            # 提前退出时关闭内层流（例如归还限流许可）
+            async with aclosing(res) if hasattr(res, "aclose") else nullcontext(res):
+                async for chunk in res:
+                    if last is None:
+                        span.set_attribute("time_to_first_chunk_ms", round(span.duration_ms, 1))
+                    last = chunk
+                    if collector is not None:
+                        await collector.on_chunk(chunk)
+                    yield chunk
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            # 流式响应的 usage 是累计值，以最后一个块为准
+            _record_usage(span, last)
+            span.end()
+
+
+def _record_usage(span: Any, response: Any) -> None:
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        span.set_attributes(
+            input_tokens=getattr(usage, "input_tokens", None),
+            output_tokens=getattr(usage, "output_tokens", None),
+        )
+
+
+def wrap_with_streaming(model: Any) -> Any:
+    """为模型实例添加流式事件包装（幂等）"""
+    if model is None or isinstance(model, StreamingChatModel):
+        return model
+    return StreamingChatModel(model)
+
+
+async def stream_agent_reply(
+    agent: Any,
+    msg: Any,
+    *,
+    idle_timeout: Optional[float] = 30.0,
+    timeout: Optional[float] = None,
+    cancel_timeout: float = 5.0,
+    buffer_size: int = 256,
+    buffer_policy: str = "block",
+) -> AsyncGenerator[StreamEvent, None]:
+    """运行 Agent 并逐个产出流式事件
+
+    调用方停止迭代（关闭生成器或所在任务被取消）时，Agent 任务会被取消，
+    取消会传递到进行中的模型流和工具调用。
+
+    Args:
+        agent: ReActAgent 实例（模型需经过 ``wrap_with_streaming`` 包装）
+        msg: 输入消息
+        idle_timeout: 两个事件之间的最长等待时间（秒），None 表示不限制
+        timeout: 整个回复的最长时间（秒），None 表示不限制；超时后以已生成的内容结束
+        cancel_timeout: 取消后等待 Agent 完成中断处理的最长时间（秒）
+        buffer_size: 事件缓冲区容量（事件数）
+        buffer_policy: 缓冲区满时的策略（block / coalesce / drop）
+
+    Yields:
+        StreamEvent，最后一个事件的类型总是 ``final``
+    """
+    buffer = StreamBuffer(buffer_size, buffer_policy, name="agent")
+    collector = _ReplyCollector(buffer)
+    hook_name = f"stream_events_{id(collector)}"
+
+    async def _pre_acting(self, kwargs: dict):
+        tool_call = kwargs.get("tool_call") or {}
+        await collector.emit(StreamEvent(
+            TOOL_CALL_START,
+            tool_name=tool_call.get("name"),
+            tool_id=tool_call.get("id"),
+        ))
+
+    async def _post_acting(self, kwargs: dict, output: Any):
+        tool_call = kwargs.get("tool_call") or {}
+        await collector.emit(StreamEvent(
+            TOOL_CALL_END,
+            tool_name=tool_call.get("name"),
+            tool_id=tool_call.get("id"),
+        ))
+
+    async def _run():
+        _current_collector.set(collector)
+        try:
+            reply = await agent(msg)
+            await collector.finish(reply)
+        except Exception as e:
+            logger.error(f"Agent 执行异常: {e}", exc_info=True)
+            await collector.finish(error=str(e))
+
+    agent.register_instance_hook(hook_type="pre_acting", hook_name=hook_name, hook=_pre_acting)
+    agent.register_instance_hook(hook_type="post_acting", hook_name=hook_name, hook=_post_acting)
+    # 事件已经直接交给调用方，关闭控制台逐块打印
+    if hasattr(agent, "set_console_output_enabled"):
+        agent.set_console_output_enabled(False)
+
+    loop = asyncio.get_running_loop()
+    expires_at = None
+    if timeout is not None:
+        record_call("agent")
+        expires_at = loop.time() + timeout
+    agent_task = asyncio.create_task(_run())
+    try:
+        while True:
+            wait = idle_timeout
+            if expires_at is not None:
+                remaining = max(0.0, expires_at - loop.time())
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                event = await asyncio.wait_for(buffer.get(), timeout=wait)
+            except asyncio.TimeoutError:
+                logger.error("Agent 执行超时")
+                if expires_at is not None and loop.time() >= expires_at:
+                    record_overrun("agent")
+                yield StreamEvent(
+                    FINAL,
+                    text=collector.text,
+                    error="timeout",
+                    metadata={"dropped_chars": buffer.dropped_chars} if buffer.dropped_chars else {},
+                )
+                return
+
+            yield event
+            if event.type == FINAL:
+                return
+    finally:
+        if not agent_task.done():
+            agent_task.cancel()
+            # 等待 Agent 处理中断，保证部分回复已写入 Agent 记忆
+            await asyncio.wait({agent_task}, timeout=cancel_timeout)
+        for hook_type in ("pre_acting", "post_acting"):
+            try:
+                agent.remove_instance_hook(hook_type=hook_type, hook_name=hook_name)
+            except Exception:
+                pass
@@ -0,0 +1,90 @@
+"""请求级阶段耗时
+
+每次 HTTP 请求（或 WebSocket 消息）创建一个 ``RequestTimings``，通过 ContextVar 传递到
+认证、流水线各阶段和 Agent 任务中。``timed`` 同时记录 ``howtolive_stage_seconds`` 指标
+和当前请求的耗时，请求结束时：
+
+- 非流式接口：通过 ``Server-Timing`` 响应头返回
+- 流式聊天：作为 ``done`` 事件的 ``timings`` 字段返回（包括首 token / 末 token 时间）
+
+同一阶段在一次请求中执行多次（例如多次工具调用）时耗时累加。
+"""
+
+from __future__ import annotations
+
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from .metrics import STAGE_SECONDS
+
+
+class RequestTimings:
+    """一次请求的阶段耗时（毫秒，按首次出现的顺序）"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.durations: dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        """累加一个阶段的耗时"""
+        self.durations[name] = self.durations.get(name, 0.0) + seconds * 1000
+
+    def mark(self, name: str) -> float:
+        """记录从请求开始到现在的时间（例如首 token），返回秒数"""
+        elapsed = time.perf_counter() - self.started
+        self.durations[name] = elapsed * 1000
+        return elapsed
+
+    def elapsed(self) -> float:
+        """请求开始到现在的时间（秒）"""
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict[str, float]:
+        """{阶段: 毫秒}（包括 total）"""
+        timings = {name: round(ms, 1) for name, ms in self.durations.items()}
+        timings["total"] = round(self.elapsed() * 1000, 1)
+        return timings
+
+    def server_timing(self) -> str:
+        """``Server-Timing`` 响应头的值"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.as_dict().items())
+
+
+_current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "howtolive_timings", default=None
+)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """当前请求的阶段耗时（不在请求中时为 None）"""
+    return _current_timings.get()
+
+
+@contextmanager
+def timings_scope(timings: Optional[RequestTimings]) -> Iterator[None]:
+    """在此作用域内（包括其中创建的任务）记录到指定的请求耗时"""
+    token = _current_timings.set(timings)
+    try:
+        yield
+    finally:
+        _current_timings.reset(token)
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """记录一次阶段耗时（指标 + 当前请求）"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """记录代码块的阶段耗时，异常时同样记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
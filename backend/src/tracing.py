@@ -0,0 +1,414 @@
+"""请求级链路追踪
+
+每次聊天请求是一条 trace，流水线阶段、模型调用、工具调用、知识库 / 记忆检索和
+会话读写是其中嵌套的 span。当前 span 通过 ContextVar 传递，Agent 任务和工具调用
+中创建的 span 自动挂到请求下。
+
+采样在请求结束时决定（尾部采样）：按 ``sample_ratio`` 随机保留，
+耗时超过 ``slow_threshold`` 或出错的请求总是保留，便于排查慢请求。
+保留的 span 由后台线程批量导出到本地 JSONL 文件（按大小轮转）或 OTLP/HTTP 端点。
+
+未配置（``tracer.configure``）时所有 span 都是空操作，开销可以忽略。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """一个计时区间"""
+
+    __slots__ = (
+        "trace", "name", "span_id", "parent_id", "attributes",
+        "start_ns", "end_ns", "_start_perf", "status", "status_message",
+    )
+
+    def __init__(self, trace: "_Trace", name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.start_ns = time.time_ns()
+        self._start_perf = time.perf_counter_ns()
+        self.end_ns: Optional[int] = None
+        self.status = "ok"
+        self.status_message = ""
+
+    @property
+    def recording(self) -> bool:
+        return True
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else self.start_ns + time.perf_counter_ns() - self._start_perf
+        return (end - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_error(self, error: BaseException) -> None:
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            self.status = "cancelled"
+            return
+        self.status = "error"
+        self.status_message = f"{type(error).__name__}: {error}"[:500]
+        self.trace.error = True
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = self.start_ns + time.perf_counter_ns() - self._start_perf
+            self.trace.tracer._on_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "status_message": self.status_message or None,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """不记录的 span（未启用追踪或不在请求中）"""
+
+    recording = False
+    span_id = None
+    duration_ms = 0.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes: Any) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    """一次请求的所有 span（根 span 结束时决定是否导出）"""
+
+    def __init__(self, tracer: "Tracer", sampled: bool):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.error = False
+        self.root: Optional[Span] = None
+        self.spans: list[Span] = []
+        self.exported = False
+        self.dropped = 0
+
+
+_current_span: contextvars.ContextVar[Any] = contextvars.ContextVar("howtolive_span", default=NOOP_SPAN)
+
+
+def current_span() -> Any:
+    """当前的 span（不在追踪中时为空操作 span）"""
+    return _current_span.get()
+
+
+class JsonlExporter:
+    """导出到本地 JSONL 文件（每行一个 span，超过 max_bytes 时轮转）"""
+
+    def __init__(self, path: str | Path, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, spans: list[dict]) -> None:
+        data = "".join(json.dumps(span, ensure_ascii=False) + "\n" for span in spans)
+        if self.max_bytes and self.path.exists() and self.path.stat().st_size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def _rotate(self) -> None:
+        if self.backup_count <= 0:
+            self.path.unlink(missing_ok=True)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+
+class OtlpHttpExporter:
+    """导出到 OTLP/HTTP（JSON 编码）端点，例如 OpenTelemetry Collector、Jaeger、Tempo"""
+
+    def __init__(
+        self,
+        endpoint: str = "http://localhost:4318",
+        headers: Optional[dict] = None,
+        timeout: float = 5.0,
+        service_name: str = "howtolive-api",
+    ):
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else f"{endpoint}/v1/traces"
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.timeout = timeout
+        self.service_name = service_name
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _encode(self, span: dict) -> dict:
+        encoded = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span["start_time_unix_nano"]),
+            "endTimeUnixNano": str(span["end_time_unix_nano"]),
+            "attributes": [self._attribute(k, v) for k, v in span["attributes"].items()],
+            "status": {"code": 2, "message": span["status_message"] or ""} if span["status"] == "error" else {"code": 1},
+        }
+        if span["parent_id"]:
+            encoded["parentSpanId"] = span["parent_id"]
+        return encoded
+
+    def export(self, spans: list[dict]) -> None:
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": "howtolive"},
+                    "spans": [self._encode(span) for span in spans],
+                }],
+            }],
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode("utf-8"),
+            headers=self.headers,
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class _BatchProcessor:
+    """后台线程批量导出（队列满时丢弃，不阻塞请求）"""
+
+    def __init__(self, exporter: Any, max_queue: int = 4096, batch_size: int = 256, flush_interval: float = 2.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self.stats = {"exported": 0, "dropped": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._worker, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, spans: list[dict]) -> None:
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.stats["dropped"] += 1
+
+    def _worker(self) -> None:
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._export(batch)
+
+    def _export(self, batch: list[dict]) -> None:
+        try:
+            self.exporter.export(batch)
+            self.stats["exported"] += len(batch)
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            logger.warning(f"⚠️ span 导出失败（{len(batch)} 个）: {e}")
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._thread.join(timeout=timeout)
+
+
+class Tracer:
+    """追踪器（进程内单例 ``tracer``）"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sample_ratio = 1.0
+        self.slow_threshold: Optional[float] = None
+        self.max_spans_per_trace = 1000
+        self._processor: Optional[_BatchProcessor] = None
+        self.stats = {"traces": 0, "sampled": 0}
+
+    def configure(self, cfg: Optional[dict], base_dir: str | Path = ".") -> None:
+        """按 api.yaml 的 tracing 配置块启用追踪
+
+        Args:
+            cfg: tracing 配置块
+            base_dir: JSONL 文件相对路径的基准目录
+        """
+        cfg = cfg or {}
+        self.shutdown()
+        self.enabled = bool(cfg.get("enabled", False))
+        if not self.enabled:
+            return
+
+        self.sample_ratio = float(cfg.get("sample_ratio", 1.0))
+        slow = cfg.get("slow_threshold")
+        self.slow_threshold = float(slow) if slow else None
+        self.max_spans_per_trace = int(cfg.get("max_spans_per_trace", 1000))
+
+        exporter_name = cfg.get("exporter", "jsonl")
+        if exporter_name == "otlp":
+            otlp_cfg = cfg.get("otlp", {})
+            exporter = OtlpHttpExporter(
+                endpoint=otlp_cfg.get("endpoint", "http://localhost:4318"),
+                headers=otlp_cfg.get("headers"),
+                timeout=float(otlp_cfg.get("timeout", 5)),
+                service_name=cfg.get("service_name", "howtolive-api"),
+            )
+        else:
+            jsonl_cfg = cfg.get("jsonl", {})
+            exporter = JsonlExporter(
+                Path(base_dir) / jsonl_cfg.get("path", "data/traces/spans.jsonl"),
+                max_bytes=int(jsonl_cfg.get("max_bytes", 10 * 1024 * 1024)),
+                backup_count=int(jsonl_cfg.get("backup_count", 5)),
+            )
+        self._processor = _BatchProcessor(exporter, flush_interval=float(cfg.get("flush_interval", 2.0)))
+
+    def start_span(self, name: str, attributes: Optional[dict] = None, root: bool = False) -> Any:
+        """开始一个 span（不设置为当前 span，需要手动 end）
+
+        Args:
+            name: span 名称
+            attributes: 属性
+            root: 是否开始一条新的 trace（否则只在已有的 trace 中创建）
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if root:
+            self.stats["traces"] += 1
+            trace = _Trace(self, sampled=random.random() < self.sample_ratio)
+            span = Span(trace, name, None, attributes or {})
+            trace.root = span
+            return span
+        if not parent.recording:
+            return NOOP_SPAN
+        trace = parent.trace
+        if len(trace.spans) >= self.max_spans_per_trace:
+            trace.dropped += 1
+            return NOOP_SPAN
+        return Span(trace, name, parent.span_id, attributes or {})
+
+    def _on_end(self, span: Span) -> None:
+        trace = span.trace
+        if trace.exported:
+            # 根 span 结束后才结束的 span（例如被取消的后台任务）
+            if self._processor is not None:
+                self._processor.submit([span.to_dict()])
+            return
+        trace.spans.append(span)
+        if span is not trace.root:
+            return
+
+        slow = self.slow_threshold is not None and span.duration_ms >= self.slow_threshold * 1000
+        if trace.dropped:
+            span.set_attribute("trace.dropped_spans", trace.dropped)
+        if (trace.sampled or slow or trace.error) and self._processor is not None:
+            trace.exported = True
+            self.stats["sampled"] += 1
+            self._processor.submit([s.to_dict() for s in trace.spans])
+        trace.spans = []
+
+    def get_stats(self) -> dict:
+        """追踪统计"""
+        stats = {**self.stats, "enabled": self.enabled}
+        if self._processor is not None:
+            stats.update(self._processor.stats)
+        return stats
+
+    def shutdown(self) -> None:
+        """导出剩余的 span 并停止后台线程"""
+        if self._processor is not None:
+            self._processor.shutdown()
+            self._processor = None
+
+
+# 进程内共享的追踪器
+tracer = Tracer()
+
+
+@contextmanager
+def start_span(name: str, root: bool = False, **attributes: Any) -> Iterator[Any]:
+    """在此作用域内创建并激活一个 span（包括其中创建的任务）"""
+    span = tracer.start_span(name, attributes, root=root)
+    if not span.recording:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+@contextmanager
+def use_span(span: Any) -> Iterator[Any]:
+    """在此作用域内把已有的 span 设为当前 span（不结束 span，用于跨多次 await 的 span，例如流式工具）"""
+    if not span.recording:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
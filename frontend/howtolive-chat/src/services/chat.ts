@@ -31,6 +31,8 @@ export const streamChat = async (
       headers: {
         'Content-Type': 'application/json',
         'Authorization': `Bearer ${token}`,
+        // 多 worker 部署时负载均衡器按会话路由（同一会话由同一个 worker 处理）
+        'X-Session-Id': sessionId,
       },
       body: JSON.stringify({ 
         session_id: sessionId, 